@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Micro-benchmarks for the storage API. These are not shipped with the
+package; run them from the repository root, e.g.::
+
+    python -m benchmarks.normalisation
+"""
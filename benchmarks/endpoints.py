@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Measure the latency and throughput of every endpoint of the API on a
+DummyStorage filled with a large, seeded, synthetic fleet of volumes,
+snapshots, export policies and locks.
+
+Every case is run through the Flask test client, and straight through
+the WSGI application (i.e. without the overhead of the test client).
+The results are written as a JSON report. Given the report of an
+earlier run (e.g. of the last release) as a baseline, the cases whose
+median latency grew by more than --max-regression are listed in the
+report, and the exit status is 1.
+
+Usage: python -m benchmarks.endpoints [--volumes N] [--snapshots N]
+           [--policies N] [--seed N] [--requests N] [--max-time-s S]
+           [--trusted] [--output FILE] [--baseline FILE]
+           [--max-regression R]
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta
+
+SUBSYSTEM = "dummy"
+AGGREGATES = 32
+FILERS = 8
+LOCKED_FRACTION = 0.01
+EPOCH = datetime(2015, 1, 1)
+
+Fleet = namedtuple('Fleet', 'volumes, snapshots, policies, locks')
+
+Case = namedtuple('Case', 'name, method, path, body, status, headers,'
+                          ' setup, first_chunk')
+
+
+def case(name, method, path, body=None, status=200, headers=None,
+         setup=None, first_chunk=False):
+    """
+    A request to time. path is a format string, or a function of i (the
+    number of the request, unique over the whole run) returning the
+    path, and setup (if given) is run with i before each request,
+    without being timed.
+    """
+    return Case(name, method, path, body, status, headers or {}, setup,
+                first_chunk)
+
+
+def make_fleet(volumes, snapshots, policies, seed=0):
+    """
+    Return a Fleet of seeded random volumes (by name), their snapshots
+    (volume name -> snapshot name -> snapshot), export policies (name ->
+    rules) and locks (volume name -> host).
+    """
+    rng = random.Random(seed)
+
+    policy_rules = OrderedDict()
+    for i in range(policies):
+        policy_rules["policy_{:05d}".format(i)] = [
+            "10.{}.{}.0/24".format(rng.randrange(256), rng.randrange(256))
+            for _ in range(rng.randint(1, 4))]
+    policy_names = list(policy_rules)
+
+    vols = OrderedDict()
+    for i in range(volumes):
+        name = "volume_{:06d}".format(i)
+        size_total = rng.randrange(1, 1024) * 2 ** 30
+        vol = {'name': name,
+               'uuid': str(uuid.UUID(int=rng.getrandbits(128))),
+               'junction_path': "/{}".format(name),
+               'aggregate_name': "aggr{}".format(
+                   rng.randrange(1, AGGREGATES + 1)),
+               'state': rng.choice(['online'] * 18
+                                   + ['offline', 'restricted']),
+               'size_used': rng.randrange(size_total),
+               'size_total': size_total,
+               'filer_address': "filer{}.cern.ch".format(
+                   rng.randrange(FILERS)),
+               'creation_time': EPOCH + timedelta(
+                   seconds=rng.randrange(3 * 365 * 86400)),
+               'compression_enabled': rng.random() < 0.5,
+               'inline_compression': rng.random() < 0.5,
+               'percentage_snapshot_reserve': rng.choice([0, 5, 10, 20]),
+               'percentage_snapshot_reserve_used': rng.randrange(100),
+               'caching_policy': None}
+        if policy_names:
+            vol['active_policy_name'] = rng.choice(policy_names)
+        vols[name] = vol
+
+    snaps = OrderedDict()
+    per_volume, extra = divmod(snapshots, max(volumes, 1))
+    for i, (volume_name, vol) in enumerate(vols.items()):
+        snaps[volume_name] = OrderedDict()
+        taken = vol['creation_time']
+        for j in range(per_volume + (1 if i < extra else 0)):
+            taken += timedelta(seconds=rng.randrange(3600, 86400))
+            snap_name = "snap_{:05d}".format(j)
+            snaps[volume_name][snap_name] = {
+                'name': snap_name,
+                'size_kbytes': rng.randrange(1, 2 ** 20),
+                'creation_time': taken}
+
+    locks = OrderedDict(
+        (volume_name, "db{:03d}.cern.ch".format(rng.randrange(1000)))
+        for volume_name in vols if rng.random() < LOCKED_FRACTION)
+
+    return Fleet(vols, snaps, policy_rules, locks)
+
+
+def populate(storage, fleet):
+    """
+    Fill a DummyStorage with a fleet.
+    """
+    storage.load(fleet.volumes, fleet.snapshots, fleet.policies, fleet.locks)
+
+
+def make_app(trusted):
+    os.environ.update({
+        'SAPI_BACKENDS': ("{}🌈DummyStorage🌈trusted🌈{}"
+                          .format(SUBSYSTEM, str(trusted).lower())),
+        'SAPI_OAUTH_CLIENT_ID': "benchmark",
+        'SAPI_OAUTH_SECRET_KEY': "benchmark",
+        # Scanning a large fleet in the background would disturb the
+        # measurements. The first scan happens on first use.
+        'SAPI_CHANGEFEED_INTERVAL_S': str(7 * 24 * 3600)})
+
+    from storage_api.app import app
+
+    logging.getLogger('SAPI').setLevel(logging.WARNING)
+    app.logger.setLevel(logging.WARNING)
+    storage = app.extensions[app.config['SUBSYSTEM'][SUBSYSTEM]]
+    return app, storage
+
+
+def make_cases(fleet, storage):
+    from storage_api.apis import SAPI_MOUNTPOINT
+    from storage_api.extensions.changefeed import format_token
+
+    root = "{}/{}".format(SAPI_MOUNTPOINT, SUBSYSTEM)
+    volume_names = list(fleet.volumes)
+    locked_names = list(fleet.locks) or volume_names
+    policy_names = list(fleet.policies)
+    with_snapshots = [name for name in volume_names
+                      if fleet.snapshots[name]] or volume_names
+
+    def volume(i):
+        return volume_names[i % len(volume_names)]
+
+    def snapped(i):
+        return with_snapshots[i % len(with_snapshots)]
+
+    def snapshot(i):
+        return next(iter(fleet.snapshots[snapped(i)]), "none")
+
+    def policy(i):
+        return policy_names[i % len(policy_names)]
+
+    def rule(i):
+        return "10.255.{}.{}".format(i // 256 % 256, i % 256)
+
+    def create_volume(i):
+        storage.create_volume("bench_{}".format(i))
+
+    def create_snapshot(i):
+        storage.create_snapshot(volume(i), "bench_{}".format(i))
+
+    def remove_lock(i):
+        host = storage.locks(volume(i))
+        if host is not None:
+            storage.remove_lock(volume(i), host)
+
+    def create_lock(i):
+        remove_lock(i)
+        storage.create_lock(volume(i), "bench.cern.ch")
+
+    def create_policy(i):
+        storage.create_policy("bench_{}".format(i), [rule(i)])
+
+    def add_rule(i):
+        storage.ensure_policy_rule_present(policy(i), rule(i))
+
+    json_headers = {'Content-Type': 'application/json'}
+    cases = [
+        case("list volumes", 'GET', root + "/volumes"),
+        case("list volumes, streamed", 'GET', root + "/volumes?stream=true"),
+        case("list volumes, ndjson", 'GET', root + "/volumes",
+             headers={'Accept': 'application/x-ndjson'}),
+        case("list volumes, page", 'GET', root + "/volumes?limit=100"),
+        case("list volumes, projected", 'GET',
+             root + "/volumes?fields=name,size_used"),
+        case("list volumes, filtered", 'GET',
+             root + "/volumes?aggregate_name=aggr1"),
+        case("list volumes, changes", 'GET',
+             lambda i: root + "/volumes?since=" + format_token(time.time())),
+        case("get volume", 'GET',
+             lambda i: "{}/volumes/{}".format(root, volume(i))),
+        case("create volume", 'POST',
+             lambda i: "{}/volumes/bench_{}".format(root, i),
+             body={}, status=201, headers=json_headers),
+        case("patch volume", 'PATCH',
+             lambda i: "{}/volumes/{}".format(root, volume(i)),
+             body={'size_total': 2 ** 40}, headers=json_headers),
+        case("restrict volume", 'DELETE',
+             lambda i: "{}/volumes/bench_{}".format(root, i),
+             status=204, setup=create_volume),
+        case("list snapshots", 'GET',
+             lambda i: "{}/volumes/{}/snapshots".format(root, snapped(i))),
+        case("get snapshot", 'GET',
+             lambda i: "{}/volumes/{}/snapshots/{}".format(
+                 root, snapped(i), snapshot(i))),
+        case("create snapshot", 'POST',
+             lambda i: "{}/volumes/{}/snapshots/bench_{}".format(
+                 root, volume(i), i),
+             body={}, status=201, headers=json_headers),
+        case("delete snapshot", 'DELETE',
+             lambda i: "{}/volumes/{}/snapshots/bench_{}".format(
+                 root, volume(i), i),
+             status=204, setup=create_snapshot),
+        case("get locks", 'GET',
+             lambda i: "{}/volumes/{}/locks".format(
+                 root, locked_names[i % len(locked_names)])),
+        case("create lock", 'PUT',
+             lambda i: "{}/volumes/{}/locks/bench.cern.ch".format(
+                 root, volume(i)),
+             status=201, setup=remove_lock),
+        case("remove lock", 'DELETE',
+             lambda i: "{}/volumes/{}/locks/bench.cern.ch".format(
+                 root, volume(i)),
+             status=204, setup=create_lock),
+        case("list export policies", 'GET', root + "/export"),
+        case("list export policies, granting", 'GET',
+             root + "/export?granting=10.0.0.0/8"),
+        case("get export policy", 'GET',
+             lambda i: "{}/export/{}".format(root, policy(i))),
+        case("create export policy", 'POST',
+             lambda i: "{}/export/bench_{}".format(root, i),
+             body={'rules': ["10.0.0.0/24"]}, status=201,
+             headers=json_headers),
+        case("delete export policy", 'DELETE',
+             lambda i: "{}/export/bench_{}".format(root, i),
+             status=204, setup=create_policy),
+        case("add export rule", 'PUT',
+             lambda i: "{}/export/{}/rule/{}".format(root, policy(i),
+                                                     rule(i)),
+             status=201),
+        case("remove export rule", 'DELETE',
+             lambda i: "{}/export/{}/rule/{}".format(root, policy(i),
+                                                     rule(i)),
+             status=204, setup=add_rule),
+        case("volumes accessible from", 'GET',
+             lambda i: "{}/access/10.{}.{}.1".format(
+                 root, i % 256, i // 256 % 256)),
+        case("batch of 20 gets", 'POST', root + "/batch",
+             body={'operations': [
+                 {'operation': 'get_volume',
+                  'arguments': {'volume_name': name}}
+                 for name in volume_names[:20]]},
+             headers=json_headers),
+        case("events, first event", 'GET', root + "/events",
+             first_chunk=True),
+        case("list volumes of all subsystems", 'GET',
+             SAPI_MOUNTPOINT + "/_all/volumes"),
+        case("get volume of all subsystems", 'GET',
+             lambda i: "{}/_all/volumes/{}".format(SAPI_MOUNTPOINT,
+                                                   volume(i))),
+        case("list subsystems", 'GET', "/conf/subsystems"),
+        case("subsystem connections", 'GET',
+             "/conf/subsystems/{}/connections".format(SUBSYSTEM),
+             status=404),
+        case("list roles", 'GET', "/conf/roles"),
+        case("role egroups", 'GET', "/conf/roles/USER/egroups"),
+        case("am I a", 'GET', "/conf/roles/ADMIN/am_i_a"),
+        case("my roles", 'GET', "/conf/me/roles"),
+    ]
+    return cases
+
+
+def case_path(c, i):
+    return c.path(i) if callable(c.path) else c.path
+
+
+def uncovered_endpoints(app, cases):
+    """
+    Return a sorted list of the "METHOD rule" of the endpoints of the
+    storage and introspection APIs no case exercises.
+    """
+    from storage_api.apis import INTROSPECTION_MOUNTPOINT, SAPI_MOUNTPOINT
+
+    adapter = app.url_map.bind("localhost")
+    covered = set()
+    for c in cases:
+        path = case_path(c, 0).split("?")[0]
+        endpoint, _ = adapter.match(path, method=c.method)
+        covered.add((endpoint, c.method))
+
+    uncovered = []
+    for rule in app.url_map.iter_rules():
+        if not (rule.rule.startswith(SAPI_MOUNTPOINT)
+                or rule.rule.startswith(INTROSPECTION_MOUNTPOINT)):
+            continue
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            if (rule.endpoint, method) not in covered:
+                uncovered.append("{} {}".format(method, rule.rule))
+    return sorted(uncovered)
+
+
+class TestClientDriver(object):
+    """
+    Send requests through the Flask test client.
+    """
+    name = "test_client"
+
+    def __init__(self, app, client):
+        self.client = client
+
+    def prepare(self, c, i):
+        path = case_path(c, i)
+        data = json.dumps(c.body) if c.body is not None else None
+
+        def send():
+            response = self.client.open(path, method=c.method, data=data,
+                                        headers=c.headers,
+                                        buffered=not c.first_chunk)
+            if c.first_chunk:
+                next(response.iter_encoded(), None)
+                response.close()
+            return response.status_code
+        return send
+
+
+class WSGIDriver(object):
+    """
+    Call the WSGI application directly, with an environment built
+    beforehand.
+    """
+    name = "wsgi"
+
+    def __init__(self, app, client):
+        from werkzeug.test import EnvironBuilder
+
+        self.app = app
+        self.builder = EnvironBuilder
+        self.cookie = "; ".join("{}={}".format(cookie.name, cookie.value)
+                                for cookie in client.cookie_jar)
+
+    def prepare(self, c, i):
+        path = case_path(c, i)
+        query = ""
+        if "?" in path:
+            path, query = path.split("?", 1)
+        headers = dict(c.headers, Cookie=self.cookie)
+        builder = self.builder(
+            path=path, query_string=query, method=c.method, headers=headers,
+            data=json.dumps(c.body) if c.body is not None else None)
+        environ = builder.get_environ()
+        builder.close()
+
+        def send():
+            status = []
+
+            def start_response(status_line, headers, exc_info=None):
+                status.append(int(status_line.split(" ", 1)[0]))
+
+            body = self.app(environ, start_response)
+            try:
+                for _ in body:
+                    if c.first_chunk:
+                        break
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+            return status[0]
+        return send
+
+
+def percentile(ordered, fraction):
+    """
+    The nearest-rank percentile of a sorted, non-empty list.
+    """
+    rank = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def measure(driver, c, counter, requests, warmup, max_time_s):
+    """
+    Run c warmup times, then requests times or until max_time_s have
+    passed (but at least once), and return a dictionary of statistics.
+    """
+    for _ in range(warmup):
+        i = next(counter)
+        if c.setup is not None:
+            c.setup(i)
+        driver.prepare(c, i)()
+
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    while (len(latencies) < requests
+           and (not latencies
+                or time.perf_counter() - started < max_time_s)):
+        i = next(counter)
+        if c.setup is not None:
+            c.setup(i)
+        send = driver.prepare(c, i)
+
+        before = time.perf_counter()
+        status = send()
+        latencies.append(time.perf_counter() - before)
+        if status != c.status:
+            errors += 1
+
+    return summarise(latencies, errors)
+
+
+def summarise(latencies, errors):
+    """
+    Return a dictionary of statistics about a non-empty list of
+    latencies (in seconds), of which errors failed.
+    """
+    ordered = sorted(latencies)
+    return OrderedDict([
+        ('requests', len(latencies)),
+        ('errors', errors),
+        ('mean_ms', sum(latencies) / len(latencies) * 1e3),
+        ('p50_ms', percentile(ordered, 0.5) * 1e3),
+        ('p90_ms', percentile(ordered, 0.9) * 1e3),
+        ('p99_ms', percentile(ordered, 0.99) * 1e3),
+        ('max_ms', ordered[-1] * 1e3),
+        ('throughput_rps', len(latencies) / sum(latencies)),
+    ])
+
+
+def find_regressions(report, baseline, max_regression):
+    """
+    Return a list of the cases whose median latency in report is more
+    than max_regression (a fraction) above the one in baseline.
+    """
+    regressions = []
+    for mode, results in report['results'].items():
+        old_results = baseline.get('results', {}).get(mode, {})
+        for name, result in results.items():
+            old = old_results.get(name)
+            if old is None:
+                continue
+            threshold = old['p50_ms'] * (1 + max_regression)
+            if result['p50_ms'] > threshold:
+                regressions.append(OrderedDict([
+                    ('mode', mode),
+                    ('case', name),
+                    ('p50_ms', result['p50_ms']),
+                    ('baseline_p50_ms', old['p50_ms']),
+                    ('threshold_ms', threshold)]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--volumes', type=int, default=50000)
+    parser.add_argument('--snapshots', type=int, default=1000000)
+    parser.add_argument('--policies', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=20,
+                        help="Timed requests per case and mode")
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--max-time-s', type=float, default=10,
+                        help="Stop timing a case after this long")
+    parser.add_argument('--trusted', action='store_true',
+                        help="Do not validate what DummyStorage returns")
+    parser.add_argument('--output', '-o', default="benchmark-report.json",
+                        help="Where to write the JSON report")
+    parser.add_argument('--baseline', type=argparse.FileType('r'),
+                        help="The JSON report to compare against")
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help=("Tolerated growth of the median latency"
+                              " over the baseline, as a fraction"))
+    args = parser.parse_args(argv)
+
+    from storage_api.apis import __version__
+    from storage_api.apis.common import (ADMIN_ROLE, UBER_ADMIN_ROLE,
+                                         USER_ROLE)
+
+    app, storage = make_app(args.trusted)
+    print("Generating {} volumes, {} snapshots and {} policies (seed {})"
+          .format(args.volumes, args.snapshots, args.policies, args.seed),
+          file=sys.stderr)
+    fleet = make_fleet(args.volumes, args.snapshots, args.policies,
+                       seed=args.seed)
+    populate(storage, fleet)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user'] = {'roles': [USER_ROLE, ADMIN_ROLE,
+                                     UBER_ADMIN_ROLE]}
+
+    cases = make_cases(fleet, storage)
+    uncovered = uncovered_endpoints(app, cases)
+    if uncovered:
+        print("Endpoints without cases: {}".format(", ".join(uncovered)),
+              file=sys.stderr)
+
+    counter = itertools.count()
+    results = OrderedDict()
+    for driver_class in [TestClientDriver, WSGIDriver]:
+        driver = driver_class(app, client)
+        results[driver.name] = OrderedDict()
+        for c in cases:
+            result = measure(driver, c, counter, args.requests,
+                             args.warmup, args.max_time_s)
+            results[driver.name][c.name] = result
+            print("{:<12} {:<36} {:9.2f} ms p50 {:9.2f} ms p99"
+                  " {:9.1f} req/s{}".format(
+                      driver.name, c.name, result['p50_ms'],
+                      result['p99_ms'], result['throughput_rps'],
+                      " ({} errors)".format(result['errors'])
+                      if result['errors'] else ""),
+                  file=sys.stderr)
+
+    report = OrderedDict([
+        ('version', __version__),
+        ('created', datetime.utcnow().isoformat() + "Z"),
+        ('python', platform.python_version()),
+        ('fleet', OrderedDict([('volumes', args.volumes),
+                               ('snapshots', args.snapshots),
+                               ('policies', args.policies),
+                               ('locks', len(fleet.locks)),
+                               ('seed', args.seed),
+                               ('trusted', args.trusted)])),
+        ('uncovered', uncovered),
+        ('results', results),
+    ])
+
+    regressions = []
+    if args.baseline:
+        baseline = json.load(args.baseline)
+        if baseline.get('fleet') != report['fleet']:
+            print("The baseline was run on a different fleet: {}"
+                  .format(baseline.get('fleet')), file=sys.stderr)
+        regressions = find_regressions(report, baseline,
+                                       args.max_regression)
+        report['baseline'] = OrderedDict([
+            ('version', baseline.get('version')),
+            ('max_regression', args.max_regression)])
+        report['regressions'] = regressions
+        for regression in regressions:
+            print("Regression: {mode} {case}: {p50_ms:.2f} ms >"
+                  " {threshold_ms:.2f} ms".format(**regression),
+                  file=sys.stderr)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
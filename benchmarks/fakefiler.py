@@ -0,0 +1,977 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+A stand-in for the ZAPI of an ONTAP filer, over plain HTTP, backed by
+an in-memory model of a (synthetic, seeded) fleet of volumes, snapshots,
+export policies, locks and aggregates.
+
+It answers the calls netapp.api.Server and NetappStorage make: the
+volume, sis, snapshot, export policy and rule, lock, aggregate and
+system-get-version calls. Listings are paginated like ONTAP does, with
+max-records and next-tag, queries match with * wildcards and |
+alternatives, and only the desired-attributes are returned.
+
+The latency, the rate of (injected) failures and the default page size
+of every call type can be set, so that NetappStorage can be load-tested
+against a slow or flaky filer with a large fleet, e.g.:
+
+    python -m benchmarks.fakefiler --port 8080 --volumes 50000 \\
+        --latency '*=0.005' --latency volume-get-iter=0.2 \\
+        --error-rate snapshot-create=0.01
+
+and a back-end configured with hostname 127.0.0.1, port 8080 and
+scheme http. See also benchmarks/netapp.py.
+
+Usage: python -m benchmarks.fakefiler [--host HOST] [--port N]
+           [--volumes N] [--snapshots N] [--policies N] [--seed N]
+           [--vserver NAME] [--latency CALL=S] [--error-rate CALL=F]
+           [--max-records CALL=N]
+"""
+import argparse
+import calendar
+import fnmatch
+import itertools
+import random
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, namedtuple, OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import lxml.builder
+import lxml.etree
+from netapp.api import ONTAP_API_URL, XMLNS
+
+from benchmarks.endpoints import make_fleet
+
+Z = lxml.builder.ElementMaker(namespace=XMLNS, nsmap={None: XMLNS})
+
+# ONTAP's default number of records per page of a *-get-iter call
+DEFAULT_MAX_RECORDS = 20
+AGGREGATE_SIZE = 2 ** 50
+MAX_CURSORS = 1000
+
+# ONTAP error numbers, as far as NetappStorage tells them apart
+EEXIST = 17
+EBUSY = 16
+EAPIERROR = 13001
+EAPINOTFOUND = 13005
+EOBJECTNOTFOUND = 15661
+
+CallProfile = namedtuple('CallProfile', 'latency_s, error_rate, max_records')
+CallProfile.__new__.__defaults__ = (0.0, 0.0, DEFAULT_MAX_RECORDS)
+
+# A kind of record, as listed by a *-get-iter call: the tag of its
+# element, and its fields as (path of the element, function of the
+# record returning the value, or None to leave the element out)
+RecordKind = namedtuple('RecordKind', 'tag, fields')
+
+
+class ZapiError(Exception):
+    def __init__(self, errno, reason):
+        super().__init__(reason)
+        self.errno = errno
+        self.reason = reason
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            return str(calendar.timegm(value.timetuple()))
+        return str(int(value.timestamp()))
+    return str(value)
+
+
+def _parse_size(size):
+    """
+    Parse a size in bytes, possibly a float or with a k, m, g or t
+    suffix, as netapp.api.Server sends them.
+    """
+    size = size.strip().lower()
+    multiplier = 1
+    if size and size[-1] in "kmgt":
+        multiplier = 1024 ** ("kmgt".index(size[-1]) + 1)
+        size = size[:-1]
+    try:
+        return int(float(size) * multiplier)
+    except ValueError:
+        raise ZapiError(EAPIERROR, "Invalid size: {}".format(size))
+
+
+def _local_name(element):
+    return lxml.etree.QName(element).localname
+
+
+def _leaves(element, path=()):
+    """
+    A generator of (path, text) of the elements under element without
+    children of their own.
+    """
+    for child in element:
+        child_path = path + (child.tag,)
+        if len(child):
+            yield from _leaves(child, child_path)
+        else:
+            yield child_path, (child.text or "")
+
+
+def _matches(value, pattern):
+    """
+    ONTAP query matching, limited to * wildcards and | alternatives.
+    """
+    if value is None:
+        return False
+    value = _format_value(value)
+    return any(fnmatch.fnmatchcase(value, alternative)
+               for alternative in pattern.split("|"))
+
+
+def _text(api_call, *path, default=None):
+    text = api_call.findtext("/".join(path))
+    return default if text is None else text
+
+
+def _required(api_call, *path):
+    text = api_call.findtext("/".join(path))
+    if text is None:
+        raise ZapiError(EAPIERROR, "Missing input: {}".format("/".join(path)))
+    return text
+
+
+def _element(path, value):
+    element = leaf = Z(path[0])
+    for tag in path[1:]:
+        child = Z(tag)
+        leaf.append(child)
+        leaf = child
+    leaf.text = _format_value(value)
+    return element
+
+
+def _merge(parent, element):
+    """
+    Append element to parent, merging it into a sibling with the same
+    tag if there is one and it has children.
+    """
+    if len(element):
+        for sibling in parent:
+            if sibling.tag == element.tag and len(sibling):
+                for child in element:
+                    _merge(sibling, child)
+                return
+    parent.append(element)
+
+
+VOLUME = RecordKind('volume-attributes', [
+    (('volume-id-attributes', 'name'), lambda v: v['name']),
+    (('volume-id-attributes', 'uuid'), lambda v: v['uuid']),
+    (('volume-id-attributes', 'junction-path'),
+     lambda v: v['junction_path']),
+    (('volume-id-attributes', 'containing-aggregate-name'),
+     lambda v: v['aggregate_name']),
+    (('volume-id-attributes', 'node'), lambda v: v['filer_address']),
+    (('volume-id-attributes', 'owning-vserver-name'),
+     lambda v: v['vserver']),
+    (('volume-id-attributes', 'creation-time'),
+     lambda v: v['creation_time']),
+    (('volume-space-attributes', 'size-total'), lambda v: v['size_total']),
+    (('volume-space-attributes', 'size-used'), lambda v: v['size_used']),
+    (('volume-space-attributes', 'percentage-snapshot-reserve'),
+     lambda v: v['percentage_snapshot_reserve']),
+    (('volume-space-attributes', 'percentage-snapshot-reserve-used'),
+     lambda v: v['percentage_snapshot_reserve_used']),
+    (('volume-autosize-attributes', 'is-enabled'),
+     lambda v: v['autosize_enabled']),
+    (('volume-autosize-attributes', 'maximum-size'),
+     lambda v: v['max_autosize']),
+    (('volume-state-attributes', 'state'), lambda v: v['state']),
+    (('volume-export-attributes', 'policy'),
+     lambda v: v['active_policy_name']),
+    (('volume-hybrid-cache-attributes', 'caching-policy'),
+     lambda v: v['caching_policy']),
+])
+
+SIS = RecordKind('sis-status-info', [
+    (('path',), lambda v: "/vol/{}".format(v['name'])),
+    (('vserver',), lambda v: v['vserver']),
+    (('is-compression-enabled',), lambda v: v['compression_enabled']),
+    (('is-inline-compression-enabled',),
+     lambda v: v['inline_compression']),
+])
+
+SNAPSHOT = RecordKind('snapshot-info', [
+    (('volume',), lambda vs: vs[0]),
+    (('name',), lambda vs: vs[1]['name']),
+    (('access-time',), lambda vs: vs[1]['creation_time']),
+    (('total',), lambda vs: vs[1]['size_kbytes']),
+])
+
+LOCK = RecordKind('lock-info', [
+    (('volume',), lambda vh: vh[0]),
+    (('lock-state',), lambda vh: "granted"),
+    (('client-address',), lambda vh: vh[1]),
+])
+
+EXPORT_POLICY = RecordKind('export-policy-info', [
+    (('policy-name',), lambda p: p[0]),
+    (('policy-id',), lambda p: p[1]),
+])
+
+EXPORT_RULE = RecordKind('export-rule-info', [
+    (('policy-name',), lambda pir: pir[0]),
+    (('rule-index',), lambda pir: pir[1]),
+    (('client-match',), lambda pir: pir[2]),
+])
+
+AGGREGATE = RecordKind('aggr-attributes', [
+    (('aggregate-name',), lambda a: a['name']),
+    (('aggr-space-attributes', 'size-used'), lambda a: a['size_used']),
+    (('aggr-space-attributes', 'size-available'),
+     lambda a: a['size_available']),
+    (('nodes', 'node-name'), lambda a: a['node']),
+])
+
+VSERVER_AGGREGATE = RecordKind('show-aggregates', [
+    (('aggregate-name',), lambda a: a['name']),
+    (('available-size',), lambda a: a['size_available']),
+    (('vserver-name',), lambda a: a['vserver']),
+])
+
+
+def render(kind, record, desired=None):
+    """
+    Return the element of record, with only the fields whose paths are
+    in desired (or all of them).
+    """
+    element = Z(kind.tag)
+    for path, value_of in kind.fields:
+        if desired is not None and path not in desired:
+            continue
+        value = value_of(record)
+        if value is not None:
+            _merge(element, _element(path, value))
+    return element
+
+
+def desired_paths(kind, api_call):
+    """
+    Return the set of the paths of the fields of kind asked for in the
+    desired-attributes of api_call, or None for all of them.
+
+    netapp.api.Server sometimes asks for attributes ONTAP does not call
+    the way it reads them. Rather than failing like ONTAP would, all
+    fields are returned if any of the desired attributes is unknown.
+    """
+    desired = api_call.find('desired-attributes')
+    if desired is None:
+        return None
+    if len(desired) == 1 and desired[0].tag == kind.tag:
+        desired = desired[0]
+
+    prefixes = [path for path, _text in _leaves(desired)]
+    paths = set()
+    for prefix in prefixes:
+        matching = [path for path, _value_of in kind.fields
+                    if path[:len(prefix)] == prefix]
+        if not matching:
+            return None
+        paths.update(matching)
+    return paths
+
+
+def query_of(kind, api_call):
+    """
+    Return the query of api_call as a list of (field path, pattern).
+    """
+    query = api_call.find('query')
+    if query is None or not len(query):
+        return []
+    record = query[0]
+    if record.tag != kind.tag:
+        raise ZapiError(EAPIERROR, "Invalid query: {}".format(record.tag))
+    return list(_leaves(record))
+
+
+def matcher(kind, query):
+    """
+    Return a function telling whether a record of kind matches query.
+    """
+    fields = dict(kind.fields)
+    try:
+        patterns = [(fields[path], pattern) for path, pattern in query]
+    except KeyError as e:
+        raise ZapiError(EAPIERROR, "Invalid query: {}"
+                        .format("/".join(e.args[0])))
+    return lambda record: all(_matches(value_of(record), pattern)
+                              for value_of, pattern in patterns)
+
+
+class FakeFiler(object):
+    """
+    The in-memory model of a filer, and the implementation of its ZAPI
+    calls. Thread-safe.
+
+    profiles maps call names (or '*' for all other calls) to the
+    CallProfile to apply to them.
+    """
+
+    def __init__(self, vserver="vs0", profiles=None, seed=0):
+        self.vserver = vserver
+        self.profiles = dict(profiles or {})
+        self.profiles.setdefault('*', CallProfile())
+        self.calls = Counter()  # type: Counter
+        self.errors_injected = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.RLock()
+        self._cursors = OrderedDict()  # type: OrderedDict
+        self._cursor_ids = itertools.count(1)
+        self.volumes = OrderedDict()  # type: OrderedDict
+        self.sis_enabled = set()
+        self.snapshots = OrderedDict()  # type: OrderedDict
+        self.policies = OrderedDict([('default', OrderedDict())])
+        self.policy_ids = {'default': 1}
+        self.locks = OrderedDict()  # type: OrderedDict
+        self.aggregate_nodes = OrderedDict()  # type: OrderedDict
+
+    @classmethod
+    def from_fleet(cls, fleet, **kwargs):
+        """
+        A FakeFiler holding a Fleet (see benchmarks.endpoints.make_fleet).
+        """
+        filer = cls(**kwargs)
+        filer.load(fleet)
+        return filer
+
+    def load(self, fleet):
+        with self._lock:
+            for name, vol in fleet.volumes.items():
+                self.volumes[name] = dict(
+                    vol, vserver=self.vserver, autosize_enabled=True,
+                    max_autosize=int(vol['size_total'] * 1.2),
+                    active_policy_name=vol.get('active_policy_name',
+                                               'default'))
+                self.sis_enabled.add(name)
+                self.aggregate_nodes.setdefault(vol['aggregate_name'],
+                                                vol['filer_address'])
+                self.snapshots[name] = OrderedDict(
+                    (snap_name, dict(snapshot)) for snap_name, snapshot
+                    in fleet.snapshots.get(name, {}).items())
+            for name, rules in fleet.policies.items():
+                self._add_policy(name, rules)
+            for name, host in fleet.locks.items():
+                self.locks.setdefault(name, []).append(host)
+
+    def profile(self, call_name):
+        return self.profiles.get(call_name, self.profiles['*'])
+
+    def handle(self, body):
+        """
+        Answer a ZAPI request (bytes), returning the response (bytes).
+        """
+        request = lxml.etree.fromstring(body)
+        for element in request.iter():
+            if isinstance(element.tag, str):
+                element.tag = _local_name(element)
+        api_call = request[0]
+        name = api_call.tag
+        try:
+            results = self.call(name, api_call)
+            results.set('status', "passed")
+        except ZapiError as e:
+            results = Z('results', status="failed", reason=e.reason,
+                        errno=str(e.errno))
+        return lxml.etree.tostring(Z('netapp', results, version="1.21"),
+                                   xml_declaration=True, encoding="UTF-8")
+
+    def call(self, name, api_call):
+        """
+        Perform the call name, after its latency and maybe failing like
+        its profile says, returning its <results> element.
+
+        Raises ZapiError if the call fails.
+        """
+        profile = self.profile(name)
+        with self._lock:
+            self.calls[name] += 1
+            failed = (profile.error_rate > 0
+                      and self._rng.random() < profile.error_rate)
+            if failed:
+                self.errors_injected += 1
+        if profile.latency_s > 0:
+            time.sleep(profile.latency_s)
+        if failed:
+            raise ZapiError(EBUSY, "Injected failure of {}".format(name))
+
+        method = getattr(self, "zapi_" + name.replace("-", "_"), None)
+        if method is None:
+            raise ZapiError(EAPINOTFOUND,
+                            "Unable to find API: {}".format(name))
+        with self._lock:
+            return method(api_call)
+
+    # Listings
+
+    def _candidates(self, kind, query):
+        """
+        The records of kind that may match query, narrowed down with
+        exact matches on what is indexed.
+        """
+        exact = {path: pattern for path, pattern in query
+                 if "*" not in pattern and "|" not in pattern}
+        if kind is VOLUME or kind is SIS:
+            if kind is VOLUME:
+                name = exact.get(('volume-id-attributes', 'name'))
+            elif exact.get(('path',), "").startswith("/vol/"):
+                name = exact[('path',)][len("/vol/"):]
+            else:
+                name = None
+            if name is not None:
+                return [self.volumes[name]] if name in self.volumes else []
+            return list(self.volumes.values())
+        if kind is SNAPSHOT:
+            names = ([exact[('volume',)]] if ('volume',) in exact
+                     else list(self.snapshots))
+            return [(name, snapshot) for name in names
+                    for snapshot in self.snapshots.get(name, {}).values()]
+        if kind is LOCK:
+            names = ([exact[('volume',)]] if ('volume',) in exact
+                     else list(self.locks))
+            return [(name, host) for name in names
+                    for host in self.locks.get(name, [])]
+        if kind is EXPORT_POLICY:
+            return [(name, self.policy_ids[name]) for name in self.policies]
+        if kind is EXPORT_RULE:
+            names = ([exact[('policy-name',)]] if ('policy-name',) in exact
+                     else list(self.policies))
+            return [(name, index, rule) for name in names
+                    for index, rule
+                    in sorted(self.policies.get(name, {}).items())]
+        if kind is AGGREGATE or kind is VSERVER_AGGREGATE:
+            return self._aggregates()
+        raise ValueError(kind)
+
+    def _aggregates(self):
+        used = Counter()  # type: Counter
+        for vol in self.volumes.values():
+            used[vol['aggregate_name']] += vol['size_total']
+        return [{'name': name, 'node': node, 'vserver': self.vserver,
+                 'size_used': used[name],
+                 'size_available': max(AGGREGATE_SIZE - used[name], 0)}
+                for name, node in self.aggregate_nodes.items()]
+
+    def _list(self, kind, api_call):
+        """
+        Answer a *-get-iter call for records of kind: a page of the
+        matching records, and a next-tag if there are more.
+        """
+        tag = api_call.findtext('tag')
+        if tag:
+            cursor_id, _, offset = tag.partition(":")
+            records = self._cursors.get(cursor_id)
+            if records is None:
+                raise ZapiError(EAPIERROR, "Invalid tag: {}".format(tag))
+            offset = int(offset)
+        else:
+            query = query_of(kind, api_call)
+            records = list(filter(matcher(kind, query),
+                                  self._candidates(kind, query)))
+            cursor_id = None
+            offset = 0
+
+        max_records = int(_text(api_call, 'max-records',
+                                default=self.profile(api_call.tag)
+                                .max_records))
+        page = records[offset:offset + max_records]
+        desired = desired_paths(kind, api_call)
+        results = Z('results',
+                    Z('attributes-list',
+                      *[render(kind, record, desired) for record in page]),
+                    Z('num-records', str(len(page))))
+
+        if offset + max_records < len(records):
+            if cursor_id is None:
+                cursor_id = str(next(self._cursor_ids))
+                self._cursors[cursor_id] = records
+                while len(self._cursors) > MAX_CURSORS:
+                    self._cursors.popitem(last=False)
+            results.append(Z('next-tag', "{}:{}".format(
+                cursor_id, offset + max_records)))
+        elif cursor_id is not None:
+            self._cursors.pop(cursor_id, None)
+        return results
+
+    def zapi_volume_get_iter(self, api_call):
+        return self._list(VOLUME, api_call)
+
+    def zapi_sis_get_iter(self, api_call):
+        return self._list(SIS, api_call)
+
+    def zapi_snapshot_get_iter(self, api_call):
+        return self._list(SNAPSHOT, api_call)
+
+    def zapi_lock_get_iter(self, api_call):
+        return self._list(LOCK, api_call)
+
+    def zapi_export_policy_get_iter(self, api_call):
+        return self._list(EXPORT_POLICY, api_call)
+
+    def zapi_export_rule_get_iter(self, api_call):
+        return self._list(EXPORT_RULE, api_call)
+
+    def zapi_aggr_get_iter(self, api_call):
+        return self._list(AGGREGATE, api_call)
+
+    def zapi_vserver_show_aggr_get_iter(self, api_call):
+        return self._list(VSERVER_AGGREGATE, api_call)
+
+    def zapi_system_get_version(self, api_call):
+        return Z('results', Z('version', "NetApp Release 8.3.2 (fake)"))
+
+    # Volumes
+
+    def _volume(self, name):
+        try:
+            return self.volumes[name]
+        except KeyError:
+            raise ZapiError(EOBJECTNOTFOUND,
+                            "Volume {} does not exist".format(name))
+
+    def _sis_volume(self, api_call):
+        path = _required(api_call, 'path')
+        if not path.startswith("/vol/"):
+            raise ZapiError(EAPIERROR, "Invalid path: {}".format(path))
+        return self._volume(path[len("/vol/"):])
+
+    def zapi_volume_create(self, api_call):
+        name = _required(api_call, 'volume')
+        aggregate_name = _required(api_call, 'containing-aggr-name')
+        if name in self.volumes:
+            raise ZapiError(EEXIST, "Volume {} already exists".format(name))
+        if aggregate_name not in self.aggregate_nodes:
+            raise ZapiError(EOBJECTNOTFOUND, "Aggregate {} does not exist"
+                            .format(aggregate_name))
+        size = _parse_size(_required(api_call, 'size'))
+        self.volumes[name] = {
+            'name': name,
+            'uuid': str(uuid.UUID(int=self._rng.getrandbits(128))),
+            'junction_path': _text(api_call, 'junction-path'),
+            'aggregate_name': aggregate_name,
+            'filer_address': self.aggregate_nodes[aggregate_name],
+            'vserver': self.vserver,
+            'creation_time': datetime.utcnow(),
+            'state': 'online',
+            'size_total': size,
+            'size_used': 0,
+            'percentage_snapshot_reserve': int(_text(
+                api_call, 'percentage-snapshot-reserve', default=0)),
+            'percentage_snapshot_reserve_used': 0,
+            'autosize_enabled': False,
+            'max_autosize': size,
+            'active_policy_name': _text(api_call, 'export-policy',
+                                        default='default'),
+            'caching_policy': _text(api_call, 'caching-policy'),
+            'compression_enabled': False,
+            'inline_compression': False,
+        }
+        self.snapshots[name] = OrderedDict()
+        return Z('results')
+
+    def zapi_volume_clone_create(self, api_call):
+        parent = self._volume(_required(api_call, 'parent-volume'))
+        name = _required(api_call, 'volume')
+        if name in self.volumes:
+            raise ZapiError(EEXIST, "Volume {} already exists".format(name))
+        parent_snapshot = _text(api_call, 'parent-snapshot')
+        if (parent_snapshot
+                and parent_snapshot not in self.snapshots[parent['name']]):
+            raise ZapiError(EOBJECTNOTFOUND, "Snapshot {} does not exist"
+                            .format(parent_snapshot))
+        self.volumes[name] = dict(
+            parent, name=name,
+            uuid=str(uuid.UUID(int=self._rng.getrandbits(128))),
+            junction_path=_text(api_call, 'junction-path'),
+            creation_time=datetime.utcnow(), state='online')
+        if parent['name'] in self.sis_enabled:
+            self.sis_enabled.add(name)
+        self.snapshots[name] = OrderedDict()
+        return Z('results')
+
+    def zapi_volume_autosize_set(self, api_call):
+        volume = self._volume(_required(api_call, 'volume'))
+        volume['autosize_enabled'] = _required(api_call,
+                                               'is-enabled') == "true"
+        maximum_size = _text(api_call, 'maximum-size')
+        if maximum_size is not None:
+            volume['max_autosize'] = _parse_size(maximum_size)
+        return Z('results')
+
+    def zapi_volume_size(self, api_call):
+        volume = self._volume(_required(api_call, 'volume'))
+        volume['size_total'] = _parse_size(_required(api_call, 'new-size'))
+        return Z('results')
+
+    def zapi_volume_modify_iter(self, api_call):
+        query = query_of(VOLUME, api_call)
+        attributes = api_call.find('attributes/volume-attributes')
+        if attributes is None:
+            raise ZapiError(EAPIERROR, "Missing input: attributes")
+
+        # The fields of the volume dictionaries that can be modified
+        modifiable = {
+            ('volume-export-attributes', 'policy'):
+                ('active_policy_name', str),
+            ('volume-space-attributes', 'percentage-snapshot-reserve'):
+                ('percentage_snapshot_reserve', int),
+            ('volume-hybrid-cache-attributes', 'caching-policy'):
+                ('caching_policy', str),
+            ('volume-state-attributes', 'state'): ('state', str),
+        }
+        changes = {}
+        for path, text in _leaves(attributes):
+            if path not in modifiable:
+                raise ZapiError(EAPIERROR, "Cannot modify {}"
+                                .format("/".join(path)))
+            key, parse = modifiable[path]
+            changes[key] = parse(text)
+
+        volumes = list(filter(matcher(VOLUME, query),
+                              self._candidates(VOLUME, query)))
+        policy = changes.get('active_policy_name')
+        if policy is not None and policy not in self.policies:
+            succeeded = 0
+            failures = [Z('volume-modify-iter-info',
+                          Z('error-code', str(EOBJECTNOTFOUND)),
+                          Z('error-message', "Export policy {} does not"
+                            " exist".format(policy)))
+                        for _volume in volumes]
+        else:
+            for volume in volumes:
+                volume.update(changes)
+            succeeded = len(volumes)
+            failures = []
+
+        results = Z('results', Z('num-succeeded', str(succeeded)),
+                    Z('num-failed', str(len(failures))))
+        if failures:
+            results.append(Z('failure-list', *failures))
+        return results
+
+    def zapi_sis_enable(self, api_call):
+        volume = self._sis_volume(api_call)
+        if volume['name'] in self.sis_enabled:
+            raise ZapiError(EAPIERROR, "SIS is already enabled")
+        self.sis_enabled.add(volume['name'])
+        return Z('results')
+
+    def zapi_sis_set_config(self, api_call):
+        volume = self._sis_volume(api_call)
+        if volume['name'] not in self.sis_enabled:
+            raise ZapiError(EAPIERROR, "SIS is not enabled")
+        volume['compression_enabled'] = _text(
+            api_call, 'enable-compression') == "true"
+        volume['inline_compression'] = _text(
+            api_call, 'enable-inline-compression') == "true"
+        return Z('results')
+
+    def zapi_volume_unmount(self, api_call):
+        volume = self._volume(_required(api_call, 'volume-name'))
+        volume['junction_path'] = None
+        return Z('results')
+
+    def zapi_volume_restrict(self, api_call):
+        volume = self._volume(_required(api_call, 'name'))
+        volume['state'] = 'restricted'
+        return Z('results')
+
+    def zapi_volume_destroy(self, api_call):
+        volume = self._volume(_required(api_call, 'name'))
+        if volume['state'] == 'online':
+            raise ZapiError(EAPIERROR, "Volume {} is online"
+                            .format(volume['name']))
+        del self.volumes[volume['name']]
+        self.snapshots.pop(volume['name'], None)
+        self.locks.pop(volume['name'], None)
+        self.sis_enabled.discard(volume['name'])
+        return Z('results')
+
+    # Snapshots
+
+    def _snapshots_of(self, api_call):
+        return self.snapshots[self._volume(_required(api_call,
+                                                     'volume'))['name']]
+
+    def zapi_snapshot_create(self, api_call):
+        snapshots = self._snapshots_of(api_call)
+        name = _required(api_call, 'snapshot')
+        if name in snapshots:
+            raise ZapiError(EEXIST, "Snapshot {} already exists"
+                            .format(name))
+        snapshots[name] = {'name': name,
+                           'size_kbytes': 0,
+                           'creation_time': datetime.utcnow()}
+        return Z('results')
+
+    def zapi_snapshot_delete(self, api_call):
+        snapshots = self._snapshots_of(api_call)
+        name = _required(api_call, 'snapshot')
+        if snapshots.pop(name, None) is None:
+            raise ZapiError(EOBJECTNOTFOUND, "Snapshot {} does not exist"
+                            .format(name))
+        return Z('results')
+
+    def zapi_snapshot_restore_volume(self, api_call):
+        snapshots = self._snapshots_of(api_call)
+        name = _required(api_call, 'snapshot')
+        if name not in snapshots:
+            raise ZapiError(EOBJECTNOTFOUND, "Snapshot {} does not exist"
+                            .format(name))
+        # Restoring deletes the snapshots taken after the restored one
+        restored = snapshots[name]['creation_time']
+        for later in [s['name'] for s in snapshots.values()
+                      if s['creation_time'] > restored]:
+            del snapshots[later]
+        return Z('results')
+
+    # Export policies
+
+    def _add_policy(self, name, rules=()):
+        self.policies[name] = OrderedDict(enumerate(rules, start=1))
+        self.policy_ids[name] = max(self.policy_ids.values()) + 1
+
+    def _policy(self, api_call):
+        name = _required(api_call, 'policy-name')
+        try:
+            return self.policies[name]
+        except KeyError:
+            raise ZapiError(EOBJECTNOTFOUND, "Export policy {} does not"
+                            " exist".format(name))
+
+    def zapi_export_policy_create(self, api_call):
+        name = _required(api_call, 'policy-name')
+        if name in self.policies:
+            raise ZapiError(EEXIST, "Export policy {} already exists"
+                            .format(name))
+        self._add_policy(name)
+        return Z('results',
+                 Z('export-policy-info',
+                   Z('policy-name', name),
+                   Z('policy-id', str(self.policy_ids[name]))))
+
+    def zapi_export_policy_destroy(self, api_call):
+        self._policy(api_call)
+        name = _required(api_call, 'policy-name')
+        if any(v['active_policy_name'] == name
+               for v in self.volumes.values()):
+            raise ZapiError(EAPIERROR, "Export policy {} is in use"
+                            .format(name))
+        del self.policies[name]
+        del self.policy_ids[name]
+        return Z('results')
+
+    def zapi_export_rule_create(self, api_call):
+        rules = self._policy(api_call)
+        rule = _required(api_call, 'client-match')
+        index = int(_text(api_call, 'rule-index', default=len(rules) + 1))
+        # Like ONTAP, the rules from index on are moved down one step
+        for moved in sorted((i for i in rules if i >= index), reverse=True):
+            rules[moved + 1] = rules.pop(moved)
+        rules[index] = rule
+        return Z('results')
+
+    def zapi_export_rule_destroy(self, api_call):
+        rules = self._policy(api_call)
+        index = int(_required(api_call, 'rule-index'))
+        if rules.pop(index, None) is None:
+            raise ZapiError(EOBJECTNOTFOUND, "Export rule {} does not exist"
+                            .format(index))
+        return Z('results')
+
+    def zapi_export_rule_set_index(self, api_call):
+        rules = self._policy(api_call)
+        index = int(_required(api_call, 'rule-index'))
+        new_index = int(_required(api_call, 'new-rule-index'))
+        if index not in rules:
+            raise ZapiError(EOBJECTNOTFOUND, "Export rule {} does not exist"
+                            .format(index))
+        rule = rules.pop(index)
+        if new_index in rules:
+            for moved in sorted((i for i in rules if i >= new_index),
+                                reverse=True):
+                rules[moved + 1] = rules.pop(moved)
+        rules[new_index] = rule
+        return Z('results')
+
+    # Locks
+
+    def zapi_lock_break_iter(self, api_call):
+        query = dict(query_of(LOCK, api_call))
+        volume_name = query.get(('volume',), "*")
+        host_pattern = query.get(('client-address',), "*")
+        broken = 0
+        for name in [n for n in self.locks if _matches(n, volume_name)]:
+            hosts = self.locks[name]
+            remaining = [h for h in hosts if not _matches(h, host_pattern)]
+            broken += len(hosts) - len(remaining)
+            if remaining:
+                self.locks[name] = remaining
+            else:
+                del self.locks[name]
+        return Z('results', Z('num-succeeded', str(broken)),
+                 Z('num-failed', "0"))
+
+
+class FakeFilerHandler(BaseHTTPRequestHandler):
+    # Keep connections alive, like the filer does. As headers and bodies
+    # are written separately, Nagle's algorithm would hold the bodies
+    # back until the client acknowledges the headers.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != ONTAP_API_URL:
+            self._respond(404, b"Not Found", "text/plain")
+            return
+        try:
+            response = self.server.filer.handle(body)
+        except lxml.etree.XMLSyntaxError:
+            self._respond(400, b"Bad Request", "text/plain")
+            return
+        self._respond(200, response, "text/xml")
+
+    def _respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeFilerServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, filer, address):
+        self.filer = filer
+        super().__init__(address, FakeFilerHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def serve(filer, host="127.0.0.1", port=0):
+    """
+    Serve filer on host and port (0 for any free port) from a daemon
+    thread, and return the FakeFilerServer. Call its shutdown() method
+    to stop it.
+    """
+    server = FakeFilerServer(filer, (host, port))
+    thread = threading.Thread(target=server.serve_forever,
+                              name="fake-filer", daemon=True)
+    thread.start()
+    return server
+
+
+def parse_profiles(latencies, error_rates, max_records):
+    """
+    Return a dictionary of call name -> CallProfile from lists of
+    "CALL=VALUE" strings. What a call does not set is taken from the
+    profile of '*'.
+    """
+    settings = []
+    for strings, field, parse in [(latencies, 'latency_s', float),
+                                  (error_rates, 'error_rate', float),
+                                  (max_records, 'max_records', int)]:
+        for string in strings:
+            call, _, value = string.partition("=")
+            if not call or not value:
+                raise ValueError("Expected CALL=VALUE, got {}"
+                                 .format(string))
+            settings.append((call, field, parse(value)))
+
+    default = CallProfile()
+    for call, field, value in settings:
+        if call == '*':
+            default = default._replace(**{field: value})
+
+    profiles = {'*': default}
+    for call, field, value in settings:
+        profiles[call] = profiles.get(call, default)._replace(
+            **{field: value})
+    return profiles
+
+
+def add_filer_arguments(parser):
+    parser.add_argument('--volumes', type=int, default=5000)
+    parser.add_argument('--snapshots', type=int, default=50000)
+    parser.add_argument('--policies', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--vserver', default="vs0")
+    parser.add_argument('--latency', action='append', default=[],
+                        metavar="CALL=S",
+                        help=("Seconds every CALL takes (* for all other"
+                              " calls). May be repeated."))
+    parser.add_argument('--error-rate', action='append', default=[],
+                        metavar="CALL=F",
+                        help="Fraction of the CALLs that fail")
+    parser.add_argument('--max-records', action='append', default=[],
+                        metavar="CALL=N",
+                        help=("Records per page of CALL when the client"
+                              " does not say (default: {})"
+                              .format(DEFAULT_MAX_RECORDS)))
+
+
+def make_filer(args):
+    """
+    Return a FakeFiler holding a fleet, as set up by the arguments of
+    add_filer_arguments().
+    """
+    fleet = make_fleet(args.volumes, args.snapshots, args.policies,
+                       seed=args.seed)
+    profiles = parse_profiles(args.latency, args.error_rate,
+                              args.max_records)
+    return FakeFiler.from_fleet(fleet, vserver=args.vserver,
+                                profiles=profiles, seed=args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    add_filer_arguments(parser)
+    args = parser.parse_args(argv)
+
+    filer = make_filer(args)
+    server = FakeFilerServer(filer, (args.host, args.port))
+    print("Serving {} volumes of vserver {} on http://{}:{}{}"
+          .format(len(filer.volumes), args.vserver, args.host, server.port,
+                  ONTAP_API_URL), file=sys.stderr)
+    print("Back-end configuration: NetappStorage🌈hostname🌈{}🌈port🌈{}"
+          "🌈scheme🌈http🌈vserver🌈{}🌈username🌈admin🌈password🌈admin"
+          .format(args.host, server.port, args.vserver), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Measure the latency of the operations of a NetappStorage talking ZAPI
+over HTTP to a FakeFiler (see benchmarks/fakefiler.py) holding a large,
+seeded, synthetic fleet, and count the ZAPI calls each operation makes.
+
+The latency, failure rate and page size of the calls of the filer are
+set with the same arguments as for benchmarks.fakefiler. The results
+are written as a JSON report.
+
+Usage: python -m benchmarks.netapp [--volumes N] [--snapshots N]
+           [--policies N] [--seed N] [--latency CALL=S]
+           [--error-rate CALL=F] [--max-records CALL=N] [--requests N]
+           [--max-time-s S] [--uncached] [--trusted] [--output FILE]
+"""
+import argparse
+import ipaddress
+import itertools
+import json
+import logging
+import platform
+import sys
+import time
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+from benchmarks.endpoints import summarise
+from benchmarks.fakefiler import add_filer_arguments, make_filer, serve
+
+Operation = namedtuple('Operation', 'name, run, setup')
+
+
+def operation(name, run, setup=None):
+    """
+    An operation to time: run (and setup, without being timed, if
+    given) are called with i, the number of the run, unique over the
+    whole benchmark.
+    """
+    return Operation(name, run, setup)
+
+
+def make_storage(port, vserver, uncached, trusted):
+    from storage_api.extensions.storage import NetappStorage
+
+    # Refreshing caches in the background would disturb the measurements
+    kwargs = dict(volume_index_refresh_s=0, inventory_refresh_s=0,
+                  policy_index_refresh_s=0)
+    if uncached:
+        kwargs.update(inventory_ttl_s=0, snapshot_cache_s=0,
+                      aggregate_cache_s=0)
+    return NetappStorage(hostname="127.0.0.1", port=port, scheme="http",
+                         username="admin", password="admin",
+                         vserver=vserver, trusted=trusted, **kwargs)
+
+
+def make_operations(filer, storage):
+    volume_names = list(filer.volumes)
+    locked_names = list(filer.locks) or volume_names
+    policy_names = [name for name in filer.policies if name != 'default']
+    with_snapshots = [name for name in volume_names
+                      if filer.snapshots[name]] or volume_names
+
+    def volume(i):
+        return volume_names[i % len(volume_names)]
+
+    def path(name):
+        # NetappStorage only creates snapshots of node:junction paths
+        return ":{}".format(filer.volumes[name]['junction_path'])
+
+    def snapped(i):
+        return with_snapshots[i % len(with_snapshots)]
+
+    def snapshot(i):
+        return next(iter(filer.snapshots[snapped(i)]), "none")
+
+    def policy(i):
+        return policy_names[i % len(policy_names)]
+
+    def rule(i):
+        return "10.255.{}.{}".format(i // 256 % 256, i % 256)
+
+    def create_volume(i, prefix="bench"):
+        name = "{}_{}".format(prefix, i)
+        storage.create_volume(name, junction_path="/{}".format(name),
+                              size_total=2 ** 30)
+
+    def create_snapshot(i):
+        storage.create_snapshot(path(volume(i)), "bench_{}".format(i))
+
+    def lock(i):
+        # There is no way of locking a volume through ZAPI
+        with filer._lock:
+            filer.locks.setdefault(volume(i), []).append("bench.cern.ch")
+
+    def create_policy(i):
+        storage.create_policy("bench_{}".format(i), [rule(i)])
+
+    def add_rule(i):
+        storage.ensure_policy_rule_present(policy(i), rule(i))
+
+    return [
+        operation("list volumes", lambda i: storage.volumes),
+        operation("filter volumes", lambda i: storage.filter_volumes(
+            aggregate_name="aggr1")),
+        operation("get volume", lambda i: storage.get_volume(volume(i))),
+        operation("create volume", create_volume),
+        operation("patch volume", lambda i: storage.patch_volume(
+            volume(i), size_total=2 ** 30 * (i + 1))),
+        operation("restrict volume",
+                  lambda i: storage.restrict_volume("restrict_{}".format(i)),
+                  setup=lambda i: create_volume(i, prefix="restrict")),
+        operation("list snapshots",
+                  lambda i: storage.get_snapshots(snapped(i))),
+        operation("get snapshot",
+                  lambda i: storage.get_snapshot(snapped(i), snapshot(i))),
+        operation("create snapshot", create_snapshot),
+        operation("delete snapshot",
+                  lambda i: storage.delete_snapshot(volume(i),
+                                                    "bench_{}".format(i)),
+                  setup=create_snapshot),
+        operation("get locks", lambda i: storage.locks(
+            locked_names[i % len(locked_names)])),
+        operation("remove lock",
+                  lambda i: storage.remove_lock(volume(i), "bench.cern.ch"),
+                  setup=lock),
+        operation("list export policies", lambda i: storage.policies),
+        operation("get export policy",
+                  lambda i: storage.get_policy(policy(i))),
+        operation("create export policy", create_policy),
+        operation("delete export policy",
+                  lambda i: storage.remove_policy("bench_{}".format(i)),
+                  setup=create_policy),
+        operation("add export rule", add_rule),
+        operation("remove export rule",
+                  lambda i: storage.ensure_policy_rule_absent(policy(i),
+                                                              rule(i)),
+                  setup=add_rule),
+        operation("volumes accessible from",
+                  lambda i: storage.volumes_accessible_from(
+                      ipaddress.ip_network("10.{}.{}.1".format(
+                          i % 256, i // 256 % 256)))),
+        operation("scan state", lambda i: storage.scan_state()),
+    ]
+
+
+def describe(e):
+    # APIErrors go on with the whole query
+    return "{}: {}".format(type(e).__name__, str(e).split("\n")[0])
+
+
+def measure(filer, op, counter, requests, max_time_s):
+    """
+    Run op requests times or until max_time_s have passed (but at least
+    once), and return a dictionary of statistics, including the mean
+    number of ZAPI calls per run, or None if op could never be set up.
+    """
+    latencies = []
+    errors = 0
+    setup_errors = 0
+    first_error = None
+    calls = 0
+    started = time.perf_counter()
+    while (len(latencies) < requests
+           and (not latencies
+                or time.perf_counter() - started < max_time_s)):
+        i = next(counter)
+        try:
+            if op.setup is not None:
+                op.setup(i)
+        except Exception as e:
+            # e.g. an injected failure, not part of what is measured
+            setup_errors += 1
+            first_error = first_error or describe(e)
+            if setup_errors > requests:
+                break
+            continue
+
+        calls_before = sum(filer.calls.values())
+        before = time.perf_counter()
+        try:
+            result = op.run(i)
+            if hasattr(result, '__next__'):
+                list(result)
+        except Exception as e:
+            errors += 1
+            first_error = first_error or describe(e)
+        latencies.append(time.perf_counter() - before)
+        calls += sum(filer.calls.values()) - calls_before
+
+    if not latencies:
+        return None
+    result = summarise(latencies, errors)
+    result['zapi_calls'] = calls / len(latencies)
+    result['setup_errors'] = setup_errors
+    if first_error is not None:
+        result['first_error'] = first_error
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    add_filer_arguments(parser)
+    parser.add_argument('--requests', type=int, default=10,
+                        help="Timed runs per operation")
+    parser.add_argument('--max-time-s', type=float, default=10,
+                        help="Stop timing an operation after this long")
+    parser.add_argument('--uncached', action='store_true',
+                        help=("Disable the inventory, snapshot and"
+                              " aggregate caches of NetappStorage"))
+    parser.add_argument('--trusted', action='store_true',
+                        help="Do not validate what the filer returns")
+    parser.add_argument('--output', '-o',
+                        default="netapp-benchmark-report.json",
+                        help="Where to write the JSON report")
+    args = parser.parse_args(argv)
+
+    from storage_api.apis import __version__
+
+    logging.getLogger('SAPI').setLevel(logging.WARNING)
+    print("Generating {} volumes, {} snapshots and {} policies (seed {})"
+          .format(args.volumes, args.snapshots, args.policies, args.seed),
+          file=sys.stderr)
+    filer = make_filer(args)
+    server = serve(filer)
+    try:
+        storage = make_storage(server.port, args.vserver, args.uncached,
+                               args.trusted)
+        counter = itertools.count()
+        results = OrderedDict()
+        for op in make_operations(filer, storage):
+            result = measure(filer, op, counter, args.requests,
+                             args.max_time_s)
+            results[op.name] = result
+            if result is None:
+                print("{:<28} could not be set up".format(op.name),
+                      file=sys.stderr)
+                continue
+            print("{:<28} {:9.2f} ms p50 {:9.2f} ms p99 {:9.1f} calls{}"
+                  .format(op.name, result['p50_ms'], result['p99_ms'],
+                          result['zapi_calls'],
+                          " ({} errors, first: {})".format(
+                              result['errors'] + result['setup_errors'],
+                              result['first_error'])
+                          if 'first_error' in result else ""),
+                  file=sys.stderr)
+        connections = storage.connection_stats()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    report = OrderedDict([
+        ('version', __version__),
+        ('created', datetime.utcnow().isoformat() + "Z"),
+        ('python', platform.python_version()),
+        ('fleet', OrderedDict([('volumes', args.volumes),
+                               ('snapshots', args.snapshots),
+                               ('policies', args.policies),
+                               ('seed', args.seed)])),
+        ('filer', OrderedDict([
+            ('profiles', OrderedDict(
+                (call, profile._asdict())
+                for call, profile in sorted(filer.profiles.items()))),
+            ('calls', OrderedDict(filer.calls.most_common())),
+            ('errors_injected', filer.errors_injected)])),
+        ('storage', OrderedDict([('uncached', args.uncached),
+                                 ('trusted', args.trusted),
+                                 ('connections', connections)])),
+        ('results', results),
+    ])
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
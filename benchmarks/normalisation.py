@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Compare the per-item cost of normalising a listing of volumes with
+normalised_with, against the way it used to be done (a fresh validator
+per call, validating and then normalising each volume on its own).
+
+Usage: python -m benchmarks.normalisation [--volumes N] [--repeat N]
+"""
+from storage_api.extensions.storage import normalised_with
+
+import argparse
+import timeit
+from datetime import datetime
+
+import cerberus
+
+
+def make_volumes(count):
+    return [{'name': "volume_{}".format(i),
+             'uuid': "uuid-{}".format(i),
+             'junction_path': "/volume_{}".format(i),
+             'aggregate_name': "aggr{}".format(i % 8 + 1),
+             'state': 'online',
+             'size_used': i * 1024,
+             'size_total': (i + 1) * 4096,
+             'filer_address': "node{}".format(i % 4),
+             'creation_time': datetime(2017, 1, 1),
+             'compression_enabled': True,
+             'inline_compression': False,
+             'percentage_snapshot_reserve': 5,
+             'percentage_snapshot_reserve_used': 1,
+             'caching_policy': None}
+            for i in range(count)]
+
+
+def per_item_before(volumes):
+    """
+    normalised_with('volume', as_list=True) as it was before validators
+    were cached and lists validated in batches.
+    """
+    schema = cerberus.schema_registry.get(name='volume')
+    v = cerberus.Validator(schema)
+    result = []
+    for volume in volumes:
+        v.validate(volume, normalize=True)
+        result.append(v.normalized(volume))
+    return result
+
+
+class Backend(object):
+    def __init__(self, volumes, trusted=False):
+        self.vols = volumes
+        self.trusted = trusted
+
+    @normalised_with('volume', as_list=True)
+    def batch(self):
+        return self.vols
+
+    @normalised_with('volume')
+    def one(self, volume):
+        return volume
+
+    def per_item(self):
+        return [self.one(volume) for volume in self.vols]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--volumes', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    volumes = make_volumes(args.volumes)
+    backend = Backend(volumes)
+    trusted = Backend(volumes, trusted=True)
+
+    cases = [("before (fresh validator, per item)",
+              lambda: per_item_before(volumes)),
+             ("cached validator, per item", backend.per_item),
+             ("cached validator, batch", backend.batch),
+             ("trusted", trusted.batch)]
+
+    print("Normalising {} volumes, best of {} runs"
+          .format(args.volumes, args.repeat))
+    baseline = None
+    for label, func in cases:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        per_item_us = best / args.volumes * 1e6
+        baseline = baseline or per_item_us
+        print("{:<40} {:10.2f} us/volume {:8.1f}x".format(
+            label, per_item_us, baseline / per_item_us))
+
+
+if __name__ == '__main__':
+    main()
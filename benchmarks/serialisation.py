@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Compare the per-item cost of marshalling a listing of volumes with the
+compiled serializers of storage_api.apis.common.serializers, against
+flask_restplus.marshal.
+
+Usage: python -m benchmarks.serialisation [--volumes N] [--repeat N]
+"""
+from benchmarks.normalisation import make_volumes
+from storage_api.apis.common.serializers import marshal_fast
+from storage_api.apis.storage import volume_read_model
+
+import argparse
+import json
+import timeit
+
+from flask_restplus import marshal
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--volumes', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    volumes = make_volumes(args.volumes)
+    assert (json.dumps(marshal_fast(volumes, volume_read_model))
+            == json.dumps(marshal(volumes, volume_read_model)))
+
+    cases = [("flask_restplus.marshal",
+              lambda: marshal(volumes, volume_read_model)),
+             ("marshal_fast",
+              lambda: marshal_fast(volumes, volume_read_model)),
+             ("flask_restplus.marshal, masked",
+              lambda: marshal(volumes, volume_read_model,
+                              mask="name,size_total")),
+             ("marshal_fast, masked",
+              lambda: marshal_fast(volumes, volume_read_model,
+                                   mask="name,size_total"))]
+
+    print("Marshalling {} volumes, best of {} runs"
+          .format(args.volumes, args.repeat))
+    for label, func in cases:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print("{:<40} {:10.2f} us/volume".format(
+            label, best / args.volumes * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -24,7 +24,7 @@ setup(name='storage-api',
       maintainer='Ignacio Coterillo',
       maintainer_email='icoteril@cern.ch',
       url='https://github.com/cerndb/storage-api',
-      packages=find_packages(),
+      packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
       # scripts=['storage-api.cgi', 'storage-api.wsgi'],
       test_suite="",
       install_requires=[
@@ -33,4 +33,10 @@ setup(name='storage-api',
           'flask_restplus',
           'flask',
           'flask_sso',
-      ])
+      ],
+      extras_require={
+          # Additional response encodings, besides gzip
+          'compression': ['brotli', 'zstandard'],
+          # MessagePack listings
+          'msgpack': ['msgpack'],
+      })
@@ -9,8 +9,7 @@
 # or submit itself to any jurisdiction.
 from storage_api.utils import init_logger
 
-from flask_restplus import Api
-
+from .specs import Api
 from .storage import api as unified_ns
 from .introspect import api as introspection_ns
 from .common.auth import authorizations
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Write the Swagger specification of the API, without running a server.
+
+Usage: python -m storage_api.apis [--output swagger.json]
+"""
+from storage_api.apis import api
+
+import argparse
+import json
+import sys
+
+import flask
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--output', '-o', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args(argv)
+
+    # The specification does not depend on the configuration of the
+    # back-ends, so there is no need for storage_api.app
+    app = flask.Flask(__name__)
+    api.init_app(app)
+    with app.test_request_context():
+        json.dump(api.__schema__, args.output, sort_keys=True, indent=4)
+    args.output.write("\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Compression of responses, in the encoding preferred by the client
+according to its Accept-Encoding header.
+
+gzip is always available, brotli ('br') and zstd only if the brotli and
+zstandard packages are installed, respectively.
+
+Streamed responses are compressed as they are sent, chunk by chunk,
+and are never held in memory as a whole. Event streams are left alone,
+as their events have to reach the clients as soon as they are sent.
+"""
+from storage_api.utils import init_logger
+
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+log = init_logger()
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson',
+                          'application/msgpack', 'text/html', 'text/plain',
+                          'text/css', 'application/javascript'}
+
+
+class GzipCompressor(object):
+    def __init__(self, level):
+        # wbits=31: a gzip header and trailer, with the largest window
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor(object):
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdCompressor(object):
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(
+            level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def available_compressors():
+    """
+    Return a dictionary of the usable encodings -> compressor classes.
+    """
+    compressors = {'gzip': GzipCompressor}
+    if brotli is not None:
+        compressors['br'] = BrotliCompressor
+    if zstandard is not None:
+        compressors['zstd'] = ZstdCompressor
+    return compressors
+
+
+COMPRESSORS = available_compressors()
+
+
+def compressed_chunks(chunks, compressor, close=None):
+    """
+    A generator of the compressed chunks (bytes) of a stream, skipping
+    the empty ones. close is called at the end, if given, even if the
+    stream is not consumed to the end.
+    """
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if close is not None:
+            close()
+
+
+def negotiated_encoding(encodings):
+    """
+    Return the encoding out of encodings (in order of preference) the
+    client prefers, or None if it accepts none of them.
+    """
+    return request.accept_encodings.best_match(
+        [e for e in encodings if e in COMPRESSORS])
+
+
+def compress_response(response):
+    """
+    Compress response if the client accepts it, and it is large and of a
+    type worth compressing. Meant to be used as an after_request hook.
+    """
+    config = current_app.config
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if (request.method == 'HEAD'
+            or not 200 <= response.status_code < 300
+            or response.status_code == 204):
+        return response
+
+    encoding = negotiated_encoding(config['COMPRESSION_ENCODINGS'])
+    if encoding is None:
+        return response
+
+    if not response.is_streamed:
+        length = response.calculate_content_length()
+        if length is not None and length < config['COMPRESSION_MIN_SIZE']:
+            return response
+
+    compressor = COMPRESSORS[encoding](config['COMPRESSION_LEVELS'][encoding])
+
+    if response.is_streamed:
+        body = response.response
+        response.response = compressed_chunks(
+            response.iter_encoded(), compressor,
+            close=getattr(body, 'close', None))
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes are not the same representation as the
+    # uncompressed ones, but they are semantically equivalent. Clients
+    # send weak ETags back in If-None-Match, which is compared weakly.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def setup_compression(app):
+    """
+    Compress the responses of app, according to its COMPRESSION_*
+    configuration (see conf.load_compression_conf()).
+    """
+    unavailable = [e for e in app.config['COMPRESSION_ENCODINGS']
+                   if e not in COMPRESSORS]
+    if unavailable:
+        log.warning("Compression encodings {} are not available, the"
+                    " Python packages they need are not installed"
+                    .format(", ".join(unavailable)))
+
+    app.after_request(compress_response)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Timing of requests, and a /metrics endpoint exposing the metrics of the
+application (see extensions.metrics) to Prometheus.
+
+Requests are timed from before their route runs until their response
+has been sent, which for streamed responses is when the whole stream
+has been sent.
+
+Every process writes a snapshot of its metrics to the metrics
+directory every METRICS_FLUSH_S seconds, and when scraped, and /metrics
+serves the sum of the snapshots of all processes. The directory is
+cleared when the app is loaded. If METRICS_DIR is set to an empty
+string, /metrics only covers the process serving the scrape.
+
+/metrics is outside of the API and its roles: if METRICS_TOKEN is set,
+scrapers must send it as a bearer token, otherwise it is open.
+
+The ZAPI calls made on behalf of each request are reported in its
+response headers (see setup_call_tracing()).
+"""
+from storage_api.utils import init_logger
+from storage_api.extensions import metrics, zapi
+from storage_api.extensions.cache import PeriodicRefresh
+
+import hmac
+import time
+
+from flask import Response, current_app, g, request
+
+log = init_logger()
+
+REQUEST_SECONDS = metrics.histogram(
+    'sapi_http_request_duration_seconds',
+    "Time from the start of a request until its response has been sent",
+    ['route', 'method'])
+RESPONSES = metrics.counter(
+    'sapi_http_responses_total',
+    "Responses sent, by status code",
+    ['route', 'method', 'status'])
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+def route():
+    """
+    The route template of the current request, rather than its path, so
+    that there is one set of metrics per endpoint and not per volume.
+    """
+    rule = request.url_rule
+    return rule.rule if rule is not None else UNMATCHED_ROUTE
+
+
+def record_response(response):
+    """
+    Count response, and time its request once it has been sent. Meant to
+    be used as an after_request hook.
+    """
+    labels = (route(), request.method)
+    RESPONSES.inc(*(labels + (str(response.status_code),)))
+
+    started = g.get('request_started')
+    if started is not None:
+        def observe():
+            REQUEST_SECONDS.observe(time.perf_counter() - started, *labels)
+
+        if response.is_streamed:
+            response.call_on_close(observe)
+        else:
+            observe()
+    return response
+
+
+def current_snapshot():
+    """
+    Return the snapshot of the metrics of all processes, or of this one
+    if there is no metrics directory.
+    """
+    snapshot = metrics.REGISTRY.snapshot()
+    directory = current_app.config.get('METRICS_DIR')
+    if not directory:
+        return snapshot
+
+    metrics.write_snapshot(directory, snapshot)
+    return metrics.merge_snapshots(metrics.read_snapshots(directory))
+
+
+def authorised():
+    """
+    Return True if the current request may read the metrics.
+    """
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        return True
+    return hmac.compare_digest(
+        request.headers.get('Authorization', "").encode('utf-8'),
+        "Bearer {}".format(token).encode('utf-8'))
+
+
+def expose_metrics():
+    if not authorised():
+        return Response("A valid bearer token is required\n", status=401,
+                        content_type='text/plain',
+                        headers={'WWW-Authenticate': 'Bearer'})
+    return Response(metrics.render(current_snapshot()),
+                    content_type=metrics.CONTENT_TYPE,
+                    headers={'Cache-Control': 'no-cache'})
+
+
+def setup_metrics(app):
+    """
+    Time the requests of app and serve its metrics on /metrics,
+    according to its METRICS_* configuration (see
+    conf.load_metrics_conf()).
+    """
+    directory = app.config.get('METRICS_DIR')
+    if directory:
+        # Once, in the uwsgi master, as it loads the app before forking
+        # the workers (see uwsgi.ini)
+        metrics.clear_snapshots(directory)
+
+    def flush():
+        metrics.write_snapshot(directory, metrics.REGISTRY.snapshot())
+
+    # Started on the first request, as uwsgi forks after loading the app
+    flusher = PeriodicRefresh(
+        app.config.get('METRICS_FLUSH_S', 0) if directory else 0,
+        flush, name="metrics-flush")
+
+    def before_request():
+        flusher.start()
+        start_timer()
+
+    app.before_request(before_request)
+    app.after_request(record_response)
+    app.add_url_rule('/metrics', 'metrics', expose_metrics)
+
+
+def server_timing(trace):
+    """
+    Return the Server-Timing header value for the ZAPI calls of trace:
+    the total, followed by the time spent in each kind of call.
+    """
+    def entry(name, calls, duration_s):
+        return '{};dur={:.1f};desc="{} call{}"'.format(
+            name, duration_s * 1000, calls, "" if calls == 1 else "s")
+
+    return ", ".join(
+        [entry("zapi", trace.calls, trace.duration_s)]
+        + [entry("zapi." + name, calls, duration_s)
+           for name, calls, duration_s in trace.summary()])
+
+
+def add_call_headers(response):
+    """
+    Report the ZAPI calls made so far on behalf of the current request
+    in the X-SAPI-Backend-Calls and Server-Timing headers of response.
+    Meant to be used as an after_request hook.
+
+    Calls made while a streamed response is being sent come too late to
+    be included.
+    """
+    trace = zapi.current_trace()
+    if trace is not None:
+        response.headers['X-SAPI-Backend-Calls'] = str(trace.calls)
+        response.headers.add('Server-Timing', server_timing(trace))
+    return response
+
+
+def setup_call_tracing(app):
+    """
+    Count and time the ZAPI calls made on behalf of each request of app
+    (see zapi.CallTrace), and report them in its response headers.
+    """
+    def start_trace():
+        zapi.start_trace()
+
+    def end_trace(exception):
+        zapi.end_trace()
+
+    app.before_request(start_trace)
+    app.after_request(add_call_headers)
+    app.teardown_request(end_trace)
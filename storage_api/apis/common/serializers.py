@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Fast marshalling of items with flask-restplus models, and serialisation
+of listings as streams of records.
+
+flask_restplus.marshal() walks the fields of a model for every item,
+dispatching to their output() methods. Instead, a serializer function is
+generated once for each model and mask, with the same output (see
+compile_serializer()).
+
+Listings can be sent as streams of records, for clients that want to
+process the records as they arrive instead of parsing a JSON array
+first:
+
+- NDJSON (application/x-ndjson): one JSON object per line.
+- MessagePack (application/msgpack): one map after the other, as read
+  by msgpack.Unpacker. Only available if the msgpack package is
+  installed.
+
+Records have the same fields and values as flask_restplus.marshal()
+would produce from the same model and mask.
+
+The time spent marshalling is observed in MARSHAL_SECONDS, once per
+call of marshal_fast() or per stream of records.
+"""
+from storage_api.utils import init_logger
+from storage_api.extensions import metrics
+
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict  # noqa
+
+from flask_restplus import fields, marshal
+from flask_restplus.mask import apply as apply_mask
+from flask_restplus.model import Model
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+log = init_logger()
+
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+MARSHAL_SECONDS = metrics.histogram(
+    'sapi_marshal_duration_seconds',
+    "Time spent marshalling responses, by model",
+    ['model'])
+
+
+def _rfc822_formatter(field):
+    """
+    Return a function formatting values like field.format(), with the
+    RFC 822 dates of datetimes cached, as the same creation times come up
+    in every listing.
+    """
+    @lru_cache(maxsize=8192)
+    def format_datetime(dt):
+        return field.format_rfc822(dt)
+
+    def format_rfc822(value):
+        if type(value) is datetime:
+            return format_datetime(value)
+        return field.format(value)
+    return format_rfc822
+
+
+def _field_source(i, field, env):
+    """
+    Return the source of an expression formatting the value v of the
+    i:th field like field.output() would, adding the names it refers to
+    to env, or None if there is no faster equivalent.
+    """
+    if field.mask is not None or callable(field.default):
+        return None
+
+    default = field.default
+    if type(field) is fields.List:
+        container = field.container
+        if (container.attribute is not None or container.default is not None
+                or container.mask is not None):
+            return None
+        env['d{}'.format(i)] = default
+        # Anything but lists of plain strings or dictionaries is left to
+        # field.output()
+        if type(container) is fields.String:
+            return ("d{i} if v is None else list(v) if type(v) is list and"
+                    " all(type(x) is str for x in v) else o{i}(k{i}, item)"
+                    .format(i=i))
+        if type(container) is fields.Nested:
+            env['s{}'.format(i)] = record_serializer(container.nested)
+            return ("d{i} if v is None else [s{i}(x) for x in v]"
+                    " if type(v) is list and all(type(x) is dict for x in v)"
+                    " else o{i}(k{i}, item)".format(i=i))
+        return None
+
+    if type(field) is fields.String:
+        formatted = "v if type(v) is str else str(v)"
+    elif type(field) is fields.Integer:
+        formatted = "v if type(v) is int else int(v)"
+    elif type(field) is fields.Boolean:
+        formatted = "v if type(v) is bool else bool(v)"
+    elif type(field) is fields.DateTime and field.dt_format == 'rfc822':
+        env['f{}'.format(i)] = _rfc822_formatter(field)
+        formatted = "f{}(v)".format(i)
+    else:
+        return None
+
+    env['d{}'.format(i)] = field.format(default) if default else default
+    return "d{} if v is None else {}".format(i, formatted)
+
+
+def compile_serializer(fields_):
+    """
+    Generate a function marshalling one item with the (resolved, already
+    masked) fields_ like flask_restplus.marshal(item, fields_) does, with
+    the same output.
+
+    Values of dictionaries are looked up directly and formatted inline
+    for the usual field types. Anything else, including errors, is left
+    to flask-restplus, so that it behaves exactly the same.
+    """
+    env = {'OrderedDict': OrderedDict,
+           'marshal': marshal,
+           'fallback': lambda item: marshal(item, fields_)}
+    lines = ["def serialize(item):",
+             "    if type(item) is not dict:",
+             "        return fallback(item)",
+             "    get = item.get",
+             "    try:"]
+    for i, (name, field) in enumerate(fields_.items()):
+        env['k{}'.format(i)] = name
+        if isinstance(field, dict):
+            env['n{}'.format(i)] = field
+            lines.append("        r{i} = marshal(item, n{i})".format(i=i))
+            continue
+
+        if isinstance(field, type):
+            field = field()
+        env['o{}'.format(i)] = field.output
+        key = name if field.attribute is None else field.attribute
+        source = _field_source(i, field, env)
+        # Attributes of dictionaries (e.g. items) are what get_value()
+        # finds for missing keys, so those are left to field.output()
+        if (source is None or not isinstance(key, str) or "." in key
+                or hasattr(dict, key)):
+            lines.append("        r{i} = o{i}(k{i}, item)".format(i=i))
+        else:
+            env['g{}'.format(i)] = key
+            lines.append("        v = get(g{})".format(i))
+            lines.append("        r{} = {}".format(i, source))
+
+    lines.append("    except Exception:")
+    lines.append("        return fallback(item)")
+    lines.append("    return OrderedDict([{}])".format(
+        ", ".join("(k{i}, r{i})".format(i=i) for i in range(len(fields_)))))
+
+    exec("\n".join(lines), env)
+    return env['serialize']
+
+
+# id(model) -> (model, mask field names) -> serializer, for the models of
+# the API, which are never garbage-collected
+_serializers = {}  # type: Dict[int, tuple]
+
+
+def record_serializer(model, mask=None):
+    """
+    Return a function marshalling one item with model and mask, with the
+    same result as marshal(item, model, mask=mask), but compiled once per
+    model and mask (see compile_serializer()).
+    """
+    mask = mask or getattr(model, '__mask__', None)
+    resolved = getattr(model, 'resolved', model)
+    fields_ = apply_mask(resolved, mask, skip=True) if mask else resolved
+
+    # Masks of nested fields clone them, making a new serializer every time
+    cacheable = (isinstance(model, Model)
+                 and all(resolved.get(name) is field
+                         for name, field in fields_.items()))
+    if not cacheable:
+        return compile_serializer(fields_)
+
+    _, serializers = _serializers.setdefault(id(model), (model, {}))
+    key = tuple(fields_)
+    serializer = serializers.get(key)
+    if serializer is None:
+        serializer = serializers.setdefault(key, compile_serializer(fields_))
+    return serializer
+
+
+def model_name(model):
+    return getattr(model, 'name', None) or type(model).__name__
+
+
+def marshal_fast(data, model, mask=None):
+    """
+    Like flask_restplus.marshal(data, model, mask=mask), using a
+    compiled serializer (see record_serializer()).
+    """
+    with MARSHAL_SECONDS.time(model_name(model)):
+        serialize = record_serializer(model, mask)
+        if isinstance(data, (list, tuple)):
+            return [serialize(item) for item in data]
+        return serialize(data)
+
+
+def marshalled_records(items, model, mask=None):
+    """
+    A generator of items marshalled with model and mask (see
+    record_serializer()), one at a time, observing the time spent
+    marshalling all of them once the generator is done.
+    """
+    serialize = record_serializer(model, mask)
+    clock = time.perf_counter
+    spent_s = 0.0
+    try:
+        for item in items:
+            start = clock()
+            record = serialize(item)
+            spent_s += clock() - start
+            yield record
+    finally:
+        MARSHAL_SECONDS.observe(spent_s, model_name(model))
+
+
+def _chunked(records, encode, chunk_size, join):
+    chunk = []
+    for record in records:
+        chunk.append(encode(record))
+        if len(chunk) >= chunk_size:
+            yield join(chunk)
+            chunk = []
+    if chunk:
+        yield join(chunk)
+
+
+def stream_ndjson(records, chunk_size):
+    """
+    A generator of the NDJSON representation of (marshalled) records,
+    chunk_size records at a time.
+    """
+    return _chunked(records, lambda record: json.dumps(record) + "\n",
+                    chunk_size, "".join)
+
+
+def stream_msgpack(records, chunk_size):
+    """
+    A generator of the MessagePack representation of (marshalled)
+    records, chunk_size records at a time.
+    """
+    packer = msgpack.Packer(use_bin_type=True)
+    return _chunked(records, packer.pack, chunk_size, b"".join)
+
+
+def available_streamers():
+    """
+    Return a dictionary of the usable record mimetypes -> streaming
+    functions.
+    """
+    streamers = {NDJSON_MIMETYPE: stream_ndjson}
+    if msgpack is not None:
+        streamers[MSGPACK_MIMETYPE] = stream_msgpack
+    return streamers
+
+
+STREAMERS = available_streamers()
@@ -26,6 +26,26 @@ class Subsystems(Resource):
         return list(current_app.config['SUBSYSTEM'].keys())
 
 
+@api.route('/subsystems/<string:subsystem>/connections')
+@api.param('subsystem', "The subsystem to inspect")
+class SubsystemConnections(Resource):
+
+    @api.doc(description=("Get statistics about the connections of a"
+                          " subsystem to its storage system"))
+    @api.response(404, description=("No such subsystem, or it does not"
+                                    " connect to anything"))
+    def get(self, subsystem):
+        with exception_is_errorcode(api=api,
+                                    exception=KeyError,
+                                    error_code=404):
+            instance_id = current_app.config['SUBSYSTEM'][subsystem]
+        stats = current_app.extensions[instance_id].connection_stats()
+        if stats is None:
+            api.abort(404, "Subsystem {} has no connections"
+                      .format(subsystem))
+        return stats
+
+
 @api.route('/roles')
 class Roles(Resource):
 
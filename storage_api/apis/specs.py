@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+The Swagger specification, rendered once into bytes.
+
+flask-restplus keeps the specification as a dictionary and serialises it
+again for every request to /swagger.json. As it only changes with the
+code, it is rendered (and compressed) once per process instead, and
+served with strong ETags so that clients holding the current version
+get a 304.
+
+It can also be written out without running a server, see __main__.py.
+"""
+from storage_api.utils import init_logger
+
+import gzip
+import hashlib
+import io
+import json
+import threading
+from collections import namedtuple
+
+import flask
+from flask import request
+import flask_restplus
+from flask_restplus import Resource
+from werkzeug.http import quote_etag
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+log = init_logger()
+
+# Preferred first, when the client accepts several equally
+ENCODINGS = ['br', 'gzip', 'identity']
+DEFAULT_MAX_AGE_S = 86400
+
+RenderedSpec = namedtuple('RenderedSpec', 'etag, variants')
+
+
+def _gzip(data):
+    # A fixed mtime, so that the same specification always compresses to
+    # the same bytes, in every process
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                       mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def render_spec(schema):
+    """
+    Render a Swagger specification (a dictionary) into a RenderedSpec,
+    whose variants map encodings to bytes.
+    """
+    data = json.dumps(schema, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
+    variants = {'identity': data, 'gzip': _gzip(data)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    etag = hashlib.sha1(data).hexdigest()
+    return RenderedSpec(etag=etag, variants=variants)
+
+
+class Api(flask_restplus.Api):
+    """
+    A flask_restplus.Api serving its specification from a RenderedSpec.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._rendered_spec = None
+        self._render_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def rendered_spec(self):
+        """
+        Return the RenderedSpec of this API, rendering it on first use.
+        Must be called in a request context.
+        """
+        if self._rendered_spec is None:
+            with self._render_lock:
+                if self._rendered_spec is None:
+                    self._rendered_spec = render_spec(self.__schema__)
+                    log.info("Rendered the Swagger specification ({} bytes)"
+                             .format(len(self._rendered_spec
+                                         .variants['identity'])))
+        return self._rendered_spec
+
+    def _register_specs(self, app_or_blueprint):
+        if self._add_specs:
+            endpoint = str('specs')
+            self._register_view(
+                app_or_blueprint,
+                RenderedSpecView,
+                '/swagger.json',
+                endpoint=endpoint,
+                resource_class_args=(self, )
+            )
+            self.endpoints.add(endpoint)
+
+
+class RenderedSpecView(Resource):
+    """
+    Serve the rendered specification in the best encoding the client
+    accepts.
+    """
+
+    def get(self):
+        spec = self.api.rendered_spec()
+        encoding = request.accept_encodings.best_match(
+            [e for e in ENCODINGS if e in spec.variants],
+            default='identity')
+        data = spec.variants[encoding]
+        # Each encoding is a different representation, with its own
+        # strong ETag
+        etag = (spec.etag if encoding == 'identity'
+                else "{}-{}".format(spec.etag, encoding))
+
+        response = flask.Response(data, mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.headers['ETag'] = quote_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.cache_control.public = True
+        response.cache_control.max_age = int(
+            flask.current_app.config.get('SPEC_MAX_AGE_S',
+                                         DEFAULT_MAX_AGE_S))
+        return response.make_conditional(request)
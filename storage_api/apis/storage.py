@@ -9,19 +9,42 @@
 # or submit itself to any jurisdiction.
 
 import storage_api.apis
-from storage_api.apis.common.auth import in_role
+from storage_api.apis.common.auth import in_role, is_in_role
 from storage_api.apis.common import ADMIN_ROLE, UBER_ADMIN_ROLE, USER_ROLE
-from storage_api.utils import dict_without, filter_none
+from storage_api.apis.common.serializers import (JSON_MIMETYPE, STREAMERS,
+                                                 marshal_fast,
+                                                 marshalled_records)
+from storage_api.utils import dict_without, filter_none, merge_two_dicts
+from storage_api.extensions.changefeed import (ChangeFeed, format_token,
+                                               parse_token)
+from storage_api.extensions.metrics import timed_backend
+from storage_api.extensions.zapi import traced
 
 from storage_api.utils import init_logger
+import base64
+import hashlib
+import heapq
+import inspect
+import ipaddress
+import itertools
+import json
+import threading
+import time
 import traceback
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from functools import partial
+from functools import partial, wraps
+from operator import itemgetter
+from typing import Dict  # noqa
+from urllib.parse import urlencode
 import re
 
-from flask_restplus import Namespace, Resource, fields, marshal
-from flask import current_app
+from flask_restplus import Namespace, Resource, fields, inputs, marshal
+from flask_restplus.mask import Mask
+from flask import current_app, request, Response, stream_with_context
 from netapp.api import APIError
+from werkzeug.http import is_resource_modified, quote_etag
 
 api = Namespace('sapi',
                 description='Storage operations')
@@ -67,6 +90,8 @@ def backend(backend_name):
     Return the actual backend object as given by backend_name. Has
     to be a function due to the app context not being available
     until later.
+
+    The back-end is wrapped in a TimedBackend, timing its methods.
     """
     with exception_is_errorcode(api, KeyError, 404,
                                 message=("No such subsystem. "
@@ -74,7 +99,34 @@ def backend(backend_name):
                                 .format(", ".join(
                                     current_app.config['SUBSYSTEM'].keys()))):
         instance_id = current_app.config['SUBSYSTEM'][backend_name]
-        return current_app.extensions[instance_id]
+        return timed_backend(backend_name,
+                             current_app.extensions[instance_id])
+
+
+_executors = {}  # type: Dict[str, ThreadPoolExecutor]
+_executors_lock = threading.Lock()
+
+
+def shared_executor(name, max_workers):
+    """
+    Return the worker pool called name shared by all requests of this
+    process, creating it with max_workers threads on first use, as uwsgi
+    forks its workers after loading the app.
+    """
+    with _executors_lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(max_workers=max_workers)
+        return _executors[name]
+
+
+def subsystem_backends():
+    """
+    Return a list of (name, back-end) tuples of all configured
+    subsystems, in name order.
+    """
+    return [(name, timed_backend(name, current_app.extensions[instance_id]))
+            for name, instance_id
+            in sorted(current_app.config['SUBSYSTEM'].items())]
 
 
 policy_rule_list_field = fields.List(fields.String(
@@ -124,6 +176,26 @@ volume_read_model = api.inherit('VolumeRead', volume_create_model, {
     })
 
 
+volume_patch_report_model = api.model('VolumePatchReport', {
+    'applied': fields.List(fields.String(),
+                           description="The fields that were updated"),
+    'unchanged': fields.List(fields.String(),
+                             description=("The fields that already had"
+                                          " the requested value")),
+    'failed': fields.Raw(description=("The fields that could not be"
+                                      " updated, and why"),
+                         example={'size_total': "Not enough space"}),
+})
+
+
+def patch_status(report):
+    """
+    The status code of a patch_volume() report: 500 if any field failed
+    to update.
+    """
+    return 500 if report['failed'] else 200
+
+
 lock_model = api.model('Lock', {
     'host': fields.String(min_length=1, required=True,
                           example="dbthing.cern.ch")
@@ -167,6 +239,328 @@ policy_rule_write_model = api.model('PolicyRule',
                                     {'rules': policy_rule_list_field})
 
 
+listing_parser = api.parser()
+listing_parser.add_argument(
+    'fields', location='args',
+    help=("Comma-separated list of the fields to return,"
+          " e.g. name,size_used. Defaults to all fields"))
+listing_parser.add_argument(
+    'limit', type=inputs.positive, location='args',
+    help=("Return at most this many entries, ordered by name. If there"
+          " are more, the cursor to the next page is returned in the"
+          " X-Next-Cursor header, and its URL in the Link header"))
+listing_parser.add_argument(
+    'cursor', location='args',
+    help=("Return the page following the one that returned this"
+          " cursor. Requires limit"))
+listing_parser.add_argument(
+    'stream', type=inputs.boolean, location='args', default=False,
+    help=("If true, stream the entries as they are produced by the"
+          " back-end instead of collecting them first"))
+
+VOLUME_FILTER_ARGS = ['aggregate_name', 'state', 'filer_address',
+                      'name_prefix']
+
+volume_list_parser = listing_parser.copy()
+volume_list_parser.add_argument(
+    'aggregate_name', location='args',
+    help="Only list volumes in this aggregate")
+volume_list_parser.add_argument(
+    'state', location='args',
+    help="Only list volumes in this state, e.g. online")
+volume_list_parser.add_argument(
+    'filer_address', location='args',
+    help="Only list volumes served by this filer")
+volume_list_parser.add_argument(
+    'name_prefix', location='args',
+    help="Only list volumes whose name starts with this prefix")
+
+all_volumes_parser = volume_list_parser.copy()
+all_volumes_parser.add_argument(
+    'since', location='args',
+    help=("Only return what changed since the change token returned"
+          " by a previous request with since, or since=0 to get"
+          " everything and a first token, as a VolumeChanges object."
+          " The other arguments do not apply"))
+
+volume_changes_model = api.model('VolumeChanges', {
+    'token': fields.String(
+        description="The change token to pass as since next time"),
+    'complete': fields.Boolean(
+        description=("If true, changed holds all volumes and the"
+                     " client should forget about the others, e.g."
+                     " because the changes since the token are no"
+                     " longer known")),
+    'changed': fields.List(fields.Nested(volume_read_model),
+                           description="The volumes created or updated"),
+    'deleted': fields.List(fields.String(),
+                           description="The names of deleted volumes"),
+    })
+
+export_list_parser = listing_parser.copy()
+export_list_parser.add_argument(
+    'granting', location='args',
+    help=("Only list policies with a rule granting access to this IP"
+          " address, or to all of this network in CIDR notation"
+          " (e.g. 10.0.0.0/24)"))
+
+# The number of entries to send at a time when streaming
+STREAM_CHUNK_SIZE = 32
+
+
+def projection_mask(model):
+    """
+    Return a fields mask for model from the comma-separated field names
+    in the request argument `fields`, or None if none was given.
+
+    Aborts with a 400 if any of the names is not a field of model.
+    """
+    requested = request.args.get('fields', None)
+    if not requested:
+        return None
+
+    field_names = [f.strip() for f in requested.split(",") if f.strip()]
+    unknown = [f for f in field_names if f not in model.resolved]
+    if unknown:
+        api.abort(400, "Unknown field(s): {}. Allowed values are: {}"
+                  .format(", ".join(unknown),
+                          ", ".join(model.resolved.keys())))
+
+    return Mask(",".join(field_names), skip=True)
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except ValueError:
+        api.abort(400, "Invalid cursor: {}".format(cursor))
+
+
+def paginate(items, limit, after=None, key=itemgetter('name')):
+    """
+    Return the first limit entries of items with a key greater than
+    after, in key order, and the key to continue from (None if there
+    were no more entries).
+
+    Only holds limit + 1 entries in memory at a time.
+    """
+    if after is not None:
+        items = (item for item in items if key(item) > after)
+
+    page = heapq.nsmallest(limit + 1, items, key=key)
+    if len(page) > limit:
+        return page[:limit], key(page[limit - 1])
+    else:
+        return page, None
+
+
+def primed(items):
+    """
+    Start iterating over items, so that any errors in producing the
+    first entry (e.g. a KeyError for a missing volume) are raised
+    before we start responding.
+    """
+    items = iter(items)
+    try:
+        first = next(items)
+    except StopIteration:
+        return iter([])
+    return itertools.chain([first], items)
+
+
+def stream_json_list(items, model, mask=None):
+    """
+    A generator of the JSON representation of a list of items
+    marshalled with model, produced a few entries at a time.
+    """
+    separator = "["
+    chunk = []
+    for record in marshalled_records(items, model, mask):
+        chunk.append(separator)
+        chunk.append(json.dumps(record))
+        separator = ","
+        if len(chunk) >= 2 * STREAM_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+
+    chunk.append("[]\n" if separator == "[" else "]\n")
+    yield "".join(chunk)
+
+
+def listing_mimetype():
+    """
+    Return the mimetype a listing should be sent as: the one the client
+    prefers out of JSON and the record formats of STREAMERS, JSON if
+    undecided.
+    """
+    return request.accept_mimetypes.best_match(
+        [JSON_MIMETYPE] + sorted(STREAMERS), default=JSON_MIMETYPE)
+
+
+def json_body(data):
+    """
+    Serialise data as a JSON response body, the way flask-restplus
+    would (see flask_restplus.representations.output_json()).
+    """
+    settings = dict(current_app.config.get('RESTPLUS_JSON', {}))
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+    return json.dumps(data, **settings) + "\n"
+
+
+def _normalised(value):
+    """
+    The JSON encoder's fallback for payload_etag(): dates and times are
+    hashed as the ISO 8601 strings they are marshalled to.
+    """
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError("Cannot compute the ETag of {!r}".format(value))
+
+
+def payload_etag(payload, mask=None):
+    """
+    Return a strong ETag for the (un-marshalled) payload as it would be
+    marshalled with mask, without marshalling it.
+    """
+    normalised = json.dumps([mask or '', payload], sort_keys=True,
+                            check_circular=False, default=_normalised)
+    return hashlib.sha1(normalised.encode('utf-8')).hexdigest()
+
+
+def conditional_response(payload, model, mask=None, headers=None):
+    """
+    Marshal payload with model and send it with a strong ETag, or
+    respond with a 304 Not Modified if the client already has it
+    according to its If-None-Match header.
+
+    The ETag is computed from the payload itself, so that payload is
+    only marshalled and serialised when it is actually sent.
+    """
+    etag = payload_etag(payload, mask)
+    headers = dict(headers or {})
+    headers['ETag'] = quote_etag(etag)
+
+    if not is_resource_modified(request.environ, etag=etag):
+        return Response(status=304, headers=headers)
+
+    return Response(json_body(marshal_fast(payload, model, mask=mask)),
+                    mimetype='application/json', headers=headers)
+
+
+def marshal_with(model, as_list=False, description=None):
+    """
+    Like api.marshal_with(model, as_list=as_list), but marshalling with
+    marshal_fast().
+    """
+    def decorator(func):
+        @api.doc(responses={200: (description,
+                                  [model] if as_list else model)},
+                 __mask__=True)
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            mask = request.headers.get(
+                current_app.config['RESTPLUS_MASK_HEADER'])
+            return marshal_fast(func(*args, **kwargs), model, mask)
+        return wrapper
+    return decorator
+
+
+def marshal_conditionally_with(model, description=None):
+    """
+    Like api.marshal_with(model), but with an ETag and support for
+    conditional requests (see conditional_response()).
+    """
+    def decorator(func):
+        @api.doc(responses={200: (description, model),
+                            304: "Not modified since the given ETag"},
+                 __mask__=True)
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            mask = request.headers.get(
+                current_app.config['RESTPLUS_MASK_HEADER'])
+            return conditional_response(func(*args, **kwargs), model, mask)
+        return wrapper
+    return decorator
+
+
+def marshal_list_with(model, description=None):
+    """
+    Like api.marshal_with(model, as_list=True), for methods returning an
+    iterable of entries. Also handles the arguments of listing_parser:
+
+    - fields: only marshal the given fields, skipping the others
+      entirely. Falls back on the usual fields mask header.
+    - limit/cursor: return one page of entries, ordered by name.
+    - stream: send the entries as they come in from the back-end, so
+      that the whole list never has to be held in memory.
+
+    Clients accepting NDJSON or MessagePack rather than JSON get the
+    entries in that format (see serializers), always streamed.
+
+    Unless streaming, responses carry an ETag and support conditional
+    requests (see conditional_response()).
+
+    KeyErrors and ValueErrors are turned into 404 and 400 respectively.
+    Responses returned by the method are sent as they are.
+    """
+    def decorator(func):
+        @api.doc(responses={200: (description, [model])}, __mask__=True)
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            listing = listing_parser.parse_args()
+            mask = (projection_mask(model)
+                    or request.headers.get(
+                        current_app.config['RESTPLUS_MASK_HEADER']))
+
+            if listing['cursor'] and not listing['limit']:
+                api.abort(400, "A cursor requires a limit")
+
+            with keyerror_is_404(), valueerror_is_400():
+                items = func(*args, **kwargs)
+                if isinstance(items, Response):
+                    return items
+                items = primed(items)
+
+            headers = {}
+            if listing['limit']:
+                after = (decode_cursor(listing['cursor'])
+                         if listing['cursor'] else None)
+                items, next_key = paginate(items, listing['limit'], after)
+                if next_key is not None:
+                    cursor = encode_cursor(next_key)
+                    next_args = request.args.to_dict()
+                    next_args['cursor'] = cursor
+                    headers['X-Next-Cursor'] = cursor
+                    headers['Link'] = '<{}?{}>; rel="next"'.format(
+                        request.base_url, urlencode(next_args))
+
+            headers['Vary'] = 'Accept'
+            mimetype = listing_mimetype()
+            if mimetype != JSON_MIMETYPE:
+                return Response(stream_with_context(
+                    STREAMERS[mimetype](
+                        marshalled_records(items, model, mask),
+                        STREAM_CHUNK_SIZE)),
+                                mimetype=mimetype,
+                                headers=headers)
+
+            if listing['stream']:
+                return Response(stream_with_context(
+                    stream_json_list(items, model, mask)),
+                                mimetype='application/json',
+                                headers=headers)
+
+            return conditional_response(list(items), model, mask,
+                                        headers=headers)
+        return wrapper
+    return decorator
+
+
 @api.errorhandler(APIError)
 def handle_netapp_exception(error):
     '''Return the error message from the filer and 500 status code'''
@@ -186,12 +580,19 @@ def default_error_handler(error):    # pragma: no cover
 @api.route('/<string:subsystem>/volumes')
 @api.param('subsystem', SUBSYSTEM_DESCRIPTION)
 class AllVolumes(Resource):
-    @api.doc(description="Get a list of all volumes",
+    @api.doc(description=("Get a list of all volumes, optionally filtered"
+                          " and with only some of their fields"),
              id='get_volumes')
-    @api.marshal_with(volume_read_model, as_list=True)
+    @api.expect(all_volumes_parser)
+    @marshal_list_with(volume_read_model)
     @in_role(api, USER_ROLE)
     def get(self, subsystem):
-        return backend(subsystem).volumes
+        args = all_volumes_parser.parse_args()
+        if args['since'] is not None:
+            return volume_changes_response(subsystem, args['since'])
+
+        filters = filter_none({k: args[k] for k in VOLUME_FILTER_ARGS})
+        return backend(subsystem).iter_volumes(**filters)
 
 
 @in_role(api, USER_ROLE)
@@ -200,8 +601,8 @@ class AllVolumes(Resource):
 @api.param('volume_name', VOLUME_NAME_DESCRIPTION)
 class Volume(Resource):
 
-    @api.marshal_with(volume_read_model,
-                      description="The volume named volume_name")
+    @marshal_conditionally_with(volume_read_model,
+                                description="The volume named volume_name")
     @api.doc(description="Get a specific volume by name")
     @api.response(404, description="No such volume exists")
     @api.response(201, description="A new volume was created")
@@ -269,7 +670,13 @@ class Volume(Resource):
             backend(subsystem).restrict_volume(volume_name)
         return '', 204
 
-    @api.doc(description="Partially update volume_name")
+    @api.doc(description=("Partially update volume_name. Settings that"
+                          " fail to apply do not prevent the others from"
+                          " being applied."),
+             responses={200: ("All fields were updated",
+                              volume_patch_report_model),
+                        500: ("Some fields could not be updated",
+                              volume_patch_report_model)})
     @api.expect(volume_write_model, validate=True)
     @in_role(api, UBER_ADMIN_ROLE)
     def patch(self, subsystem, volume_name):
@@ -281,22 +688,25 @@ class Volume(Resource):
         log.info("PATCH with payload {}".format(str(data)))
         if data:
             with keyerror_is_404():
-                backend(subsystem).patch_volume(volume_name, **data)
+                report = backend(subsystem).patch_volume(volume_name, **data)
         else:
             raise api.abort(400, "No PATCH data provided!")
 
+        return marshal(report, volume_patch_report_model), patch_status(report)
+
 
 @api.route('/<string:subsystem>/volumes/<path:volume_name>/snapshots')
 @api.param('subsystem', SUBSYSTEM_DESCRIPTION)
 @api.param('volume_name', VOLUME_NAME_DESCRIPTION)
 class AllSnapshots(Resource):
-    @api.marshal_with(snapshot_model,
-                      description="All snapshots for the volume",
-                      as_list=True)
+    @api.expect(listing_parser)
+    @marshal_list_with(snapshot_model,
+                       description="All snapshots for the volume")
+    @api.response(404, description="No such volume exists")
     def get(self, subsystem, volume_name):
         if DISALLOWED_VOLUME_NAME_RE.match(volume_name):
             api.abort(400, "Invalid volume name")
-        return backend(subsystem).get_snapshots(volume_name)
+        return backend(subsystem).iter_snapshots(volume_name)
 
 
 @api.route(('/<string:subsystem>/volumes/'
@@ -307,7 +717,7 @@ class AllSnapshots(Resource):
 class Snapshots(Resource):
 
     @api.doc(description="Get the current information for a given snapshot")
-    @api.marshal_with(snapshot_model)
+    @marshal_conditionally_with(snapshot_model)
     def get(self, subsystem, volume_name, snapshot_name):
         if DISALLOWED_VOLUME_NAME_RE.match(volume_name):
             api.abort(400, "Invalid volume name")
@@ -350,10 +760,10 @@ class Snapshots(Resource):
 @api.param('volume_name', VOLUME_NAME_DESCRIPTION)
 @api.doc(description="Get the host locking the volume, if any")
 class AllLocks(Resource):
-    @api.marshal_with(lock_model, as_list=True,
-                      description=("An empty list (if no locks were"
-                                   " held) or a single dict describing the"
-                                   " host holding the lock"))
+    @marshal_with(lock_model, as_list=True,
+                  description=("An empty list (if no locks were"
+                               " held) or a single dict describing the"
+                               " host holding the lock"))
     @in_role(api, USER_ROLE)
     def get(self, subsystem, volume_name):
         if DISALLOWED_VOLUME_NAME_RE.match(volume_name):
@@ -393,13 +803,19 @@ class Locks(Resource):
 @api.route('/<string:subsystem>/export')
 @api.param('subsystem', SUBSYSTEM_DESCRIPTION)
 class AllExports(Resource):
-    @api.marshal_with(export_policy_model,
-                      description="The full policy",
-                      as_list=True)
-    @api.doc(description="Get all ACLs present on the back-end")
+    @api.expect(export_list_parser)
+    @marshal_list_with(export_policy_model,
+                       description="The full policy")
+    @api.doc(description=("Get all ACLs present on the back-end,"
+                          " optionally only those granting access to"
+                          " an address or network"))
     @in_role(api, ADMIN_ROLE)
     def get(self, subsystem):
-        return backend(subsystem).policies
+        granting = export_list_parser.parse_args()['granting']
+        if granting:
+            return backend(subsystem).policies_granting(
+                ipaddress.ip_network(granting, strict=False))
+        return backend(subsystem).iter_policies()
 
 
 @api.route('/<string:subsystem>/export/<path:policy>')
@@ -407,8 +823,9 @@ class AllExports(Resource):
 @api.param('policy', "The policy to operate on")
 class Export(Resource):
 
-    @api.marshal_with(export_policy_model,
-                      description="Get the rules of a specific policy")
+    @marshal_conditionally_with(
+        export_policy_model,
+        description="Get the rules of a specific policy")
     @api.doc(description="Display the rules of a given policy")
     @in_role(api, ADMIN_ROLE)
     def get(self, subsystem, policy):
@@ -462,3 +879,506 @@ class ExportRule(Resource):
     def delete(self, subsystem, policy, rule):
         backend(subsystem).ensure_policy_rule_absent(policy, rule)
         return '', 204
+
+
+@api.route('/<string:subsystem>/access/<path:address>')
+@api.param('subsystem', SUBSYSTEM_DESCRIPTION)
+@api.param('address', ("An IP address, or a network in CIDR notation"
+                       " (e.g. 10.0.0.0/24)"))
+class Access(Resource):
+    @api.doc(description=("Get the volumes whose export policy grants"
+                          " access to the given address, or to all of"
+                          " the given network"))
+    @api.expect(listing_parser)
+    @marshal_list_with(volume_read_model)
+    @in_role(api, ADMIN_ROLE)
+    def get(self, subsystem, address):
+        return backend(subsystem).volumes_accessible_from(
+            ipaddress.ip_network(address, strict=False))
+
+
+BatchOperation = namedtuple('BatchOperation',
+                            'role, status, model, fields_model')
+BatchOperation.__new__.__defaults__ = (None,)
+
+# The back-end methods available to batches, with the role required to
+# run them, the status code they return on success, the model of their
+# return value if it is returned at all, and the model of their
+# keyword arguments for methods taking arbitrary ones.
+BATCH_OPERATIONS = {
+    'get_volume': BatchOperation(USER_ROLE, 200, volume_read_model),
+    'create_volume': BatchOperation(ADMIN_ROLE, 201, volume_read_model,
+                                    volume_create_model),
+    'clone_volume': BatchOperation(ADMIN_ROLE, 201, volume_read_model),
+    'rollback_volume': BatchOperation(ADMIN_ROLE, 201, None),
+    'patch_volume': BatchOperation(UBER_ADMIN_ROLE, 200,
+                                   volume_patch_report_model,
+                                   volume_write_model),
+    'restrict_volume': BatchOperation(UBER_ADMIN_ROLE, 204, None),
+    'get_snapshots': BatchOperation(USER_ROLE, 200, snapshot_model),
+    'get_snapshot': BatchOperation(USER_ROLE, 200, snapshot_model),
+    'create_snapshot': BatchOperation(ADMIN_ROLE, 201, None),
+    'delete_snapshot': BatchOperation(ADMIN_ROLE, 204, None),
+    'create_lock': BatchOperation(ADMIN_ROLE, 201, None),
+    'remove_lock': BatchOperation(UBER_ADMIN_ROLE, 204, None),
+    'get_policy': BatchOperation(ADMIN_ROLE, 200, None),
+    'set_policy': BatchOperation(ADMIN_ROLE, 200, None),
+    'create_policy': BatchOperation(ADMIN_ROLE, 201, None),
+    'remove_policy': BatchOperation(ADMIN_ROLE, 204, None),
+    'ensure_policy_rule_present': BatchOperation(ADMIN_ROLE, 201, None),
+    'ensure_policy_rule_absent': BatchOperation(ADMIN_ROLE, 204, None),
+}
+
+BATCH_VOLUME_NAME_ARGUMENTS = ['volume_name', 'clone_volume_name',
+                               'from_volume_name']
+
+batch_operation_model = api.model('BatchOperation', {
+    'operation': fields.String(
+        required=True, example="create_snapshot",
+        description=("The back-end method to call, one of {}"
+                     .format(", ".join(sorted(BATCH_OPERATIONS))))),
+    'arguments': fields.Raw(
+        description="The keyword arguments of the back-end method",
+        example={'volume_name': "volume_name",
+                 'snapshot_name': "snapshot_name"}),
+})
+
+batch_model = api.model('Batch', {
+    'operations': fields.List(fields.Nested(batch_operation_model),
+                              required=True),
+    'ordered': fields.Boolean(
+        default=False,
+        description=("If true, run the operations one at a time in the"
+                     " given order, and skip the rest as soon as one"
+                     " fails. Otherwise, run them concurrently")),
+})
+
+batch_result_model = api.model('BatchResult', {
+    'operation': fields.String(),
+    'status': fields.Integer(
+        description="The status code of the equivalent HTTP call"),
+    'message': fields.String(description="What went wrong, if anything"),
+    'result': fields.Raw(description="The return value, if any"),
+})
+
+
+def batch_result(operation, status, message=None, result=None):
+    return {'operation': operation, 'status': status,
+            'message': message, 'result': result}
+
+
+def prepare_batch_operation(storage, operation, arguments):
+    """
+    Check that the current user may run operation with arguments on
+    storage, in the request context.
+
+    Returns a function running the operation, or the result of the
+    operation if it has already failed.
+    """
+    spec = BATCH_OPERATIONS.get(operation)
+    if spec is None:
+        return batch_result(operation, 400, "No such operation. Allowed"
+                            " values are: {}"
+                            .format(", ".join(sorted(BATCH_OPERATIONS))))
+
+    if not is_in_role(spec.role):
+        return batch_result(operation, 403, ("The current user is not in"
+                                             " role {}".format(spec.role)))
+
+    if not isinstance(arguments, dict):
+        return batch_result(operation, 400, "Arguments must be an object")
+
+    for argument in BATCH_VOLUME_NAME_ARGUMENTS:
+        if DISALLOWED_VOLUME_NAME_RE.match(str(arguments.get(argument, ""))):
+            return batch_result(operation, 400, "Invalid volume name")
+
+    method = getattr(storage, operation)
+    try:
+        inspect.signature(method).bind(**arguments)
+    except TypeError as e:
+        return batch_result(operation, 400, str(e))
+
+    if spec.fields_model is not None:
+        fields = dict_without(arguments, 'volume_name')
+        unknown = sorted(set(fields) - set(spec.fields_model.resolved))
+        if unknown:
+            return batch_result(operation, 400, "Unknown field(s): {}"
+                                .format(", ".join(unknown)))
+        arguments = merge_two_dicts(
+            filter_none(marshal(fields, spec.fields_model)),
+            {'volume_name': arguments['volume_name']})
+
+    def run():
+        try:
+            result = method(**arguments)
+        except KeyError as e:
+            return batch_result(operation, 404, str(e))
+        except ValueError as e:
+            return batch_result(operation, 400, str(e))
+        except APIError as e:
+            return batch_result(operation, 500, e.msg)
+        except Exception as e:
+            log.warning("Batch operation {} failed: {}"
+                        .format(operation, traceback.format_exc()))
+            return batch_result(operation, 500, str(e))
+
+        status = spec.status
+        if operation == 'patch_volume':
+            status = patch_status(result)
+
+        if spec.model is not None:
+            result = marshal(result, spec.model)
+        elif spec.status != 200:
+            result = None
+        return batch_result(operation, status, result=result)
+
+    return run
+
+
+@api.route('/<string:subsystem>/batch')
+@api.param('subsystem', SUBSYSTEM_DESCRIPTION)
+class Batch(Resource):
+
+    @api.doc(description=("Run a list of back-end operations in one go."
+                          " Each operation is checked against the role"
+                          " its equivalent HTTP call requires, and gets"
+                          " its own status code in the results, which"
+                          " are in the order of the operations."))
+    @api.expect(batch_model, validate=True)
+    @api.marshal_with(batch_result_model, as_list=True,
+                      description="The results of the operations")
+    @api.response(400, description="Too many operations")
+    @in_role(api, USER_ROLE)
+    def post(self, subsystem):
+        data = storage_api.apis.api.payload
+        operations = data['operations']
+        max_operations = current_app.config.get('BATCH_MAX_OPERATIONS', 500)
+        if len(operations) > max_operations:
+            api.abort(400, "At most {} operations are allowed per batch"
+                      .format(max_operations))
+
+        storage = backend(subsystem)
+        prepared = [prepare_batch_operation(storage, op['operation'],
+                                            op.get('arguments') or {})
+                    for op in operations]
+
+        if data.get('ordered', False):
+            results = []
+            for i, run in enumerate(prepared):
+                result = run() if callable(run) else run
+                results.append(result)
+                if result['status'] >= 400:
+                    results.extend(
+                        batch_result(op['operation'], 424,
+                                     "Skipped, as operation {} failed"
+                                     .format(i))
+                        for op in operations[i + 1:])
+                    break
+            return results
+
+        executor = shared_executor(
+            'batch', current_app.config.get('BATCH_WORKERS', 8))
+        pending = [executor.submit(traced(run)) if callable(run) else run
+                   for run in prepared]
+        return [p.result() if isinstance(p, Future) else p
+                for p in pending]
+
+
+subsystem_volume_model = api.inherit('SubsystemVolume', volume_read_model, {
+    'subsystem': fields.String(description="The subsystem of the volume"),
+})
+
+fanout_error_model = api.model('SubsystemError', {
+    'subsystem': fields.String(),
+    'status': fields.Integer(
+        description=("The status code the subsystem would have"
+                     " responded with, 504 if it timed out")),
+    'message': fields.String(),
+})
+
+fanout_volumes_model = api.model('SubsystemVolumes', {
+    'volumes': fields.List(fields.Nested(subsystem_volume_model)),
+    'errors': fields.List(fields.Nested(fanout_error_model),
+                          description=("The subsystems that failed to"
+                                       " answer, if any")),
+})
+
+fanout_list_parser = volume_list_parser.copy()
+for argument in ['limit', 'cursor', 'stream']:
+    fanout_list_parser.remove_argument(argument)
+
+
+def fan_out(func):
+    """
+    Call func(back-end) for every configured subsystem in parallel, and
+    wait at most FANOUT_TIMEOUT_S seconds for all of them to answer.
+
+    Returns a tuple of a list of (subsystem, return value) tuples for
+    the subsystems that answered, and a list of errors for the ones
+    that failed or timed out. KeyErrors are taken to mean that the
+    subsystem has nothing to say, and are ignored.
+    """
+    timeout_s = current_app.config.get('FANOUT_TIMEOUT_S', 10)
+    executor = shared_executor(
+        'fanout', current_app.config.get('FANOUT_WORKERS', 16))
+
+    futures = [(name, executor.submit(traced(func), storage))
+               for name, storage in subsystem_backends()]
+    wait([f for _name, f in futures], timeout=timeout_s)
+
+    results = []
+    errors = []
+
+    def error(subsystem, status, message):
+        log.warning("Fan-out to {} failed with {}: {}"
+                    .format(subsystem, status, message))
+        errors.append({'subsystem': subsystem, 'status': status,
+                       'message': message})
+
+    for name, future in futures:
+        if not future.done():
+            future.cancel()
+            error(name, 504, "No answer within {}s".format(timeout_s))
+            continue
+
+        try:
+            results.append((name, future.result()))
+        except KeyError:
+            pass
+        except ValueError as e:
+            error(name, 400, str(e))
+        except APIError as e:
+            error(name, 500, e.msg)
+        except Exception as e:
+            error(name, 500, str(e))
+
+    return results, errors
+
+
+def fanout_response(results, errors):
+    mask = (projection_mask(subsystem_volume_model)
+            or request.headers.get(
+                current_app.config['RESTPLUS_MASK_HEADER']))
+    volumes = [merge_two_dicts(volume, {'subsystem': subsystem})
+               for subsystem, subsystem_volumes in results
+               for volume in subsystem_volumes]
+    return {'volumes': marshal_fast(volumes, subsystem_volume_model,
+                                    mask=mask),
+            'errors': marshal(errors, fanout_error_model)}
+
+
+@api.route('/_all/volumes')
+class AllSubsystemsVolumes(Resource):
+    @api.doc(description=("Get the volumes of all subsystems at once,"
+                          " optionally filtered and with only some of"
+                          " their fields. Subsystems that fail or time"
+                          " out are reported in errors."),
+             responses={200: ("The volumes of all subsystems",
+                              fanout_volumes_model)})
+    @api.expect(fanout_list_parser)
+    @in_role(api, USER_ROLE)
+    def get(self):
+        args = fanout_list_parser.parse_args()
+        filters = filter_none({k: args[k] for k in VOLUME_FILTER_ARGS})
+        results, errors = fan_out(
+            lambda storage: list(storage.iter_volumes(**filters)))
+
+        return fanout_response(results, errors)
+
+
+@api.route('/_all/volumes/<path:volume_name>')
+@api.param('volume_name', VOLUME_NAME_DESCRIPTION)
+class AllSubsystemsVolume(Resource):
+    @api.doc(description=("Look for a volume by name in all subsystems at"
+                          " once. Subsystems that fail or time out are"
+                          " reported in errors."),
+             responses={200: ("The volumes named volume_name",
+                              fanout_volumes_model)})
+    @api.response(404, description=("No such volume exists, and all"
+                                    " subsystems answered"))
+    @in_role(api, USER_ROLE)
+    def get(self, volume_name):
+        if DISALLOWED_VOLUME_NAME_RE.match(volume_name):
+            api.abort(400, "Invalid volume name")
+
+        results, errors = fan_out(
+            lambda storage: [storage.get_volume(volume_name)])
+        if not results and not errors:
+            api.abort(404, "No such volume in any subsystem: {}"
+                      .format(volume_name))
+
+        return fanout_response(results, errors)
+
+
+snapshot_change_model = api.inherit('VolumeSnapshot', snapshot_model, {
+    'volume_name': fields.String(),
+    })
+
+locks_change_model = api.model('VolumeLocks', {
+    'volume_name': fields.String(),
+    'hosts': fields.List(fields.String()),
+    })
+
+# The models of the items of each kind of change
+CHANGE_MODELS = {
+    'volume': volume_read_model,
+    'snapshot': snapshot_change_model,
+    'lock': locks_change_model,
+    'policy': export_policy_model,
+}
+
+_feeds = {}  # type: Dict[str, tuple]
+_feeds_lock = threading.Lock()
+
+
+def change_feed(subsystem):
+    """
+    Return the ChangeFeed of subsystem in this process, started on
+    first use. A new one is made if the back-end has been replaced.
+    """
+    storage = backend(subsystem)
+    with _feeds_lock:
+        feed_storage, feed = _feeds.get(subsystem, (None, None))
+        if feed_storage is not storage:
+            if feed is not None:
+                feed.stop()
+            feed = ChangeFeed(
+                scan=storage.scan_state,
+                interval_s=current_app.config['CHANGEFEED_INTERVAL_S'],
+                max_events=current_app.config['CHANGEFEED_MAX_EVENTS'],
+                name="change-feed-{}".format(subsystem),
+                idle_s=current_app.config['CHANGEFEED_IDLE_S'])
+            _feeds[subsystem] = (storage, feed)
+
+    feed.start()
+    return feed
+
+
+def parse_since(since):
+    """
+    Parse a change token from a request, where 0 means from the start.
+    """
+    with valueerror_is_400():
+        token = parse_token(since)
+    return token or None
+
+
+def volume_changes_response(subsystem, since):
+    token, changes, complete = change_feed(subsystem).since(
+        parse_since(since), kinds=['volume'])
+    payload = {'token': format_token(token),
+               'complete': complete,
+               'changed': [c.data for c in changes if c.data is not None],
+               'deleted': [c.key for c in changes if c.data is None]}
+    return Response(json.dumps(marshal_fast(payload, volume_changes_model)),
+                    mimetype='application/json')
+
+
+def format_event(event, data, event_id=None):
+    """
+    Format a server-sent event, with data as JSON.
+    """
+    lines = [] if event_id is None else ["id: {}".format(event_id)]
+    lines.append("event: {}".format(event))
+    lines.append("data: {}".format(json.dumps(data)))
+    return "\n".join(lines) + "\n\n"
+
+
+def event_stream(feed, token, kinds, keepalive_s, max_duration_s,
+                 retry_s=None):
+    """
+    A generator of the server-sent events of the changes to kinds found
+    by feed after token, for at most max_duration_s seconds, starting
+    by telling clients to reconnect after retry_s seconds if given.
+
+    Every batch of events ends with one carrying the change token as
+    its id, so that clients reconnecting with Last-Event-ID get
+    everything they missed. Without any changes, a sync event carries
+    it.
+    """
+    deadline = time.monotonic() + max_duration_s
+    if retry_s is not None:
+        yield "retry: {}\n\n".format(int(retry_s * 1000))
+    first = True
+    while True:
+        token, changes, complete = feed.since(token, kinds)
+        events = []
+        if complete:
+            events.append(('resync', {}))
+        events.extend(
+            (change.kind,
+             {'change': change.change,
+              'key': change.key,
+              'data': (None if change.data is None
+                       else marshal_fast(change.data,
+                                         CHANGE_MODELS[change.kind]))})
+            for change in changes)
+        if not events and first:
+            events.append(('sync', {}))
+
+        for i, (event, data) in enumerate(events, start=1):
+            yield format_event(event, data,
+                               event_id=(format_token(token)
+                                         if i == len(events) else None))
+        first = False
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if not feed.wait(token, min(keepalive_s, remaining)):
+            yield ": keep-alive\n\n"
+
+
+events_parser = api.parser()
+events_parser.add_argument(
+    'since', location='args',
+    help=("Start from the changes since this change token (the id of"
+          " an event), or since=0 for all items. Defaults to the"
+          " Last-Event-ID header, or to only new changes"))
+events_parser.add_argument(
+    'kinds', location='args',
+    help=("Comma-separated list of the kinds of changes to send, among"
+          " {}. Defaults to all of them".format(
+              ", ".join(sorted(CHANGE_MODELS)))))
+
+
+@api.route('/<string:subsystem>/events')
+@api.param('subsystem', SUBSYSTEM_DESCRIPTION)
+class Events(Resource):
+    @api.doc(description=(
+        "Stream the changes to the volumes, snapshots, locks and (for"
+        " admins) policies of the subsystem as server-sent events,"
+        " named after the kind of item that changed. Their data is the"
+        " change (created, updated or deleted), the key of the item and"
+        " the item itself. A resync event means that what follows is"
+        " everything, and that the client should forget the rest. The"
+        " stream is closed after a while, reconnect with Last-Event-ID"
+        " to resume where it left off."))
+    @api.expect(events_parser)
+    @api.response(200, description="A text/event-stream of changes")
+    @in_role(api, USER_ROLE)
+    def get(self, subsystem):
+        args = events_parser.parse_args()
+
+        allowed = set(CHANGE_MODELS)
+        if not is_in_role(ADMIN_ROLE):
+            allowed.discard('policy')
+        kinds = (set(args['kinds'].split(",")) if args['kinds']
+                 else allowed)
+        if not kinds <= allowed:
+            api.abort(400, "Unknown or forbidden kinds: {}. Allowed values"
+                      " are: {}".format(", ".join(sorted(kinds - allowed)),
+                                        ", ".join(sorted(allowed))))
+
+        feed = change_feed(subsystem)
+        since = args['since'] or request.headers.get('Last-Event-ID')
+        token = parse_since(since) if since else feed.token
+
+        return Response(stream_with_context(event_stream(
+            feed, token, kinds,
+            keepalive_s=current_app.config['EVENTS_KEEPALIVE_S'],
+            max_duration_s=current_app.config['EVENTS_MAX_DURATION_S'],
+            retry_s=current_app.config.get('EVENTS_RETRY_S'))),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
@@ -9,7 +9,7 @@
 
 from storage_api import conf
 from storage_api.apis import api
-from storage_api.apis.common import auth
+from storage_api.apis.common import auth, compression, monitoring
 import storage_api.extensions as extensions
 
 import os
@@ -22,12 +22,26 @@ app.secret_key = os.urandom(24)
 api.init_app(app)
 conf.load_basic_auth_conf(app)
 conf.load_oauth_conf(app)
+conf.load_batch_conf(app)
+conf.load_fanout_conf(app)
+conf.load_changefeed_conf(app)
+conf.load_spec_conf(app)
+conf.load_compression_conf(app)
+conf.load_metrics_conf(app)
 conf.load_backend_conf(app, backends_module=extensions)
 auth.setup_roles_from_env(app)
 auth.setup_basic_auth(app)
 auth.setup_oauth(app,
                  login_endpoint=auth.authorizations['sso']['authorizationUrl'],
                  logout_endpoint="/logout")
+compression.setup_compression(app)
+monitoring.setup_metrics(app)
+monitoring.setup_call_tracing(app)
+
+# Render the specification before the workers are forked, so that they
+# all share it
+with app.test_request_context():
+    api.rendered_spec()
 
 
 if __name__ == '__main__':
@@ -11,6 +11,7 @@ from storage_api.utils import pairwise
 import os
 import csv
 import io
+import tempfile
 
 # If you're not unicode ready, you're not ready, period.
 BACKEND_SEPARATOR = "🦄"
@@ -35,6 +36,112 @@ def load_basic_auth_conf(app):
     app.config[env_var_name] = os.getenv(env_var_name)
 
 
+def load_batch_conf(app):
+    """
+    Load the limits of the batch endpoint from $SAPI_BATCH_WORKERS (the
+    number of operations run at the same time in each process) and
+    $SAPI_BATCH_MAX_OPERATIONS (the number of operations per batch).
+    """
+    app.config['BATCH_WORKERS'] = int(os.getenv('SAPI_BATCH_WORKERS', 8))
+    app.config['BATCH_MAX_OPERATIONS'] = int(
+        os.getenv('SAPI_BATCH_MAX_OPERATIONS', 500))
+
+
+def load_fanout_conf(app):
+    """
+    Load the limits of the queries to all subsystems from
+    $SAPI_FANOUT_TIMEOUT_S (how long to wait for every subsystem) and
+    $SAPI_FANOUT_WORKERS (the number of subsystems queried at the same
+    time in each process).
+    """
+    app.config['FANOUT_TIMEOUT_S'] = float(
+        os.getenv('SAPI_FANOUT_TIMEOUT_S', 10))
+    app.config['FANOUT_WORKERS'] = int(os.getenv('SAPI_FANOUT_WORKERS', 16))
+
+
+def load_changefeed_conf(app):
+    """
+    Load the settings of the change feeds from
+    $SAPI_CHANGEFEED_INTERVAL_S (how often each subsystem is scanned for
+    changes), $SAPI_CHANGEFEED_MAX_EVENTS (the number of changes kept
+    per subsystem), $SAPI_CHANGEFEED_IDLE_S (after which subsystems
+    whose changes nobody asked for are no longer scanned),
+    $SAPI_EVENTS_KEEPALIVE_S (how often to send something on idle event
+    streams), $SAPI_EVENTS_MAX_DURATION_S (after which event streams
+    are closed, and clients reconnect) and
+    $SAPI_EVENTS_RETRY_S (how long clients wait before reconnecting).
+
+    Every process scans on its own, so a subsystem being followed is
+    scanned as many times per interval as there are uwsgi processes.
+
+    Event streams hold a worker thread for their whole duration, which
+    must stay below uwsgi's harakiri (see uwsgi.ini).
+    """
+    app.config['CHANGEFEED_INTERVAL_S'] = float(
+        os.getenv('SAPI_CHANGEFEED_INTERVAL_S', 30))
+    app.config['CHANGEFEED_MAX_EVENTS'] = int(
+        os.getenv('SAPI_CHANGEFEED_MAX_EVENTS', 10000))
+    app.config['CHANGEFEED_IDLE_S'] = float(
+        os.getenv('SAPI_CHANGEFEED_IDLE_S', 300))
+    app.config['EVENTS_KEEPALIVE_S'] = float(
+        os.getenv('SAPI_EVENTS_KEEPALIVE_S', 15))
+    app.config['EVENTS_MAX_DURATION_S'] = float(
+        os.getenv('SAPI_EVENTS_MAX_DURATION_S', 45))
+    app.config['EVENTS_RETRY_S'] = float(
+        os.getenv('SAPI_EVENTS_RETRY_S', 1))
+
+
+def load_spec_conf(app):
+    """
+    Load how long clients may cache the Swagger specification for from
+    $SAPI_SPEC_MAX_AGE_S.
+    """
+    app.config['SPEC_MAX_AGE_S'] = int(
+        os.getenv('SAPI_SPEC_MAX_AGE_S', 86400))
+
+
+def load_compression_conf(app):
+    """
+    Load the settings of response compression from
+    $SAPI_COMPRESSION_ENCODINGS (a comma-separated list of the encodings
+    to use, in order of preference, empty to disable compression),
+    $SAPI_COMPRESSION_MIN_SIZE (responses smaller than this are sent
+    uncompressed, streamed responses are always compressed), and the
+    levels of each encoding from $SAPI_GZIP_LEVEL (0-9),
+    $SAPI_BROTLI_LEVEL (0-11) and $SAPI_ZSTD_LEVEL (1-22).
+    """
+    encodings = os.getenv('SAPI_COMPRESSION_ENCODINGS', "br,zstd,gzip")
+    app.config['COMPRESSION_ENCODINGS'] = [e.strip() for e
+                                           in encodings.split(",")
+                                           if e.strip()]
+    app.config['COMPRESSION_MIN_SIZE'] = int(
+        os.getenv('SAPI_COMPRESSION_MIN_SIZE', 1024))
+    app.config['COMPRESSION_LEVELS'] = {
+        'gzip': int(os.getenv('SAPI_GZIP_LEVEL', 6)),
+        'br': int(os.getenv('SAPI_BROTLI_LEVEL', 4)),
+        'zstd': int(os.getenv('SAPI_ZSTD_LEVEL', 3)),
+    }
+
+
+def load_metrics_conf(app):
+    """
+    Load the settings of the metrics from $SAPI_METRICS_DIR (a directory
+    shared by all processes of the application, where they write their
+    metrics so that /metrics can add them up, by default in the
+    temporary directory of the host, empty to only expose the metrics of
+    the process serving /metrics), $SAPI_METRICS_FLUSH_S
+    (how often each process writes its metrics there) and
+    $SAPI_METRICS_TOKEN (the bearer token required to read /metrics,
+    empty to leave it open).
+    """
+    app.config['METRICS_DIR'] = os.getenv(
+        'SAPI_METRICS_DIR',
+        os.path.join(tempfile.gettempdir(), "storage-api-metrics"))
+    app.config['METRICS_TOKEN'] = os.getenv('SAPI_METRICS_TOKEN', "")
+    app.config['METRICS_FLUSH_S'] = float(
+        os.getenv('SAPI_METRICS_FLUSH_S', 10))
+
+
 def load_backend_conf(app, backends_module):
     """
     Initialise back-ends into the app app, using the provided module to
@@ -7,7 +7,7 @@
 # granted to it by virtue of its status as Intergovernmental Organization
 # or submit itself to any jurisdiction.
 
-from .storage import DummyStorage, NetappStorage # noqa
+from .storage import DummyStorage, NetappStorage, AsyncNetappStorage # noqa
 
 from storage_api.utils import init_logger
 
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Support for back-ends with an asyncio core behind the synchronous
+StorageBackend interface that the Flask resources expect.
+"""
+from storage_api.utils import init_logger
+
+import asyncio
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+log = init_logger()
+
+# asyncio.Task.current_task() is deprecated as of Python 3.7
+_current_task = getattr(asyncio, 'current_task', None) or \
+    asyncio.Task.current_task
+
+
+class EventLoopThread(object):
+    """
+    An asyncio event loop running in a daemon thread, for synchronous
+    code to run coroutines on.
+
+    Blocking calls (e.g. to a library using requests) are run from the
+    coroutines with call(), on a pool of at most max_workers threads.
+
+    Like PeriodicRefresh, the thread is only started on first use, as
+    uwsgi forks its workers after the application has been loaded and
+    threads do not survive a fork.
+
+    If given, context is called by run() in the calling thread, and
+    returns a function wrapping the blocking calls made with call() on
+    behalf of that run, including by the tasks it starts, e.g. to carry
+    thread-local state over to the worker threads.
+    """
+
+    def __init__(self, max_workers=8, name="event-loop", context=None):
+        self.max_workers = max_workers
+        self.name = name
+        self.context = context
+        self._loop = None
+        self._executor = None
+        self._start_lock = threading.Lock()
+        # task -> the wrapper of the calls made on behalf of it
+        self._wrappers = weakref.WeakKeyDictionary()
+
+    @property
+    def running(self):
+        return self._loop is not None and self._loop.is_running()
+
+    def _start(self):
+        with self._start_lock:
+            if self.running:
+                return self._loop
+
+            loop = asyncio.new_event_loop()
+            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            loop.set_default_executor(executor)
+            loop.set_task_factory(self._new_task)
+            started = threading.Event()
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            thread = threading.Thread(target=run_loop, name=self.name)
+            thread.daemon = True
+            thread.start()
+            started.wait()
+            log.info("Started event loop {}".format(self.name))
+
+            self._loop = loop
+            self._executor = executor
+            return loop
+
+    def _new_task(self, loop, coroutine):
+        # Tasks inherit the wrapper of the task starting them
+        parent = _current_task(loop)
+        task = asyncio.Task(coroutine, loop=loop)
+        wrapper = self._wrappers.get(parent) if parent is not None else None
+        if wrapper is not None:
+            self._wrappers[task] = wrapper
+        return task
+
+    async def _wrapped(self, coroutine, wrapper):
+        self._wrappers[_current_task(self._loop)] = wrapper
+        return await coroutine
+
+    def run(self, coroutine):
+        """
+        Run coroutine on the loop and wait for its result. Must not be
+        called from the loop itself.
+        """
+        loop = self._loop if self.running else self._start()
+        if self.context is not None:
+            coroutine = self._wrapped(coroutine, self.context())
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Return an awaitable of the result of the blocking call
+        func(*args, **kwargs), run in a worker thread. Must be called
+        from a coroutine on the loop.
+        """
+        call = functools.partial(func, *args, **kwargs)
+        task = _current_task(self._loop)
+        wrapper = self._wrappers.get(task) if task is not None else None
+        if wrapper is not None:
+            call = wrapper(call)
+        return self._loop.run_in_executor(None, call)
+
+    def stop(self):
+        with self._start_lock:
+            if not self.running:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._executor.shutdown(wait=False)
+            self._loop = None
+            self._executor = None
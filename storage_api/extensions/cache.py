@@ -0,0 +1,793 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+In-memory caches and indexes used by the storage back-ends to avoid
+round trips to the storage system.
+
+Everything in here is thread-safe, as uwsgi runs several threads per
+worker.
+"""
+from storage_api.utils import init_logger
+
+import ipaddress
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple # noqa
+
+log = init_logger()
+
+
+class PeriodicRefresh(object):
+    """
+    Call a function every interval_s seconds in a daemon thread.
+
+    The thread is not started until start() is called, which is safe to
+    call any number of times. Back-ends should call it lazily on first
+    use rather than on creation, as uwsgi forks its workers after the
+    application has been loaded and threads do not survive a fork.
+
+    An interval of 0 or less disables the refresh entirely.
+
+    With a positive idle_s, the thread stops once start() has not been
+    called for idle_s seconds, until the next call to start(): calling
+    it on every read then only keeps refreshing what is being read.
+    """
+
+    def __init__(self, interval_s, func, name=None, idle_s=0):
+        self.interval_s = float(interval_s)
+        self.func = func
+        self.name = name or getattr(func, '__name__', 'refresh')
+        self.idle_s = float(idle_s)
+        self._used_at = time.monotonic()
+        self._thread = None
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.interval_s > 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._used_at = time.monotonic()
+        if not self.enabled or self.running:
+            return
+
+        with self._start_lock:
+            if self.running:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        log.info("Starting background refresh {} every {}s"
+                 .format(self.name, self.interval_s))
+        while not self._stopped.wait(self.interval_s):
+            if self._idle():
+                with self._start_lock:
+                    # Checked again, as start() only takes the lock if
+                    # the thread is not running
+                    if self._idle():
+                        self._thread = None
+                        log.info("Pausing background refresh {}, unused"
+                                 " for {}s".format(self.name, self.idle_s))
+                        return
+            try:
+                self.func()
+            except Exception as e:
+                log.warning("Background refresh {} failed: {}"
+                            .format(self.name, e))
+
+    def _idle(self):
+        return (self.idle_s > 0
+                and time.monotonic() - self._used_at > self.idle_s)
+
+    def __repr__(self):
+        return "{}({}, every {}s)".format(type(self).__name__,
+                                          self.name, self.interval_s)
+
+
+class ReadWriteLock(object):
+    """
+    A lock letting any number of readers in at the same time, or one
+    writer. Waiting writers keep new readers out, so that a steady flow
+    of reads cannot starve writes.
+
+    Not reentrant: a thread holding the lock must not take it again.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def reading(self):
+        with self._condition:
+            while self._writing or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self._condition:
+            self._writers_waiting += 1
+            try:
+                while self._writing or self._readers:
+                    self._condition.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class VolumeNameIndex(object):
+    """
+    A two-way index between volume names and their junction paths,
+    keyed by the node serving them.
+
+    Junction paths are unique within a vserver, so a lookup that does
+    not specify a node (or specifies a node the index does not know
+    about) still resolves as long as only one node is known to serve
+    the path.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # junction path -> node -> name
+        self._paths = {}  # type: Dict[str, Dict[Optional[str], str]]
+        # name -> (node, junction path)
+        self._names = {}  # type: Dict[str, Tuple[Optional[str], str]]
+
+    def __len__(self):
+        return len(self._names)
+
+    def _add(self, name, junction_path, node):
+        self._discard(name)
+        if not junction_path:
+            return
+        self._paths.setdefault(junction_path, {})[node or None] = name
+        self._names[name] = (node or None, junction_path)
+
+    def _discard(self, name):
+        node, junction_path = self._names.pop(name, (None, None))
+        if junction_path is None:
+            return
+        nodes = self._paths.get(junction_path, {})
+        if nodes.get(node) == name:
+            nodes.pop(node)
+        if not nodes:
+            self._paths.pop(junction_path, None)
+
+    def add(self, name, junction_path, node=None):
+        """
+        Record that the volume name is mounted at junction_path on
+        node, replacing any previous entry for that volume.
+        """
+        with self._lock:
+            self._add(name, junction_path, node)
+
+    def discard(self, name):
+        """
+        Forget everything about the volume name, if anything.
+        """
+        with self._lock:
+            self._discard(name)
+
+    def replace_all(self, entries):
+        """
+        Replace the contents of the index with entries, an iterable of
+        (name, junction_path, node) tuples.
+        """
+        paths = {}  # type: Dict[str, Dict[Optional[str], str]]
+        names = {}  # type: Dict[str, Tuple[Optional[str], str]]
+        for name, junction_path, node in entries:
+            if not junction_path:
+                continue
+            paths.setdefault(junction_path, {})[node or None] = name
+            names[name] = (node or None, junction_path)
+
+        with self._lock:
+            self._paths = paths
+            self._names = names
+
+    def name_of(self, junction_path, node=None):
+        """
+        Return the name of the volume mounted at junction_path on node,
+        or None if it is not known.
+        """
+        with self._lock:
+            nodes = self._paths.get(junction_path)
+            if not nodes:
+                return None
+            if node and node in nodes:
+                return nodes[node]
+            if len(nodes) == 1:
+                return next(iter(nodes.values()))
+            return None
+
+    def path_of(self, volume_name):
+        """
+        Return a tuple of (node, junction_path) for volume_name, or None
+        if it is not known. The node is None if it was never recorded.
+        """
+        with self._lock:
+            return self._names.get(volume_name)
+
+
+class VolumeInventory(object):
+    """
+    A write-through cache of all the volumes of a back-end, as
+    dictionaries keyed by volume name.
+
+    The inventory is (re-)loaded by calling load() whenever it is read
+    and older than ttl_s seconds. Back-ends are expected to keep it
+    up to date with their own writes using put() and discard(), so that
+    these are visible immediately.
+
+    Writes made while a load is in progress are re-applied on top of
+    the freshly loaded data, so they cannot be lost to a slow load.
+
+    Volumes are also indexed by the values of the keys in indexed, for
+    volumes_with().
+
+    A ttl_s of 0 or less disables the cache: every read calls load().
+    """
+
+    def __init__(self, ttl_s, load, indexed=()):
+        self.ttl_s = float(ttl_s)
+        self._load = load
+        self.indexed = tuple(indexed)
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._volumes = None  # type: Optional[OrderedDict]
+        # key -> value -> names of the volumes with that value
+        self._index = {}  # type: Dict[str, Dict[Any, set]]
+        self._loaded_at = None  # type: Optional[float]
+        self._pending = None  # type: Optional[Dict[str, Any]]
+
+    @property
+    def enabled(self):
+        return self.ttl_s > 0
+
+    @property
+    def loaded(self):
+        return self._volumes is not None
+
+    @property
+    def fresh(self):
+        loaded_at = self._loaded_at
+        return (loaded_at is not None
+                and time.monotonic() - loaded_at < self.ttl_s)
+
+    def _ensure_fresh(self):
+        if not self.fresh:
+            with self._load_lock:
+                # Someone else may have loaded while we were waiting
+                if not self.fresh:
+                    self._refresh()
+
+    def volumes(self):
+        """
+        Return a list of all volumes, loading them if necessary.
+
+        The returned dictionaries are shared with the cache and must not
+        be modified.
+        """
+        if not self.enabled:
+            return list(self._load())
+
+        self._ensure_fresh()
+        with self._lock:
+            return list(self._volumes.values())
+
+    def volumes_with(self, key, values):
+        """
+        Return a list of the volumes whose value for key, which must be
+        one of the indexed keys, is in values, by name. Like volumes(),
+        loads the volumes if necessary.
+
+        Only goes through the matching volumes, found in the index.
+        """
+        if key not in self.indexed:
+            raise ValueError("Volumes are not indexed by {}".format(key))
+
+        values = set(values)
+        if not self.enabled:
+            return sorted((v for v in self._load() if v.get(key) in values),
+                          key=lambda v: v['name'])
+
+        self._ensure_fresh()
+        with self._lock:
+            index = self._index[key]
+            names = set()
+            for value in values:
+                names.update(index.get(value, ()))
+            return [self._volumes[name] for name in sorted(names)]
+
+    def _index_volume(self, volume):
+        for key in self.indexed:
+            self._index[key].setdefault(volume.get(key), set()).add(
+                volume['name'])
+
+    def _unindex_volume(self, volume):
+        for key in self.indexed:
+            names = self._index[key].get(volume.get(key))
+            if names is not None:
+                names.discard(volume['name'])
+                if not names:
+                    self._index[key].pop(volume.get(key))
+
+    def refresh(self):
+        """
+        Unconditionally re-load the inventory.
+        """
+        with self._load_lock:
+            self._refresh()
+
+    def _refresh(self):
+        with self._lock:
+            self._pending = {}
+
+        try:
+            volumes = OrderedDict((v['name'], v) for v in self._load())
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            for name, volume in self._pending.items():
+                if volume is None:
+                    volumes.pop(name, None)
+                else:
+                    volumes[name] = volume
+            self._pending = None
+            self._volumes = volumes
+            self._index = {key: {} for key in self.indexed}
+            for volume in volumes.values():
+                self._index_volume(volume)
+            self._loaded_at = time.monotonic()
+
+    def _write(self, name, volume):
+        with self._lock:
+            if self._pending is not None:
+                self._pending[name] = volume
+
+            if self._volumes is None:
+                return
+
+            old_volume = self._volumes.get(name)
+            if old_volume is not None:
+                self._unindex_volume(old_volume)
+
+            if volume is None:
+                self._volumes.pop(name, None)
+            else:
+                self._volumes[name] = volume
+                self._index_volume(volume)
+
+    def put(self, volume):
+        """
+        Insert or replace a volume in the inventory.
+        """
+        self._write(volume['name'], volume)
+
+    def discard(self, volume_name):
+        """
+        Remove a volume from the inventory, if present.
+        """
+        self._write(volume_name, None)
+
+    def invalidate(self):
+        """
+        Force a re-load on the next read.
+        """
+        self._loaded_at = None
+
+
+class SnapshotCache(object):
+    """
+    The snapshots of the most recently listed volumes, as dictionaries
+    keyed by volume and snapshot name.
+
+    A volume is cached for ttl_s seconds after its snapshots have been
+    listed in full with replace(). Back-ends are expected to keep it
+    up to date with their own writes using put() and discard().
+
+    A listing that was started before a write to the same volume is not
+    stored, as it may or may not include the write. Use version() to get
+    a token before listing, and pass it to replace().
+
+    At most max_volumes volumes are kept; the least recently used ones
+    are dropped first. A ttl_s of 0 or less disables the cache.
+    """
+
+    def __init__(self, ttl_s, max_volumes=1024):
+        self.ttl_s = float(ttl_s)
+        self.max_volumes = int(max_volumes)
+        self._lock = threading.Lock()
+        # volume name -> (time listed, snapshot name -> snapshot)
+        self._volumes = OrderedDict()  # type: OrderedDict
+        self._versions = {}  # type: Dict[str, int]
+
+    @property
+    def enabled(self):
+        return self.ttl_s > 0
+
+    def __len__(self):
+        return len(self._volumes)
+
+    def _fresh_snapshots(self, volume_name):
+        entry = self._volumes.get(volume_name)
+        if entry is None:
+            return None
+
+        listed_at, snapshots = entry
+        if time.monotonic() - listed_at >= self.ttl_s:
+            self._volumes.pop(volume_name)
+            return None
+
+        self._volumes.move_to_end(volume_name)
+        return snapshots
+
+    def version(self, volume_name):
+        """
+        Return a token to pass to replace() after listing the snapshots
+        of volume_name.
+        """
+        with self._lock:
+            return self._versions.get(volume_name, 0)
+
+    def _bump(self, volume_name):
+        self._versions[volume_name] = self._versions.get(volume_name, 0) + 1
+
+    def snapshots(self, volume_name):
+        """
+        Return a list of all the snapshots of volume_name, or None if
+        they are not cached.
+        """
+        with self._lock:
+            snapshots = self._fresh_snapshots(volume_name)
+            return None if snapshots is None else list(snapshots.values())
+
+    def get(self, volume_name, snapshot_name):
+        """
+        Return the snapshot snapshot_name of volume_name, or None if it
+        is not cached.
+        """
+        with self._lock:
+            snapshots = self._fresh_snapshots(volume_name)
+            return None if snapshots is None else snapshots.get(snapshot_name)
+
+    def replace(self, volume_name, snapshots, version):
+        """
+        Cache snapshots as all the snapshots of volume_name, unless
+        there were writes to it since version() returned version.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if self._versions.get(volume_name, 0) != version:
+                return
+            self._volumes.pop(volume_name, None)
+            self._volumes[volume_name] = (
+                time.monotonic(),
+                OrderedDict((s['name'], s) for s in snapshots))
+            while len(self._volumes) > self.max_volumes:
+                self._volumes.popitem(last=False)
+
+    def put(self, volume_name, snapshot):
+        """
+        Insert or replace a snapshot of volume_name, if it is cached.
+        """
+        with self._lock:
+            self._bump(volume_name)
+            snapshots = self._fresh_snapshots(volume_name)
+            if snapshots is not None:
+                snapshots[snapshot['name']] = snapshot
+
+    def discard(self, volume_name, snapshot_name):
+        """
+        Remove a snapshot of volume_name, if present.
+        """
+        with self._lock:
+            self._bump(volume_name)
+            snapshots = self._fresh_snapshots(volume_name)
+            if snapshots is not None:
+                snapshots.pop(snapshot_name, None)
+
+    def invalidate(self, volume_name):
+        """
+        Forget all about the snapshots of volume_name.
+        """
+        with self._lock:
+            self._bump(volume_name)
+            self._volumes.pop(volume_name, None)
+
+
+def rule_network(rule):
+    """
+    Return the IP network an export policy rule matches as an
+    ipaddress network, or None if the rule is not an address or
+    network, e.g. a host name or a netgroup.
+    """
+    try:
+        return ipaddress.ip_network(rule, strict=False)
+    except ValueError:
+        return None
+
+
+def network_contains(outer, inner):
+    """
+    Return True if the ipaddress network inner is all inside outer.
+    """
+    return (outer.version == inner.version
+            and outer.prefixlen <= inner.prefixlen
+            and inner.network_address in outer)
+
+
+class NetworkTrie(object):
+    """
+    A binary prefix trie of IP networks, each mapped to a count of
+    values, for finding all the values of the networks containing a
+    given network in time proportional to its prefix length.
+    """
+
+    # Nodes are lists of [zero child, one child, {value: count}]
+
+    def __init__(self):
+        self._roots = {4: [None, None, {}], 6: [None, None, {}]}
+
+    @staticmethod
+    def _bits(network):
+        address = int(network.network_address)
+        width = network.max_prefixlen
+        for i in range(network.prefixlen):
+            yield (address >> (width - 1 - i)) & 1
+
+    def add(self, network, value):
+        node = self._roots[network.version]
+        for bit in self._bits(network):
+            if node[bit] is None:
+                node[bit] = [None, None, {}]
+            node = node[bit]
+        node[2][value] = node[2].get(value, 0) + 1
+
+    def discard(self, network, value):
+        node = self._roots[network.version]
+        for bit in self._bits(network):
+            node = node[bit]
+            if node is None:
+                return
+        count = node[2].get(value, 0)
+        if count > 1:
+            node[2][value] = count - 1
+        else:
+            node[2].pop(value, None)
+
+    def containing(self, network):
+        """
+        Return a set of the values of all the networks containing
+        network, including network itself.
+        """
+        node = self._roots[network.version]
+        values = set(node[2])
+        for bit in self._bits(network):
+            node = node[bit]
+            if node is None:
+                break
+            values.update(node[2])
+        return values
+
+
+class PolicyRuleIndex(object):
+    """
+    The rules of all the export policies of a back-end, indexed by
+    policy name and by the networks they grant access to.
+
+    The index is loaded by calling load() on first use or when
+    refresh() is called, which must return an iterable of (policy name,
+    list of rules) tuples. Back-ends are expected to keep it up to date
+    with their own writes, which like in VolumeInventory are re-applied
+    on top of a load in progress.
+
+    Rules are kept in the order of the back-end, which must place rules
+    added with add_rule() first.
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        # policy name -> rules, as the keys of an OrderedDict
+        self._policies = None  # type: Optional[Dict[str, OrderedDict]]
+        self._networks = NetworkTrie()
+        # Writes made while loading, as (policy name, update) tuples
+        self._pending = None  # type: Optional[List[tuple]]
+
+    @property
+    def loaded(self):
+        return self._policies is not None
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            with self._load_lock:
+                if not self.loaded:
+                    self._refresh()
+
+    def refresh(self):
+        """
+        Unconditionally re-load the index.
+        """
+        with self._load_lock:
+            self._refresh()
+
+    def _refresh(self):
+        with self._lock:
+            self._pending = []
+
+        try:
+            policies = OrderedDict(
+                (name, OrderedDict.fromkeys(rules))
+                for name, rules in self._load())
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        networks = NetworkTrie()
+        for name, rules in policies.items():
+            for network in filter(None, map(rule_network, rules)):
+                networks.add(network, name)
+
+        with self._lock:
+            for name, update in self._pending:
+                self._set(policies, networks, name,
+                          update(policies.get(name)))
+            self._pending = None
+
+            self._policies = policies
+            self._networks = networks
+        log.debug("Refreshed export policy index: {} policies"
+                  .format(len(policies)))
+
+    @staticmethod
+    def _set(policies, networks, policy_name, rules):
+        old_rules = policies.get(policy_name) or ()
+        for network in filter(None, map(rule_network, old_rules)):
+            networks.discard(network, policy_name)
+
+        if rules is None:
+            policies.pop(policy_name, None)
+            return
+
+        # Replacing keeps the policy in its place
+        policies[policy_name] = OrderedDict.fromkeys(rules)
+        for network in filter(None, map(rule_network, policies[policy_name])):
+            networks.add(network, policy_name)
+
+    def _write(self, policy_name, update):
+        """
+        Replace the rules of policy_name with update(its current rules),
+        where rules are None for a missing policy. Must be called with
+        the lock held.
+        """
+        if self._pending is not None:
+            self._pending.append((policy_name, update))
+
+        if self._policies is not None:
+            self._set(self._policies, self._networks, policy_name,
+                      update(self._policies.get(policy_name)))
+
+    def policies(self):
+        """
+        Return a list of (policy name, list of rules) tuples for all
+        policies.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return [(name, list(rules))
+                    for name, rules in self._policies.items()]
+
+    def rules(self, policy_name):
+        """
+        Return the list of rules of policy_name, or None if there is no
+        such policy.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            rules = self._policies.get(policy_name)
+            return None if rules is None else list(rules)
+
+    def has_rule(self, policy_name, rule):
+        """
+        Return True or False depending on whether policy_name has rule,
+        or None if there is no such policy.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            rules = self._policies.get(policy_name)
+            return None if rules is None else rule in rules
+
+    def granting(self, network):
+        """
+        Return a list of (policy name, list of rules) tuples for all
+        the policies with a rule matching all of the ipaddress network,
+        ordered by name.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return [(name, list(self._policies[name]))
+                    for name in sorted(self._networks.containing(network))]
+
+    def put(self, policy_name, rules):
+        """
+        Insert or replace a policy and its rules.
+        """
+        rules = list(rules)
+        with self._lock:
+            self._write(policy_name, lambda _old_rules: rules)
+
+    def discard(self, policy_name):
+        """
+        Remove a policy, if present.
+        """
+        with self._lock:
+            self._write(policy_name, lambda _old_rules: None)
+
+    def add_rule(self, policy_name, rule):
+        """
+        Add rule first among the rules of policy_name, if known.
+        """
+        def add(rules):
+            if rules is None or rule in rules:
+                return rules
+            return [rule] + list(rules)
+
+        with self._lock:
+            self._write(policy_name, add)
+
+    def remove_rule(self, policy_name, rule):
+        """
+        Remove rule from the rules of policy_name, if present.
+        """
+        def remove(rules):
+            if rules is None:
+                return None
+            return [r for r in rules if r != rule]
+
+        with self._lock:
+            self._write(policy_name, remove)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+A feed of the changes to the volumes, snapshots, locks and policies of
+a back-end, found by comparing consecutive scans of all of them.
+
+Changes are identified by tokens, which are the (wall clock) times at
+which the scans that found them started. A client holding a token has
+seen everything that changed before the scan it came from started.
+
+As tokens are times rather than counters, a token from the feed of one
+process (e.g. a uwsgi worker) can be used with the feed of another
+one. As the scans of different feeds overlap, a change made after a
+token may have been found by a scan of the other feed that started
+before it, but ended after it: a feed given a token of another one
+returns the changes found by all the scans that ended after it. At
+worst, a client then sees some changes twice.
+
+Every process scans on its own, from the first time it is asked for
+changes until it has not been asked for idle_s seconds.
+"""
+from storage_api.extensions.cache import PeriodicRefresh
+from storage_api.utils import init_logger
+
+import threading
+import time
+from collections import deque, namedtuple, OrderedDict
+
+log = init_logger()
+
+Change = namedtuple('Change', 'token, kind, key, change, data')
+
+CREATED = 'created'
+UPDATED = 'updated'
+DELETED = 'deleted'
+
+
+def format_token(token):
+    return "{:.6f}".format(token)
+
+
+def parse_token(token):
+    """
+    Parse a token as returned by format_token().
+
+    Raises ValueError if it is not a token.
+    """
+    try:
+        return float(token)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid change token: {}".format(token))
+
+
+def diff_states(old, new, token):
+    """
+    Return a list of the Changes between two scans, which are
+    dictionaries of kind -> key -> item.
+    """
+    changes = []
+    for kind in sorted(set(old) | set(new)):
+        old_items = old.get(kind, {})
+        new_items = new.get(kind, {})
+        for key, item in new_items.items():
+            if key not in old_items:
+                changes.append(Change(token, kind, key, CREATED, item))
+            elif old_items[key] != item:
+                changes.append(Change(token, kind, key, UPDATED, item))
+        for key in old_items:
+            if key not in new_items:
+                changes.append(Change(token, kind, key, DELETED, None))
+    return changes
+
+
+class ChangeFeed(object):
+    """
+    Scan a back-end every interval_s seconds in a daemon thread, and
+    keep the last max_events changes found.
+
+    scan() must return the current state of the back-end as a
+    dictionary of kind -> key -> item, where the items can be compared
+    with ==. See StorageBackend.scan_state().
+
+    Like PeriodicRefresh, nothing happens until start() is called, and
+    with a positive idle_s, scanning stops once the feed has not been
+    asked for changes for idle_s seconds, until the next time it is.
+    """
+
+    def __init__(self, scan, interval_s=30, max_events=10000, name=None,
+                 idle_s=0):
+        self._scan = scan
+        self.max_events = int(max_events)
+        self._lock = threading.Condition()
+        self._poll_lock = threading.Lock()
+        self._state = None
+        # (the time the scan that found it ended, Change)
+        self._events = deque()  # type: deque
+        self._token = None
+        # The times at which our recent scans started and ended, to tell
+        # our own tokens from the ones of other feeds
+        self._scans = OrderedDict()  # type: OrderedDict
+        # The start and end of the last scan whose changes may have been
+        # dropped: tokens before them must start over
+        self._complete_after = None
+        self._refresh = PeriodicRefresh(interval_s=interval_s,
+                                        func=self.poll,
+                                        name=name or "change-feed",
+                                        idle_s=idle_s)
+
+    @property
+    def token(self):
+        """
+        The token of the latest scan, or None before the first one.
+        """
+        return self._token
+
+    def start(self):
+        """
+        Scan for the first time, unless that has already happened, and
+        start scanning in the background. Safe to call any number of
+        times.
+        """
+        if self._token is None:
+            with self._poll_lock:
+                if self._token is None:
+                    self._poll()
+        self._refresh.start()
+
+    def stop(self):
+        self._refresh.stop()
+
+    def poll(self):
+        """
+        Scan the back-end and record the changes since the last scan.
+        """
+        with self._poll_lock:
+            self._poll()
+
+    def _poll(self):
+        # Taken before scanning, as what changes during the scan may or
+        # may not be found by it. Never goes back in time, even if the
+        # clock does. Rounded so that tokens survive format_token() and
+        # parse_token() unchanged.
+        token = round(max(time.time(), (self._token or 0.0) + 1e-6), 6)
+        state = self._scan()
+        ended = max(round(time.time(), 6), token)
+
+        with self._lock:
+            if self._state is None:
+                self._complete_after = (token, ended)
+            else:
+                changes = diff_states(self._state, state, token)
+                self._events.extend((ended, change) for change in changes)
+                while len(self._events) > self.max_events:
+                    dropped_ended, dropped = self._events.popleft()
+                    self._complete_after = (dropped.token, dropped_ended)
+                if changes:
+                    log.debug("Found {} changes".format(len(changes)))
+
+            self._scans[token] = ended
+            while (len(self._scans) > self.max_events
+                   or next(iter(self._scans)) < self._complete_after[0]):
+                self._scans.popitem(last=False)
+
+            self._state = state
+            self._token = token
+            self._lock.notify_all()
+
+    def _must_start_over(self, token, own):
+        started, ended = self._complete_after
+        return token < started if own else token < ended
+
+    def since(self, token, kinds=None):
+        """
+        Return the changes since token (a float, or None for everything)
+        to the given kinds (or all of them) as a tuple of (the token to
+        ask from next time, list of Changes, complete).
+
+        There is at most one Change per item, for its latest change. If
+        some changes since token are no longer known, all current items
+        are returned as created and complete is True: the client should
+        then forget everything it knows and start over.
+
+        Tokens of other feeds get the changes found by every scan that
+        ended after them, see the module documentation.
+        """
+        self.start()
+
+        with self._lock:
+            own = token in self._scans
+            if token is None or self._must_start_over(token, own):
+                changes = [Change(self._token, kind, key, CREATED, item)
+                           for kind, items in sorted(self._state.items())
+                           for key, item in items.items()]
+                complete = True
+            else:
+                latest = OrderedDict()
+                for ended, change in self._events:
+                    if (change.token if own else ended) > token:
+                        latest.pop((change.kind, change.key), None)
+                        latest[(change.kind, change.key)] = change
+                changes = list(latest.values())
+                complete = False
+            next_token = max(self._token, token or 0.0)
+
+        if kinds is not None:
+            changes = [c for c in changes if c.kind in kinds]
+        return next_token, changes, complete
+
+    def wait(self, token, timeout_s):
+        """
+        Wait for at most timeout_s seconds for a scan after token.
+        Returns True if there has been one.
+        """
+        deadline = time.monotonic() + timeout_s
+        with self._lock:
+            while self._token is None or self._token <= token:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Counters and latency histograms, exposed in the Prometheus text format.
+
+Metrics are kept in memory by each process, and are thread-safe. As
+uwsgi runs several worker processes, each of them can write a snapshot
+of its metrics to a shared directory (see write_snapshot()), and the
+snapshots of all of them are summed up (see read_snapshots() and
+merge_snapshots()) when the metrics are exposed. The snapshots of
+processes that have exited are folded into a single one as they are
+read, so that the directory does not grow with every worker recycle.
+The directory is cleared when the application starts (see
+clear_snapshots()), so that the metrics of a previous run are not
+added to the ones of the current one.
+
+Histograms count observations in cumulative buckets like the ones of
+the Prometheus client libraries, with the same default bounds.
+"""
+from storage_api.utils import init_logger
+
+import bisect
+import fcntl
+import inspect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Tuple # noqa
+
+log = init_logger()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# The snapshot of the processes that have exited, in a metrics directory
+EXITED_SNAPSHOT = "exited.json"
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5,
+                   5.0, 7.5, 10.0)
+
+
+class Counter(object):
+    """
+    A counter of things that happened, by the values of labelnames.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # type: Dict[tuple, float]
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(labels), value]
+                       for labels, value in self._values.items()]
+        return {'type': self.type, 'help': self.documentation,
+                'labelnames': list(self.labelnames), 'samples': samples}
+
+
+class Histogram(object):
+    """
+    A histogram of observed values (e.g. durations in seconds), by the
+    values of labelnames, counted in buckets with the upper bounds
+    buckets (and +Inf).
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        # labels -> [[count per bucket, the last one for +Inf], sum]
+        self._values = {}  # type: Dict[tuple, list]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bucket] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """
+        Observe how long the body of the with block takes to run, even
+        if it raises an exception.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            return sum(entry[0]) if entry else 0
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(labels), list(counts), total]
+                       for labels, (counts, total) in self._values.items()]
+        return {'type': self.type, 'help': self.documentation,
+                'labelnames': list(self.labelnames),
+                'buckets': list(self.buckets), 'samples': samples}
+
+
+class Registry(object):
+    """
+    The metrics of a process, by name.
+    """
+
+    def __init__(self):
+        self._metrics = OrderedDict()  # type: Dict[str, object]
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add metric, returning the one already registered under the same
+        name if there is one, so that modules can be reloaded.
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def snapshot(self):
+        """
+        Return the current values of all metrics, as a dictionary that
+        can be serialised as JSON.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return OrderedDict((metric.name, metric.snapshot())
+                           for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    """
+    Return the Counter called name of REGISTRY, creating it if needed.
+    """
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """
+    Return the Histogram called name of REGISTRY, creating it if needed.
+    """
+    return REGISTRY.register(Histogram(name, documentation, labelnames,
+                                       buckets))
+
+
+def merge_snapshots(snapshots):
+    """
+    Sum up the samples with the same labels of snapshots (as returned by
+    Registry.snapshot()) of several processes into one snapshot.
+
+    Samples of histograms with other buckets than the first snapshot
+    of the metric (i.e. of an older version of the application) are
+    skipped.
+    """
+    merged = OrderedDict()  # type: Dict[str, dict]
+    values = {}  # type: Dict[str, Dict[tuple, list]]
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            if name not in merged:
+                merged[name] = dict(metric, samples=[])
+                values[name] = OrderedDict()
+            elif metric.get('buckets') != merged[name].get('buckets'):
+                continue
+
+            samples = values[name]
+            for labels, *value in metric['samples']:
+                key = tuple(labels)
+                if key not in samples:
+                    samples[key] = value
+                elif metric['type'] == 'histogram':
+                    counts, total = samples[key]
+                    samples[key] = [[a + b for a, b in zip(counts, value[0])],
+                                    total + value[1]]
+                else:
+                    samples[key] = [samples[key][0] + value[0]]
+
+    for name, metric in merged.items():
+        metric['samples'] = [[list(labels)] + value
+                             for labels, value in values[name].items()]
+    return merged
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{{{}}}".format(",".join('{}="{}"'.format(name, _escape(value))
+                                    for name, value in pairs))
+
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshot):
+    """
+    Return snapshot (as returned by Registry.snapshot() or
+    merge_snapshots()) in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, metric in snapshot.items():
+        names = metric['labelnames']
+        lines.append("# HELP {} {}".format(
+            name, metric['help'].replace("\\", "\\\\").replace("\n", "\\n")))
+        lines.append("# TYPE {} {}".format(name, metric['type']))
+        for labels, *value in sorted(metric['samples'],
+                                     key=lambda s: [str(v) for v in s[0]]):
+            if metric['type'] != 'histogram':
+                lines.append("{}{} {}".format(name, _labels(names, labels),
+                                              _number(value[0])))
+                continue
+
+            counts, total = value
+            cumulative = 0
+            bounds = metric['buckets'] + [float('inf')]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    name, _labels(names, labels, [('le', _number(bound))]),
+                    cumulative))
+            lines.append("{}_sum{} {}".format(name, _labels(names, labels),
+                                              _number(float(total))))
+            lines.append("{}_count{} {}".format(name, _labels(names, labels),
+                                                cumulative))
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomically(path, snapshot):
+    temporary = os.path.join(os.path.dirname(path),
+                             ".{}.tmp".format(os.path.basename(path)))
+    with open(temporary, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(temporary, path)
+
+
+def write_snapshot(directory, snapshot):
+    """
+    Write snapshot to directory as the one of this process, replacing
+    the previous one atomically.
+    """
+    _write_atomically(
+        os.path.join(directory, "{}.json".format(os.getpid())), snapshot)
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError) as e:
+        log.warning("Skipping unreadable metrics snapshot {}: {}"
+                    .format(path, e))
+        return None
+
+
+def _process_of(filename):
+    """
+    Return the PID of the process filename is the snapshot of, or None
+    if it is not one.
+    """
+    name, extension = os.path.splitext(filename)
+    return int(name) if extension == ".json" and name.isdigit() else None
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def _locked(directory):
+    """
+    Hold an exclusive lock on directory, shared with the other
+    processes using it.
+    """
+    with open(os.path.join(directory, ".lock"), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _snapshot_files(directory):
+    return sorted(f for f in os.listdir(directory)
+                  if f.endswith(".json") and not f.startswith("."))
+
+
+def _fold_exited(directory):
+    """
+    Merge the snapshots of the processes that have exited into
+    EXITED_SNAPSHOT, and remove them. Must be called with the directory
+    locked.
+    """
+    exited = [f for f in _snapshot_files(directory)
+              if _process_of(f) is not None
+              and not _running(_process_of(f))]
+    if not exited:
+        return
+
+    path = os.path.join(directory, EXITED_SNAPSHOT)
+    snapshots = [_read_snapshot(os.path.join(directory, f))
+                 for f in exited]
+    if os.path.exists(path):
+        folded = _read_snapshot(path)
+        if folded is None:
+            # Better to keep many files than to lose what was folded
+            return
+        snapshots.insert(0, folded)
+
+    _write_atomically(path, merge_snapshots(s for s in snapshots if s))
+    for filename in exited:
+        os.remove(os.path.join(directory, filename))
+    log.info("Folded the metrics of {} exited processes into {}"
+             .format(len(exited), path))
+
+
+def clear_snapshots(directory):
+    """
+    Remove all snapshots from directory, creating it if needed. Meant
+    to be called once, before any process writes to it.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with _locked(directory):
+        for filename in _snapshot_files(directory):
+            os.remove(os.path.join(directory, filename))
+
+
+def read_snapshots(directory):
+    """
+    Return the snapshots of all processes in directory, including the
+    ones that have exited since, so that counters never go down.
+
+    The snapshots of processes that have exited are folded into
+    EXITED_SNAPSHOT first. Processes are told apart by their PID, so
+    the directory must not be shared between hosts.
+    """
+    with _locked(directory):
+        _fold_exited(directory)
+        snapshots = [_read_snapshot(os.path.join(directory, f))
+                     for f in _snapshot_files(directory)]
+    return [s for s in snapshots if s is not None]
+
+
+BACKEND_SECONDS = histogram(
+    'sapi_backend_call_duration_seconds',
+    "Time spent in the methods of the storage back-ends, including"
+    " consuming the iterators they return",
+    ['subsystem', 'method'])
+
+
+class TimedIterator(object):
+    """
+    An iterator over iterator, observing the time spent in it
+    (including spent_s, for creating it) in BACKEND_SECONDS once it is
+    exhausted, fails or is closed.
+    """
+
+    def __init__(self, iterator, labels, spent_s=0.0):
+        self._iterator = iterator
+        self._labels = labels
+        self._spent_s = spent_s
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            item = next(self._iterator)
+        except BaseException:
+            self._spent_s += time.perf_counter() - start
+            self._observe()
+            raise
+        self._spent_s += time.perf_counter() - start
+        return item
+
+    def _observe(self):
+        if not self._done:
+            self._done = True
+            BACKEND_SECONDS.observe(self._spent_s, *self._labels)
+
+    def close(self):
+        self._observe()
+        close = getattr(self._iterator, 'close', None)
+        if close is not None:
+            close()
+
+    def __del__(self):
+        self._observe()
+
+
+def _timed_result(result, labels, start):
+    spent_s = time.perf_counter() - start
+    if hasattr(result, '__next__'):
+        return TimedIterator(result, labels, spent_s)
+    BACKEND_SECONDS.observe(spent_s, *labels)
+    return result
+
+
+class TimedBackend(object):
+    """
+    A proxy of a StorageBackend of subsystem, observing the time spent
+    in its public methods and properties in BACKEND_SECONDS.
+
+    Iterators returned by the methods are timed as they are consumed.
+    """
+
+    def __init__(self, backend, subsystem):
+        self.backend = backend
+        self.subsystem = subsystem
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            return getattr(self.backend, name)
+
+        labels = (self.subsystem, name)
+        if isinstance(getattr(type(self.backend), name, None), property):
+            start = time.perf_counter()
+            try:
+                value = getattr(self.backend, name)
+            except BaseException:
+                BACKEND_SECONDS.observe(time.perf_counter() - start, *labels)
+                raise
+            return _timed_result(value, labels, start)
+
+        value = getattr(self.backend, name)
+        if not callable(value):
+            return value
+        return TimedMethod(value, labels)
+
+
+class TimedMethod(object):
+    """
+    A method of a TimedBackend, with the same signature as method.
+    """
+
+    def __init__(self, method, labels):
+        self.method = method
+        self.labels = labels
+
+    @property
+    def __signature__(self):
+        return inspect.signature(self.method)
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = self.method(*args, **kwargs)
+        except BaseException:
+            BACKEND_SECONDS.observe(time.perf_counter() - start,
+                                    *self.labels)
+            raise
+        return _timed_result(result, self.labels, start)
+
+
+_timed_backends = {}  # type: Dict[str, TimedBackend]
+_timed_backends_lock = threading.Lock()
+
+
+def timed_backend(subsystem, backend):
+    """
+    Return the TimedBackend of backend, the same one as long as it is
+    the back-end of subsystem, as callers may compare them by identity.
+    """
+    with _timed_backends_lock:
+        timed = _timed_backends.get(subsystem)
+        if timed is None or timed.backend is not backend:
+            timed = _timed_backends[subsystem] = TimedBackend(backend,
+                                                              subsystem)
+        return timed
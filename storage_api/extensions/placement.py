@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+Placement of new volumes on aggregates.
+
+The free space of the aggregates is read from the storage system at
+most every ttl_s seconds, and volumes being created reserve their size
+against it, so that concurrent creations see each other and spread out
+instead of all picking the same aggregate.
+
+Placement strategies are functions taking a list of candidate
+AggregateStates and the size of the new volume, and returning the
+chosen candidate. They are registered by name in PLACEMENT_STRATEGIES.
+"""
+from storage_api.utils import init_logger
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional  # noqa
+
+log = init_logger()
+
+
+class AggregateState(object):
+    """
+    The known state of an aggregate: its free space as last read from
+    the storage system, less what has been reserved since.
+    """
+
+    def __init__(self, name, node, bytes_available):
+        self.name = name
+        self.node = node
+        self.bytes_available = bytes_available
+        self.reserved_bytes = 0
+        self.reservations = 0
+
+    @property
+    def free_bytes(self):
+        return self.bytes_available - self.reserved_bytes
+
+    def __repr__(self):
+        return "{}({}, node={}, free={})".format(
+            type(self).__name__, self.name, self.node, self.free_bytes)
+
+
+def most_free(candidates, size_bytes):
+    """
+    Pick the aggregate with the most free space.
+    """
+    return max(candidates, key=lambda a: a.free_bytes)
+
+
+def best_fit(candidates, size_bytes):
+    """
+    Pick the aggregate with the least free space that still fits the
+    volume, keeping the large free areas for large volumes.
+    """
+    return min(candidates, key=lambda a: a.free_bytes - size_bytes)
+
+
+def spread(candidates, size_bytes):
+    """
+    Pick an aggregate on the node with the fewest placements since the
+    aggregates were last read, then the one with the most free space on
+    that node. Aggregates on unknown nodes count as nodes of their own.
+    """
+    placements = {}  # type: Dict[str, int]
+    for aggregate in candidates:
+        node = aggregate.node or aggregate.name
+        placements[node] = placements.get(node, 0) + aggregate.reservations
+
+    return min(candidates,
+               key=lambda a: (placements[a.node or a.name], -a.free_bytes))
+
+
+PLACEMENT_STRATEGIES = {
+    'most_free': most_free,
+    'best_fit': best_fit,
+    'spread': spread,
+}
+
+
+class AggregatePlacement(object):
+    """
+    Choose aggregates for new volumes with a placement strategy,
+    accounting for the volumes being created.
+
+    load() must return an iterable of aggregates as returned by
+    netapp.api.Server.aggregates, and is called when choosing an
+    aggregate at most every ttl_s seconds. Aggregates whose name matches
+    the regular expression exclude are never chosen.
+
+    Raises ValueError on unknown strategies.
+    """
+
+    def __init__(self, load, ttl_s=60, strategy='most_free', exclude=None):
+        self._load = load
+        self.ttl_s = float(ttl_s)
+        self.exclude = exclude
+        self.strategy = self._strategy(strategy)
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._aggregates = None  # type: Optional[Dict[str, AggregateState]]
+        self._loaded_at = None  # type: Optional[float]
+        # Reservations whose volume was created, but might not be
+        # accounted for in the free space of the aggregates yet, with
+        # the time they were committed at, oldest first
+        self._committed = []  # type: List[tuple]
+        # Reservations of volumes still being created
+        self._pending = []  # type: List[tuple]
+
+    @staticmethod
+    def _strategy(strategy):
+        if callable(strategy):
+            return strategy
+        try:
+            return PLACEMENT_STRATEGIES[strategy]
+        except KeyError:
+            raise ValueError("Unknown placement strategy: {}. Allowed"
+                             " values are: {}"
+                             .format(strategy,
+                                     ", ".join(sorted(PLACEMENT_STRATEGIES))))
+
+    @property
+    def fresh(self):
+        loaded_at = self._loaded_at
+        return (loaded_at is not None
+                and time.monotonic() - loaded_at < self.ttl_s)
+
+    def refresh(self):
+        """
+        Re-read the aggregates. Reservations of volumes that have been
+        created since the last read are dropped, as their space is now
+        accounted for by the storage system.
+        """
+        started = time.monotonic()
+        aggregates = {}
+        for aggregate in self._load():
+            if self.exclude and self.exclude.match(aggregate.name):
+                continue
+            node_names = aggregate.node_names or [None]
+            aggregates[aggregate.name] = AggregateState(
+                name=aggregate.name,
+                node=node_names[0],
+                bytes_available=aggregate.bytes_available or 0)
+
+        with self._lock:
+            # Reservations committed while we were reading may or may
+            # not be accounted for, so assume they are not
+            self._committed = [c for c in self._committed
+                               if c[2] >= started]
+            for aggregate_name, size_bytes in (
+                    [c[:2] for c in self._committed] + self._pending):
+                if aggregate_name in aggregates:
+                    aggregates[aggregate_name].reserved_bytes += size_bytes
+                    aggregates[aggregate_name].reservations += 1
+            self._aggregates = aggregates
+            self._loaded_at = time.monotonic()
+
+    def _expire_committed(self, now):
+        """
+        Drop the committed reservations older than ttl_s, which the next
+        read of the aggregates accounts for, so that they do not pile up
+        when aggregates are never read, e.g. if all volumes are created
+        on a given aggregate. Must be called with the lock held.
+        """
+        expired = 0
+        while (expired < len(self._committed)
+               and self._committed[expired][2] < now - self.ttl_s):
+            expired += 1
+        del self._committed[:expired]
+
+    def invalidate(self):
+        """
+        Force a re-read on the next placement.
+        """
+        self._loaded_at = None
+
+    def aggregates(self):
+        """
+        Return a list of the states of all candidate aggregates,
+        reading them if necessary.
+        """
+        if not self.fresh:
+            with self._load_lock:
+                if not self.fresh:
+                    self.refresh()
+
+        with self._lock:
+            return list(self._aggregates.values())
+
+    def _choose(self, size_bytes, strategy):
+        candidates = list(self._aggregates.values())
+        if not candidates:
+            raise ValueError("Could not find a suitable aggregate!")
+
+        fitting = [a for a in candidates if a.free_bytes >= size_bytes]
+        if not fitting:
+            log.warning("No aggregate seems to have room for {} bytes,"
+                        " trying the one with the most free space"
+                        .format(size_bytes))
+            return most_free(candidates, size_bytes)
+
+        return strategy(fitting, size_bytes)
+
+    @contextmanager
+    def reserve(self, size_bytes, aggregate_name=None, strategy=None):
+        """
+        Context manager choosing an aggregate for a volume of size_bytes
+        (unless given one) and reserving the space on it for as long as
+        the volume is being created, i.e. until the end of the block.
+
+        The chosen aggregate name is the target of the with-statement.
+        If the block raises an exception, the reservation is cancelled.
+
+        Raises:
+            ValueError: if there are no aggregates to choose from, or
+                the strategy is unknown
+        """
+        size_bytes = int(size_bytes)
+        if strategy is None:
+            strategy = self.strategy
+        else:
+            strategy = self._strategy(strategy)
+
+        if aggregate_name is None:
+            self.aggregates()
+
+        with self._lock:
+            if aggregate_name is None:
+                aggregate_name = self._choose(size_bytes, strategy).name
+                log.info("Placing {} bytes on aggregate {}"
+                         .format(size_bytes, aggregate_name))
+
+            reservation = (aggregate_name, size_bytes)
+            self._pending.append(reservation)
+            aggregate = (self._aggregates or {}).get(aggregate_name)
+            if aggregate is not None:
+                aggregate.reserved_bytes += size_bytes
+                aggregate.reservations += 1
+
+        try:
+            yield aggregate_name
+        except Exception:
+            with self._lock:
+                self._pending.remove(reservation)
+                aggregate = (self._aggregates or {}).get(aggregate_name)
+                if aggregate is not None:
+                    aggregate.reserved_bytes -= size_bytes
+                    aggregate.reservations -= 1
+            raise
+        else:
+            with self._lock:
+                self._pending.remove(reservation)
+                now = time.monotonic()
+                self._committed.append(reservation + (now,))
+                self._expire_committed(now)
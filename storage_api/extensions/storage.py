@@ -15,23 +15,53 @@ In general, methods are expected to raise KeyErrors on 404-type errors
 cases, reasonable descriptions of what went wrong should be included,
 and -- if possible -- suggestions on how to fix the situation.
 """
-from storage_api.utils import merge_two_dicts
+from storage_api.utils import merge_two_dicts, to_bool
+from storage_api.extensions.cache import (PeriodicRefresh, VolumeNameIndex,
+                                          VolumeInventory, SnapshotCache,
+                                          PolicyRuleIndex, ReadWriteLock,
+                                          rule_network, network_contains)
+from storage_api.extensions.zapi import (PooledServer, bind_current_trace,
+                                         traced)
+from storage_api.extensions.placement import AggregatePlacement
+from storage_api.extensions.aio import EventLoopThread
+from storage_api.extensions import metrics
 
 from abc import ABCMeta, abstractmethod
+import asyncio
+import copy
 from storage_api.utils import init_logger
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import functools
-from typing import Dict, Any
+import itertools
+import operator
+import threading
+from typing import Dict, Any, List
 import re
+from collections import OrderedDict
 from datetime import datetime
 
 from ordered_set import OrderedSet
 import cerberus
 import flask
 import netapp.api
+import pytz
 
 log = init_logger()
 
+AGGR0_RE = re.compile("^aggr0.*")
+ZAPI_QUERY_OPERATORS = "*|!<>="
+ZAPI_QUERY_OPERATORS_RE = re.compile("[{}]".format(re.escape(
+    ZAPI_QUERY_OPERATORS)))
+# How many values normalised_with(..., lazy=True) validates at a time
+LAZY_BATCH_SIZE = 64
+
+VALIDATION_SECONDS = metrics.histogram(
+    'sapi_validation_duration_seconds',
+    "Time spent validating and normalising the return values of the"
+    " back-ends, by schema, per value or batch of values",
+    ['schema'])
+
 SCHEMAS = [
     ('volume', {
         'name': {'type': 'string', 'minlength': 1,
@@ -96,19 +126,102 @@ def validate_value(v: cerberus.Validator, value: Dict[str, Any]):
     if not validation_result:
         raise ValidationError(v.errors)  # pragma: no cover
     else:
-        return v.normalized(value)
+        # validate() has already normalised the document, no need to do
+        # it all over again with v.normalized()
+        return v.document
+
+
+def validate_values(v: cerberus.Validator, values: List[Dict[str, Any]]):
+    """
+    Validate and normalise a list of values in one go, using a validator
+    from cached_validator(..., as_list=True).
+    """
+    return validate_value(v, {'items': values})['items']
+
+
+_validators = threading.local()
+
+
+def cached_validator(schema_name: str,
+                     allow_unknown: bool = False,
+                     ignore_none_values: bool = False,
+                     as_list: bool = False) -> cerberus.Validator:
+    """
+    Return a validator for the schema schema_name from the registry,
+    building it only on the first call with a given set of arguments.
+
+    Validators keep the state of the last validation, so they are
+    cached per thread rather than shared.
+
+    If as_list is True, the validator validates a dictionary with a
+    list of values under the key 'items', which is a lot faster than
+    validating each value on its own. See validate_values().
+    """
+    cache = getattr(_validators, 'cache', None)
+    if cache is None:
+        cache = _validators.cache = {}
+
+    key = (schema_name, allow_unknown, ignore_none_values, as_list)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+
+    schema = cerberus.schema_registry.get(name=schema_name)
+    if as_list:
+        schema = {'items': {'type': 'list',
+                            'schema': {'type': 'dict',
+                                       'schema': schema,
+                                       'allow_unknown': allow_unknown}}}
+
+    v = cerberus.Validator(schema,
+                           allow_unknown=allow_unknown,
+                           ignore_none_values=ignore_none_values)
+    cache[key] = v
+    return v
+
+
+def timed_validation(schema_name: str, validate, v: cerberus.Validator,
+                     value):
+    """
+    Return validate(v, value), observing how long it takes in
+    VALIDATION_SECONDS.
+    """
+    with VALIDATION_SECONDS.time(schema_name):
+        return validate(v, value)
+
+
+def chunked(iterable, size):
+    """
+    Produce lists of at most size items from iterable, as it is
+    consumed.
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def normalised_with(schema_name: str,
                     allow_unknown: bool = False,
                     ignore_none_values: bool = False,
-                    as_list: bool = False):
+                    as_list: bool = False,
+                    lazy: bool = False):
     """
     A decorator to normalise and validate the return values of a
     function according to a schema.
 
-    If as_list is True, validate and normalise each entry in the
-    returned list.
+    If as_list is True, validate and normalise the returned list in
+    one batch. If lazy is also True, the function may return any
+    iterable, and a generator validating the entries in batches of
+    LAZY_BATCH_SIZE as they are consumed is returned instead of a list.
+
+    If the decorated function is a method of an object with a true
+    `trusted` attribute (see StorageBackend.trusted), its return values
+    are passed through as they are, without validation or
+    normalisation.
 
     Raises a ValidationError if the schema was not correctly validated.
     """
@@ -116,31 +229,73 @@ def normalised_with(schema_name: str,
     def validator_decorator(func):
         @functools.wraps(func)
         def inner_wrapper(*args, **kwargs):
-            schema = cerberus.schema_registry.get(name=schema_name)
-            v = cerberus.Validator(schema,
-                                   allow_unknown=allow_unknown,
-                                   ignore_none_values=ignore_none_values)
             return_value = func(*args, **kwargs)
+            trusted = bool(args) and getattr(args[0], 'trusted', False)
 
             if as_list:
                 if isinstance(return_value, str):
                     raise ValidationError("Expected a list!")
+                if trusted:
+                    return return_value if lazy else list(return_value)
+
+                v = cached_validator(schema_name,
+                                     allow_unknown=allow_unknown,
+                                     ignore_none_values=ignore_none_values,
+                                     as_list=True)
+                if lazy:
+                    return (x
+                            for chunk in chunked(return_value,
+                                                 LAZY_BATCH_SIZE)
+                            for x in timed_validation(schema_name,
+                                                      validate_values,
+                                                      v, chunk))
                 try:
-                    return [validate_value(v, x) for x in return_value]
+                    return timed_validation(schema_name, validate_values,
+                                            v, list(return_value))
                 except TypeError:  # pragma: no cover
                     raise ValidationError("Expected a list!")
             else:
                 # if function called with decorator returns None do not
                 # validate since cerberus dislikes empty document
-                if return_value is not None:
-                    return validate_value(v, return_value)
-                else:
-                    return None
+                if return_value is None or trusted:
+                    return return_value
+
+                v = cached_validator(schema_name,
+                                     allow_unknown=allow_unknown,
+                                     ignore_none_values=ignore_none_values)
+                return timed_validation(schema_name, validate_value, v,
+                                        return_value)
 
         return inner_wrapper
+
     return validator_decorator
 
 
+VOLUME_FILTERS = ['aggregate_name', 'state', 'filer_address', 'name_prefix']
+
+
+def volume_matches(volume, **filters):
+    """
+    Return True if the volume matches all filters, as passed to
+    StorageBackend.filter_volumes().
+    """
+    for key, value in filters.items():
+        if key == 'name_prefix':
+            if not volume['name'].startswith(value):
+                return False
+        elif volume.get(key, None) != value:
+            return False
+    return True
+
+
+def raise_on_unknown_filters(filters):
+    unknown = set(filters) - set(VOLUME_FILTERS)
+    if unknown:
+        raise ValueError("Unknown volume filter(s): {}. Allowed values are: {}"
+                         .format(", ".join(sorted(unknown)),
+                                 ", ".join(VOLUME_FILTERS)))
+
+
 def patch_and_diff(previous, new):
     """
     Replace all keys in previous with their values in new, returning a
@@ -158,6 +313,77 @@ def patch_and_diff(previous, new):
     return changed_keys, previous
 
 
+def unpack_snapshot(snapshot_info):
+    """
+    Turn a snapshot-info element into a netapp.api.Snapshot, the way
+    netapp.api.Server.snapshots_of() does.
+    """
+    return netapp.api.Snapshot(
+        name=netapp.api._child_get_string(snapshot_info, 'name'),
+        creation_time=datetime.fromtimestamp(
+            netapp.api._child_get_int(snapshot_info, 'access-time'),
+            pytz.timezone(netapp.api.LOCAL_TIMEZONE)),
+        size_kbytes=netapp.api._child_get_int(snapshot_info, 'total'))
+
+
+def snapshot_key(volume_name, snapshot_name):
+    return "{}/{}".format(volume_name, snapshot_name)
+
+
+def lock_item(volume_name, hosts):
+    """
+    The change feed item of the locks on a volume, where hosts is the
+    return value of StorageBackend.locks().
+    """
+    if isinstance(hosts, str):
+        hosts = [hosts]
+    return {'volume_name': volume_name, 'hosts': sorted(hosts)}
+
+
+def format_snapshot(snapshot):
+    return {'name': snapshot.name,
+            'size_kbytes': snapshot.size_kbytes,
+            'creation_time': snapshot.creation_time}
+
+
+def apply_setting(steps):
+    """
+    Take the (fields, call) steps of a setting in order, stopping at the
+    first failure. Returns a tuple of the fields applied and a dict of
+    the fields that failed with their error messages.
+    """
+    applied = []
+    failed = {}  # type: Dict[str, str]
+    for fields, call in steps:
+        if failed:
+            failed.update((field, "Not attempted after an earlier failure")
+                          for field in fields)
+            continue
+        try:
+            call()
+        except netapp.api.APIError as e:
+            failed.update((field, e.msg) for field in fields)
+        except Exception as e:
+            log.warning("Failed to apply {}: {}".format(", ".join(fields), e))
+            failed.update((field, str(e)) for field in fields)
+        else:
+            applied.extend(fields)
+    return applied, failed
+
+
+def merge_setting_results(results):
+    """
+    Merge the results of apply_setting() into a report, as returned by
+    patch_volume().
+    """
+    report = {'applied': [], 'failed': {}}
+    for applied, failed in results:
+        report['applied'].extend(applied)
+        report['failed'].update(failed)
+    report['applied'].sort()
+    return report
+
+
 @contextmanager
 def annotate_exception(exception, annotation):
     """
@@ -178,6 +404,12 @@ def annotate_exception(exception, annotation):
 
 class StorageBackend(metaclass=ABCMeta):
 
+    # If True, the return values of methods decorated with
+    # normalised_with are passed through without validation or
+    # normalisation. Only set this for back-ends whose data is known to
+    # be well formed already.
+    trusted = False
+
     def __repr__(self):
         return "{}({})".format(type(self).__name__, str(self.__dict__))
 
@@ -192,6 +424,37 @@ class StorageBackend(metaclass=ABCMeta):
         """
         return NotImplemented
 
+    def filter_volumes(self, **filters):
+        """
+        Return the volumes (as in volumes) matching all of the given
+        filters. Filters whose value is None are ignored.
+
+        The following filters are supported:
+
+        - aggregate_name, state, filer_address: exact match on that key
+        - name_prefix: the volume name starts with the given string
+
+        Back-ends that can do the filtering closer to the storage system
+        are encouraged to override this.
+
+        Raises:
+            ValueError: on unknown filters
+        """
+        filters = {k: v for k, v in filters.items() if v is not None}
+        raise_on_unknown_filters(filters)
+        return [v for v in self.volumes if volume_matches(v, **filters)]
+
+    def iter_volumes(self, **filters):
+        """
+        Like filter_volumes(), but return an iterator. Back-ends that
+        can produce volumes one by one from the storage system should
+        override this, so that callers can stream them.
+
+        Invalid filters must raise ValueError immediately, and not when
+        the iterator is first consumed.
+        """
+        return iter(self.filter_volumes(**filters))
+
     @abstractmethod
     def get_volume(self, volume_name):
         """
@@ -231,6 +494,12 @@ class StorageBackend(metaclass=ABCMeta):
         """
         Update a volume with data from **data.
 
+        Returns:
+            A report of the update, as a dictionary of the `applied`
+            and `unchanged` fields (lists of their names) and the
+            `failed` ones (a dictionary of their names to what went
+            wrong).
+
         Raises:
             ValueError: on poorly formatted data, or invalid data
                 entries/attempts to write to read-only fields
@@ -314,6 +583,40 @@ class StorageBackend(metaclass=ABCMeta):
         """
         return NotImplemented
 
+    def iter_policies(self):
+        """
+        Like policies, but return an iterator. See iter_volumes().
+        """
+        return iter(self.policies)
+
+    def policies_granting(self, network):
+        """
+        Return an iterable of the export policies (as in policies) with
+        a rule matching all of network, an ipaddress network, e.g. the
+        policies granting access to an address or to all of a subnet.
+
+        Rules that are not addresses or networks, such as host names,
+        never match.
+
+        The default implementation scans all policies.
+        """
+        return (p for p in self.iter_policies()
+                if any(network_contains(n, network)
+                       for n in map(rule_network, p['rules'])
+                       if n is not None))
+
+    def volumes_accessible_from(self, network):
+        """
+        Return an iterable of the volumes (as in volumes) whose active
+        export policy grants access to all of network, an ipaddress
+        network (see policies_granting()).
+
+        The default implementation goes through all volumes.
+        """
+        policy_names = {p['name'] for p in self.policies_granting(network)}
+        return (v for v in self.iter_volumes()
+                if v.get('active_policy_name') in policy_names)
+
     @abstractmethod
     def get_policy(self, policy_name):
         """
@@ -418,6 +721,17 @@ class StorageBackend(metaclass=ABCMeta):
         """
         return NotImplemented
 
+    def iter_snapshots(self, volume_name):
+        """
+        Like get_snapshots(), but return an iterator. See
+        iter_volumes().
+
+        Raises:
+            KeyError: if no such volume exists. This may happen either
+                immediately or when the iterator is first consumed.
+        """
+        return iter(self.get_snapshots(volume_name))
+
     @abstractmethod
     def rollback_volume(self, volume_name, restore_snapshot_name):
         """
@@ -455,6 +769,50 @@ class StorageBackend(metaclass=ABCMeta):
 
         return NotImplemented
 
+    def connection_stats(self):
+        """
+        Return a dictionary of statistics about the connections of the
+        back-end to its storage system, or None if it has none.
+        """
+        return None
+
+    def scan_state(self):
+        """
+        Return the current state of everything the change feed follows
+        (see storage_api.extensions.changefeed), as a dictionary of
+        kind -> key -> item with the following kinds:
+
+        - volume: volumes (as in volumes) by name
+        - snapshot: snapshots (as in get_snapshots()) by
+          "volume_name/snapshot_name", with an added volume_name
+        - lock: {'volume_name': ..., 'hosts': [...]} by volume name,
+          for locked volumes only
+        - policy: export policies (as in policies) by name
+
+        The items are compared with those of later scans, so they must
+        not be modified afterwards by the back-end.
+
+        The default implementation asks for the snapshots and locks of
+        every volume in turn, back-ends that can do better should.
+        """
+        volumes = OrderedDict((v['name'], dict(v)) for v in self.volumes)
+        snapshots = OrderedDict()
+        locks = OrderedDict()
+        for volume_name in volumes:
+            for snapshot in self.get_snapshots(volume_name):
+                snapshots[snapshot_key(volume_name, snapshot['name'])] = (
+                    merge_two_dicts(snapshot, {'volume_name': volume_name}))
+            hosts = self.locks(volume_name)
+            if hosts:
+                locks[volume_name] = lock_item(volume_name, hosts)
+
+        return {'volume': volumes,
+                'snapshot': snapshots,
+                'lock': locks,
+                'policy': OrderedDict((p['name'], {'name': p['name'],
+                                                   'rules': list(p['rules'])})
+                                      for p in self.policies)}
+
     def init_app(self, app: flask.Flask, endpoint):
         """
         Initialise a Flask app context with the storage system.
@@ -482,20 +840,143 @@ class StorageBackend(metaclass=ABCMeta):
         app.config['SUBSYSTEM'][endpoint] = instance_id
 
 
+# Volume fields kept in the slots of a VolumeRecord, the others go in
+# its extra dictionary
+VOLUME_FIELDS = ('name', 'uuid', 'active_policy_name', 'junction_path',
+                 'aggregate_name', 'state', 'size_used', 'size_total',
+                 'filer_address', 'creation_time', 'compression_enabled',
+                 'inline_compression', 'percentage_snapshot_reserve',
+                 'percentage_snapshot_reserve_used', 'caching_policy',
+                 'autosize_enabled', 'max_autosize')
+_VOLUME_FIELD_SET = frozenset(VOLUME_FIELDS)
+# Volume fields DummyStorage can look volumes up by
+INDEXED_VOLUME_FIELDS = ('active_policy_name', 'aggregate_name',
+                         'filer_address')
+# The value of the fields of a VolumeRecord that were never set
+_UNSET = object()
+
+
+class VolumeRecord(object):
+    """
+    A volume as stored by DummyStorage, taking a fraction of the memory
+    of a dictionary. seq orders the volumes by creation.
+    """
+    __slots__ = VOLUME_FIELDS + ('extra', 'seq')
+    _values = operator.attrgetter(*VOLUME_FIELDS)
+
+    def __init__(self, seq, fields):
+        self.seq = seq
+        self.extra = None
+        for field in VOLUME_FIELDS:
+            setattr(self, field, _UNSET)
+        self.update(fields)
+
+    def get(self, field, default=None):
+        if field in _VOLUME_FIELD_SET:
+            value = getattr(self, field)
+            return default if value is _UNSET else value
+        return self.extra.get(field, default) if self.extra else default
+
+    def update(self, fields):
+        for field, value in fields.items():
+            if field in _VOLUME_FIELD_SET:
+                setattr(self, field, value)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[field] = value
+
+    def as_dict(self):
+        """
+        Return the fields of the volume as a new dictionary.
+        """
+        volume = {field: value for field, value
+                  in zip(VOLUME_FIELDS, self._values(self))
+                  if value is not _UNSET}
+        if self.extra:
+            volume.update(self.extra)
+        return volume
+
+
+class SnapshotRecord(object):
+    """
+    A snapshot as stored by DummyStorage.
+    """
+    __slots__ = ('name', 'size_kbytes', 'creation_time')
+
+    def __init__(self, name, size_kbytes, creation_time):
+        self.name = name
+        self.size_kbytes = size_kbytes
+        self.creation_time = creation_time
+
+    def as_dict(self):
+        return {'name': self.name,
+                'size_kbytes': self.size_kbytes,
+                'creation_time': self.creation_time}
+
+
+class VolumeFieldIndex(object):
+    """
+    The names of the volumes of a DummyStorage by their value of field,
+    for volumes where it is set. Not thread-safe on its own: it must be
+    used under the lock of its DummyStorage.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self._names = {}  # type: Dict[Any, set]
+
+    def add(self, volume_name, record):
+        value = record.get(self.field)
+        if value is not None:
+            self._names.setdefault(value, set()).add(volume_name)
+
+    def discard(self, volume_name, record):
+        value = record.get(self.field)
+        names = self._names.get(value)
+        if names is not None:
+            names.discard(volume_name)
+            if not names:
+                del self._names[value]
+
+    def names(self, value):
+        """
+        Return a copy of the names of the volumes with value, which stays
+        the same when the index changes.
+        """
+        return frozenset(self._names.get(value, ()))
+
+
 class DummyStorage(StorageBackend):
     """
     This is a dummy storage back-end meant for testing. It will persist
     data given to it in RAM and follow the standard API provided by the
     base class above, but that is about it.
+
+    It is safe to use from several threads: readers share a
+    ReadWriteLock, and get copies of what is stored. Volumes are kept
+    as VolumeRecords, indexed by INDEXED_VOLUME_FIELDS for
+    filter_volumes() and volumes_accessible_from().
     """
 
+    def _raise_if_volume_absent(self, volume_name):
+        if volume_name not in self._records:
+            raise KeyError(vol_404(volume_name))
+
+    def _raise_if_snapshot_absent(self, volume_name, snapshot_name):
+        self._raise_if_volume_absent(volume_name)
+
+        if snapshot_name not in self._snapshots[volume_name]:
+            raise KeyError("No such snapshot exists for volume '{}': '{}'"
+                           .format(volume_name, snapshot_name))
+
     def raise_if_volume_absent(self, volume_name: str):
         """
         Raise a `KeyError` with an appropriate message if a volume is
         absent.
         """
-        if volume_name not in self.vols:
-            raise KeyError(vol_404(volume_name))
+        with self._lock.reading():
+            self._raise_if_volume_absent(volume_name)
 
     def raise_if_snapshot_absent(self, volume_name: str, snapshot_name: str):
         """
@@ -504,56 +985,148 @@ class DummyStorage(StorageBackend):
 
         This implies first running `raise_if_volume absent(volume_name)`.
         """
-        self.raise_if_volume_absent(volume_name)
+        with self._lock.reading():
+            self._raise_if_snapshot_absent(volume_name, snapshot_name)
+
+    def __init__(self, trusted=False):
+        self.trusted = to_bool(trusted)
+        self._lock = ReadWriteLock()
+        self._records = OrderedDict()  # type: Dict[str, VolumeRecord]
+        # volume name -> snapshot name -> snapshot
+        self._snapshots = {}  # type: Dict[str, Dict[str, SnapshotRecord]]
+        self._locks = {}  # type: Dict[str, str]
+        self._policies = OrderedDict()  # type: Dict[str, List[str]]
+        self._indexes = {field: VolumeFieldIndex(field)
+                         for field in INDEXED_VOLUME_FIELDS}
+        self._seq = itertools.count()
+
+    def _add_volume(self, volume_name, fields):
+        record = VolumeRecord(next(self._seq), fields)
+        self._records[volume_name] = record
+        self._snapshots[volume_name] = OrderedDict()
+        self._locks.pop(volume_name, None)
+        for index in self._indexes.values():
+            index.add(volume_name, record)
+        return record
+
+    def _update_volume(self, volume_name, fields):
+        record = self._records[volume_name]
+        for index in self._indexes.values():
+            index.discard(volume_name, record)
+        record.update(fields)
+        for index in self._indexes.values():
+            index.add(volume_name, record)
+
+    def _remove_volume(self, volume_name):
+        record = self._records.pop(volume_name)
+        for index in self._indexes.values():
+            index.discard(volume_name, record)
+        self._locks.pop(volume_name, None)
+        self._snapshots.pop(volume_name, None)
+
+    def _indexed_volumes(self, names):
+        return [self._records[name].as_dict()
+                for name in sorted(names, key=lambda n: self._records[n].seq)]
+
+    def load(self, volumes, snapshots=None, policies=None, locks=None):
+        """
+        Store volumes (name -> volume), their snapshots (volume name ->
+        snapshot name -> snapshot), export policies (name -> rules) and
+        locks (volume name -> host) in one go, e.g. to fill the back-end
+        for benchmarks, replacing any volumes and policies with the same
+        names.
+        """
+        with self._lock.writing():
+            for volume_name, volume in volumes.items():
+                if volume_name in self._records:
+                    self._remove_volume(volume_name)
+                self._add_volume(volume_name, volume)
+            for volume_name, volume_snapshots in (snapshots or {}).items():
+                self._raise_if_volume_absent(volume_name)
+                self._snapshots[volume_name].update(
+                    (name, SnapshotRecord(s['name'], s['size_kbytes'],
+                                          s['creation_time']))
+                    for name, s in volume_snapshots.items())
+            for policy_name, rules in (policies or {}).items():
+                self._policies[policy_name] = list(rules)
+            for volume_name, host in (locks or {}).items():
+                self._raise_if_volume_absent(volume_name)
+                self._locks[volume_name] = host
 
-        if snapshot_name not in self.snapshots_store[volume_name]:
-            raise KeyError("No such snapshot exists for volume '{}': '{}'"
-                           .format(volume_name, snapshot_name))
+    @normalised_with('volume', as_list=True)
+    def _normalised_volumes(self, volumes):
+        return volumes
 
-    def __init__(self):
-        self.vols = {}  # type: Dict[str, Dict[str, Any]]
-        self.locks_store = {}  # type: Dict[str, str]
-        self.rules_store = {}  # type: Dict[str, str]
-        self.snapshots_store = {}  # Dict[str, Dict[str, List[str]]]
-        self.policies_store = {}  # Dict[str, List[str]]
+    @normalised_with('snapshot', as_list=True)
+    def _normalised_snapshots(self, snapshots):
+        return snapshots
 
     @property
     def volumes(self):
-        return self._volumes()
+        with self._lock.reading():
+            volumes = [r.as_dict() for r in self._records.values()]
+        return self._normalised_volumes(volumes)
 
-    @normalised_with('volume', as_list=True)
-    def _volumes(self):
-        return list(self.vols.values())
+    def filter_volumes(self, **filters):
+        """
+        Like StorageBackend.filter_volumes(), only going through the
+        volumes of the most selective index of the given filters, if
+        any.
+        """
+        filters = {k: v for k, v in filters.items() if v is not None}
+        raise_on_unknown_filters(filters)
+
+        with self._lock.reading():
+            indexed = [self._indexes[field].names(filters[field])
+                       for field in INDEXED_VOLUME_FIELDS if field in filters]
+            if indexed:
+                volumes = self._indexed_volumes(min(indexed, key=len))
+            else:
+                volumes = [r.as_dict() for r in self._records.values()]
+        return self._normalised_volumes([v for v in volumes
+                                         if volume_matches(v, **filters)])
+
+    def volumes_accessible_from(self, network):
+        policy_names = [p['name'] for p in self.policies_granting(network)]
+        with self._lock.reading():
+            index = self._indexes['active_policy_name']
+            volumes = self._indexed_volumes(
+                set().union(*[index.names(name) for name in policy_names]))
+        return self._normalised_volumes(volumes)
 
     @normalised_with('volume', allow_unknown=True)
     def get_volume(self, volume_name):
         log.info("Trying to get volume {}".format(volume_name))
-        with annotate_exception(KeyError, vol_404(volume_name)):
-            return self.vols[volume_name]
+        with self._lock.reading():
+            with annotate_exception(KeyError, vol_404(volume_name)):
+                return self._records[volume_name].as_dict()
 
     @normalised_with('volume', ignore_none_values=True)
     def restrict_volume(self, volume_name):
         log.info("Restricting volume {}".format(volume_name))
-        with annotate_exception(KeyError, vol_404(volume_name)):
-            self.vols.pop(volume_name)
-        self.locks_store.pop(volume_name, None)
-        self.rules_store.pop(volume_name, None)
-        self.snapshots_store.pop(volume_name, None)
+        with self._lock.writing():
+            with annotate_exception(KeyError, vol_404(volume_name)):
+                self._remove_volume(volume_name)
 
     def patch_volume(self, volume_name, **data):
         log.info("Updating volume {} with data {}"
                  .format(volume_name, data))
-        for key in data:
+        with self._lock.writing():
             with annotate_exception(KeyError, vol_404(volume_name)):
-                self.vols[volume_name][key] = data[key]
+                volume = self._records[volume_name].as_dict()
+            unchanged = [k for k in data
+                         if k in volume and volume[k] == data[k]]
+            changed_keys, _volume = patch_and_diff(volume, data)
+            self._update_volume(volume_name,
+                                {k: data[k] for k in changed_keys})
+        return {'applied': sorted(changed_keys),
+                'unchanged': sorted(unchanged),
+                'failed': {}}
 
     def create_volume(self, volume_name, **kwargs):
         log.info("Adding new volume '{}': {}"
                  .format(volume_name, str(kwargs)))
 
-        if volume_name in self.vols:
-            raise KeyError("Volume {} already exists!".format(volume_name))
-
         size_total = kwargs.get('size_total', None)
         filer_address = kwargs.get('filer_address', None)
 
@@ -563,99 +1136,111 @@ class DummyStorage(StorageBackend):
                 'filer_address':
                 "dummy-filer" if filer_address is None else filer_address}
 
-        self.vols[volume_name] = data
-        self.locks_store.pop(volume_name, None)
-        self.snapshots_store[volume_name] = {}
-        return self.vols[volume_name]
+        with self._lock.writing():
+            if volume_name in self._records:
+                raise KeyError("Volume {} already exists!"
+                               .format(volume_name))
+            return self._add_volume(volume_name, data).as_dict()
 
     def locks(self, volume_name):
-        self.raise_if_volume_absent(volume_name)
-
-        if volume_name not in self.locks_store:
-            return None
-        else:
-            return self.locks_store[volume_name]
+        with self._lock.reading():
+            self._raise_if_volume_absent(volume_name)
+            return self._locks.get(volume_name)
 
     def create_lock(self, volume_name, host_owner):
-        self.raise_if_volume_absent(volume_name)
-
         log.info("Host_Owner {} is locking {}".format(host_owner, volume_name))
-        if volume_name in self.locks_store and\
-           self.locks_store[volume_name] != host_owner:
-            raise ValueError("{} is already locked by {}!"
-                             .format(volume_name,
-                                     self.locks_store[volume_name]))
+        with self._lock.writing():
+            self._raise_if_volume_absent(volume_name)
+
+            if volume_name in self._locks and\
+               self._locks[volume_name] != host_owner:
+                raise ValueError("{} is already locked by {}!"
+                                 .format(volume_name,
+                                         self._locks[volume_name]))
 
-        self.locks_store[volume_name] = host_owner
+            self._locks[volume_name] = host_owner
 
     def remove_lock(self, volume_name, host_owner):
-        self.raise_if_volume_absent(volume_name)
+        with self._lock.writing():
+            self._raise_if_volume_absent(volume_name)
 
-        with annotate_exception(KeyError, vol_404(volume_name)):
-            if host_owner == self.locks_store[volume_name]:
-                self.locks_store.pop(volume_name)
+            with annotate_exception(KeyError, vol_404(volume_name)):
+                if host_owner == self._locks[volume_name]:
+                    self._locks.pop(volume_name)
 
     @property
     def policies(self):
-        return [{'name': name, 'rules': rules}
-                for name, rules in self.rules_store.items()]
+        with self._lock.reading():
+            return [{'name': name, 'rules': list(rules)}
+                    for name, rules in self._policies.items()]
 
     def get_policy(self, policy_name):
-        return self.rules_store[policy_name]
+        with self._lock.reading():
+            return list(self._policies[policy_name])
 
     def set_policy(self, volume_name, policy_name):
-        self.raise_if_volume_absent(volume_name)
-        if policy_name not in self.rules_store:
-            raise ValueError("No such policy: {}".format(policy_name))
+        with self._lock.writing():
+            self._raise_if_volume_absent(volume_name)
+            if policy_name not in self._policies:
+                raise ValueError("No such policy: {}".format(policy_name))
 
-        self.vols[volume_name]['active_policy_name'] = policy_name
+            self._update_volume(volume_name,
+                                {'active_policy_name': policy_name})
 
     def create_policy(self, policy_name, rules):
         log.info("Adding policy {} with rules {}"
                  .format(policy_name, rules))
-        self.rules_store[policy_name] = list(OrderedSet(rules))
+        with self._lock.writing():
+            self._policies[policy_name] = list(OrderedSet(rules))
 
     def remove_policy(self, policy_name):
         log.info("Removing policy {}"
                  .format(policy_name))
-        self.rules_store.pop(policy_name)
+        with self._lock.writing():
+            self._policies.pop(policy_name)
 
     def clone_volume(self, clone_volume_name,
                      from_volume_name, from_snapshot_name):
         log.info("Cloning volume {target} from {source}:{snapshot}"
                  .format(target=clone_volume_name, source=from_volume_name,
                          snapshot=from_snapshot_name))
-        self.raise_if_snapshot_absent(from_volume_name, from_snapshot_name)
+        with self._lock.writing():
+            self._raise_if_snapshot_absent(from_volume_name,
+                                           from_snapshot_name)
 
-        if clone_volume_name in self.vols:
-            raise ValueError("Name already in use!")
+            if clone_volume_name in self._records:
+                raise ValueError("Name already in use!")
 
-        with annotate_exception(KeyError, vol_404(from_volume_name)):
-            self.vols[clone_volume_name] = self.vols[from_volume_name]
+            volume = self._records[from_volume_name].as_dict()
+            volume['name'] = str(clone_volume_name)
+            self._add_volume(clone_volume_name, volume)
 
     def create_snapshot(self, volume_name, snapshot_name):
         log.info("Creating snapshot {}:{}".format(volume_name, snapshot_name))
-        with annotate_exception(KeyError, vol_404(volume_name)):
-            self.snapshots_store[volume_name][snapshot_name] = {
-                'name': snapshot_name,
-                'size_kbytes': 42,
-                'creation_time': datetime.now()}
+        with self._lock.writing():
+            with annotate_exception(KeyError, vol_404(volume_name)):
+                self._snapshots[volume_name][snapshot_name] = SnapshotRecord(
+                    snapshot_name, 42, datetime.now())
 
     def get_snapshot(self, volume_name, snapshot_name):
         log.info("Fetching snapshot {}:{}".format(volume_name, snapshot_name))
-        self.raise_if_snapshot_absent(volume_name, snapshot_name)
-        return self.snapshots_store[volume_name][snapshot_name]
+        with self._lock.reading():
+            self._raise_if_snapshot_absent(volume_name, snapshot_name)
+            return self._snapshots[volume_name][snapshot_name].as_dict()
 
     def delete_snapshot(self, volume_name, snapshot_name):
         log.info("Deleting {} on {}".format(snapshot_name, volume_name))
-        self.raise_if_snapshot_absent(volume_name, snapshot_name)
-        self.snapshots_store[volume_name].pop(snapshot_name)
+        with self._lock.writing():
+            self._raise_if_snapshot_absent(volume_name, snapshot_name)
+            self._snapshots[volume_name].pop(snapshot_name)
 
-    @normalised_with('snapshot', as_list=True)
     def get_snapshots(self, volume_name):
         log.info("Getting snapshots for {}".format(volume_name))
-        self.raise_if_volume_absent(volume_name)
-        return list(self.snapshots_store[volume_name].values())
+        with self._lock.reading():
+            self._raise_if_volume_absent(volume_name)
+            snapshots = [s.as_dict()
+                         for s in self._snapshots[volume_name].values()]
+        return self._normalised_snapshots(snapshots)
 
     def rollback_volume(self, volume_name, restore_snapshot_name):
         log.info("Restoring '{}' to '{}'"
@@ -663,13 +1248,44 @@ class DummyStorage(StorageBackend):
         self.raise_if_snapshot_absent(volume_name, restore_snapshot_name)
 
     def ensure_policy_rule_present(self, policy_name, rule):
-        if rule not in self.rules_store[policy_name]:
-            self.rules_store[policy_name].append(rule)
+        with self._lock.writing():
+            rules = self._policies[policy_name]
+            if rule not in rules:
+                rules.append(rule)
 
     def ensure_policy_rule_absent(self, policy_name, rule):
-        stored_rules = self.rules_store[policy_name]
-        self.rules_store[policy_name] = list(filter(
-            lambda x: x != rule, stored_rules))
+        with self._lock.writing():
+            self._policies[policy_name] = [
+                r for r in self._policies[policy_name] if r != rule]
+
+    def scan_state(self):
+        """
+        Like StorageBackend.scan_state(), but as of a single point in
+        time.
+        """
+        with self._lock.reading():
+            volumes = [r.as_dict() for r in self._records.values()]
+            snapshots = [(volume_name, s.as_dict())
+                         for volume_name in self._records
+                         for s in self._snapshots[volume_name].values()]
+            locks = [(volume_name, host)
+                     for volume_name, host in self._locks.items() if host]
+            policies = [(name, list(rules))
+                        for name, rules in self._policies.items()]
+
+        normalised = self._normalised_snapshots([s for _, s in snapshots])
+        return {
+            'volume': OrderedDict((v['name'], v)
+                                  for v in self._normalised_volumes(volumes)),
+            'snapshot': OrderedDict(
+                (snapshot_key(volume_name, snapshot['name']),
+                 merge_two_dicts(snapshot, {'volume_name': volume_name}))
+                for (volume_name, _), snapshot
+                in zip(snapshots, normalised)),
+            'lock': OrderedDict((volume_name, lock_item(volume_name, host))
+                                for volume_name, host in locks),
+            'policy': OrderedDict((name, {'name': name, 'rules': rules})
+                                  for name, rules in policies)}
 
 
 class NetappStorage(StorageBackend):
@@ -677,21 +1293,159 @@ class NetappStorage(StorageBackend):
     A Back-end for a NetApp storage system.
     """
 
-    def __init__(self, hostname, username, password, vserver, timeout_s=4):
+    def __init__(self, hostname, username, password, vserver, timeout_s=4,
+                 volume_index_refresh_s=300, inventory_ttl_s=30,
+                 inventory_refresh_s=20, inventory_idle_s=120,
+                 trusted=False, pool_size=4,
+                 max_connections=0, keep_alive=True, snapshot_cache_s=60,
+                 placement_strategy='most_free', aggregate_cache_s=60,
+                 policy_index_refresh_s=300, port=443, scheme='https',
+                 slow_call_s=2):
         """
-        Initialise a NetApp back-end
+        Initialise a NetApp back-end, talking ZAPI to `hostname` on
+        `port` over `scheme` (https, or http e.g. for
+        benchmarks/fakefiler.py)
+
+        The mapping between volume names and junction paths is cached
+        in `volume_index`, and fully re-read from the filer every
+        `volume_index_refresh_s` seconds (0 disables the re-reads;
+        the index is then only fed by lookups and our own writes).
+
+        The list of volumes is cached in `inventory` for
+        `inventory_ttl_s` seconds (0 disables the cache), and re-read
+        in the background every `inventory_refresh_s` seconds (0
+        disables the background re-reads) so that readers rarely have
+        to wait for the filer, until it has not been read for
+        `inventory_idle_s` seconds (0 for never).
+
+        New volumes not given an aggregate are placed by `placement`,
+        using `placement_strategy` (one of most_free, best_fit or
+        spread; see storage_api.extensions.placement) on the free
+        space of the aggregates as read at most every
+        `aggregate_cache_s` seconds.
+
+        The snapshots of recently listed volumes are cached in
+        `snapshot_cache` for `snapshot_cache_s` seconds (0 disables
+        the cache).
+
+        The rules of all export policies are kept in `policy_index`,
+        read on first use and re-read every `policy_index_refresh_s`
+        seconds (0 disables the re-reads) to pick up changes made
+        outside of the API.
+
+        If `trusted` is true, values read from the filer are not
+        validated against the schemas (see normalised_with).
+
+        Calls to the filer go through a pool of at most `pool_size`
+        kept-alive connections shared by all threads, with at most
+        `max_connections` calls in flight at a time (0 for no limit).
+        Calls taking longer than `slow_call_s` seconds are logged with
+        their arguments (0 disables the logging). See PooledServer.
         """
-
-        self.server = netapp.api.Server(hostname=hostname,
-                                        username=username,
-                                        password=password,
-                                        vserver=vserver,
-                                        timeout_s=int(timeout_s))
+        self.trusted = to_bool(trusted)
+
+        self.server = PooledServer(hostname=hostname,
+                                   username=username,
+                                   password=password,
+                                   vserver=vserver,
+                                   port=int(port),
+                                   scheme=scheme,
+                                   timeout_s=int(timeout_s),
+                                   pool_size=int(pool_size),
+                                   max_connections=int(max_connections),
+                                   keep_alive=to_bool(keep_alive),
+                                   slow_call_s=float(slow_call_s))
+        self.volume_index = VolumeNameIndex()
+        self._volume_index_refresh = PeriodicRefresh(
+            interval_s=float(volume_index_refresh_s),
+            func=self.refresh_volume_index,
+            name="volume-index-{}".format(vserver))
+        self.inventory = VolumeInventory(ttl_s=float(inventory_ttl_s),
+                                         load=self._load_volumes,
+                                         indexed=['active_policy_name'])
+        self._inventory_refresh = PeriodicRefresh(
+            interval_s=(float(inventory_refresh_s)
+                        if self.inventory.enabled else 0),
+            func=self.inventory.refresh,
+            name="volume-inventory-{}".format(vserver),
+            idle_s=float(inventory_idle_s))
+        self.snapshot_cache = SnapshotCache(ttl_s=float(snapshot_cache_s))
+        self.policy_index = PolicyRuleIndex(load=self._load_policies)
+        self._policy_index_refresh = PeriodicRefresh(
+            interval_s=float(policy_index_refresh_s),
+            func=self.policy_index.refresh,
+            name="policy-index-{}".format(vserver))
+        self.placement = AggregatePlacement(
+            load=lambda: self.server.aggregates,
+            ttl_s=float(aggregate_cache_s),
+            strategy=placement_strategy,
+            exclude=AGGR0_RE)
         import requests
 
         # FIXME: implement proper certificates, Miro!
         requests.packages.urllib3.disable_warnings()
 
+    def connection_stats(self):
+        return self.server.pool_stats()
+
+    def scan_state(self):
+        """
+        Volumes and policies come from the inventory and policy index,
+        and all snapshots and all locks are read in one call each.
+        """
+        volumes = OrderedDict((v['name'], v) for v in self.volumes)
+
+        X = netapp.api.X
+        snapshot_call = X('snapshot-get-iter',
+                          X('desired-attributes',
+                            X('snapshot-info',
+                              X('volume'),
+                              X('name'),
+                              X('access-time'),
+                              X('total'))))
+
+        def unpack_volume_snapshot(snapshot_info):
+            return (netapp.api._child_get_string(snapshot_info, 'volume'),
+                    format_snapshot(unpack_snapshot(snapshot_info)))
+
+        snapshots = OrderedDict()
+        for volume_name, snapshot in self.server._get_paginated(
+                snapshot_call,
+                endpoint='ONTAP',
+                constructor=unpack_volume_snapshot,
+                container_tag='attributes-list'):
+            if volume_name in volumes:
+                snapshot['volume_name'] = volume_name
+                snapshots[snapshot_key(volume_name,
+                                       snapshot['name'])] = snapshot
+
+        lock_call = X('lock-get-iter',
+                      X('desired-attributes',
+                        X('lock-info',
+                          X('volume'),
+                          X('client-address'))))
+
+        def unpack_lock(lock_info):
+            return (netapp.api._child_get_string(lock_info, 'volume'),
+                    netapp.api._child_get_string(lock_info,
+                                                 'client-address'))
+
+        hosts = OrderedDict()
+        for volume_name, host in self.server._get_paginated(
+                lock_call,
+                endpoint='ONTAP',
+                constructor=unpack_lock,
+                container_tag='attributes-list'):
+            if volume_name in volumes:
+                hosts.setdefault(volume_name, set()).add(host)
+
+        return {'volume': volumes,
+                'snapshot': snapshots,
+                'lock': OrderedDict((name, lock_item(name, volume_hosts))
+                                    for name, volume_hosts in hosts.items()),
+                'policy': OrderedDict((p['name'], p)
+                                      for p in self.iter_policies())}
+
     def format_volume(self, v):
         return merge_two_dicts(
             v.__dict__,
@@ -700,22 +1454,134 @@ class NetappStorage(StorageBackend):
              'filer_address': v.node_name,
              'aggregate_name': v.containing_aggregate_name})
 
-    def format_policy(self, p):
-        return {'name': p.name,
-                'rules': [r[1] for r in p.rules]}
+    def _export_rules(self):
+        """
+        Return a list of (policy name, rule index, rule) tuples for
+        the rules of all export policies, in a single call.
+        """
+        X = netapp.api.X
+        api_call = X('export-rule-get-iter',
+                     X('desired-attributes',
+                       X('export-rule-info',
+                         X('policy-name'),
+                         X('rule-index'),
+                         X('client-match'))))
+
+        def unpack_rule(export_rule_info):
+            return (netapp.api._child_get_string(export_rule_info,
+                                                 'policy-name'),
+                    netapp.api._child_get_int(export_rule_info,
+                                              'rule-index'),
+                    netapp.api._child_get_string(export_rule_info,
+                                                 'client-match'))
+
+        return list(self.server._get_paginated(
+            api_call,
+            endpoint='ONTAP',
+            constructor=unpack_rule,
+            container_tag='attributes-list'))
+
+    @staticmethod
+    def _group_rules(policy_names, export_rules):
+        # Policies without rules only show up in policy_names
+        rules = OrderedDict((name, []) for name in policy_names)
+        for policy_name, index, rule in export_rules:
+            rules.setdefault(policy_name, []).append((index, rule))
+
+        return [(name, [rule for _index, rule in sorted(policy_rules)])
+                for name, policy_rules in rules.items()]
+
+    def _load_policies(self):
+        """
+        Read the rules of every export policy for the policy index, in
+        two calls to the filer rather than one per policy.
+        """
+        return self._group_rules([p.name for p in self.server.export_policies],
+                                 self._export_rules())
+
+    def _read_policy(self, policy_name):
+        """
+        Read the rules of a single policy from the filer.
+
+        Raises KeyError if there is no such policy.
+        """
+        if policy_name not in [p.name for p in self.server.export_policies]:
+            raise KeyError("No such policy exists: '{}'".format(policy_name))
+        return [r[1] for r in self.server.export_rules_of(policy_name)]
+
+    def _policy_rules(self, policy_name):
+        """
+        Return the rules of policy_name from the policy index, falling
+        back on the filer for policies the index does not know about
+        (yet).
+
+        Raises KeyError if there is no such policy.
+        """
+        self._policy_index_refresh.start()
+
+        rules = self.policy_index.rules(policy_name)
+        if rules is not None:
+            return rules
+
+        rules = self._read_policy(policy_name)
+        self.policy_index.put(policy_name, rules)
+        return rules
+
+    def refresh_volume_index(self):
+        """
+        Re-read the names, junction paths and nodes of every volume on
+        the filer into the volume index.
 
-    def name_from_path(self, junction_path):
+        Only asks for the identifying attributes of the volumes, which
+        is a lot cheaper than going through server.volumes.
+        """
+        X = netapp.api.X
+        api_call = X('volume-get-iter',
+                     X('desired-attributes',
+                       X('volume-attributes',
+                         X('volume-id-attributes',
+                           X('name'),
+                           X('junction-path'),
+                           X('node')))))
+
+        def unpack_ids(attributes):
+            return tuple(
+                netapp.api._child_get_string(attributes,
+                                             'volume-id-attributes',
+                                             attribute)
+                for attribute in ['name', 'junction-path', 'node'])
+
+        self.volume_index.replace_all(self.server._get_paginated(
+            api_call,
+            endpoint='ONTAP',
+            constructor=unpack_ids,
+            container_tag='attributes-list'))
+        log.debug("Refreshed volume index: {} volumes"
+                  .format(len(self.volume_index)))
+
+    def name_from_path(self, junction_path, node=None):
         """
         'Resolve' a junction path to a proper volume name.
 
+        Answers from the volume index if possible, and only asks the
+        filer (remembering the answer) if the path is not in the index.
+
         Raises KeyError if there was no such volume.
         """
+        self._volume_index_refresh.start()
+
+        name = self.volume_index.name_of(junction_path, node=node)
+        if name is not None:
+            return name
+
         vols = self.server.volumes.filter(junction_path=junction_path)
         try:
             volume = next(vols)
         except StopIteration:
             raise KeyError(junction_path)
 
+        self.volume_index.add(volume.name, volume.junction_path,
+                              node=volume.node_name)
         return volume.name
 
     def node_junction_path(self, volume_name):
@@ -747,19 +1613,165 @@ class NetappStorage(StorageBackend):
             # Name did not follow name:junction_path convention. Assume name.
             return junction_path
         else:
-            return self.name_from_path(junction_path)
+            return self.name_from_path(junction_path, node=node)
+
+    def is_listed(self, volume):
+        """
+        Return True if the (formatted) volume should be listed in
+        volumes, e.g. if it is neither restricted nor belongs to aggr0.
+        """
+        return bool(not volume['state'] == 'restricted'
+                    and volume['aggregate_name']
+                    and not AGGR0_RE.match(volume['aggregate_name']))
+
+    def _volume_attributes(self):
+        """
+        Return the volume-attributes of every volume on the filer, as
+        read by server.volumes, but without its sis-get-iter call per
+        volume.
+        """
+        X = netapp.api.X
+        api_call = X('volume-get-iter',
+                     X('desired-attributes',
+                       X('volume-attributes',
+                         *copy.deepcopy(netapp.api.VOL_FIELDS))))
+        return list(self.server._get_paginated(
+            api_call,
+            endpoint='ONTAP',
+            constructor=lambda attributes: attributes,
+            container_tag='attributes-list'))
+
+    def _compression(self):
+        """
+        Return whether compression and inline compression are enabled,
+        by (vserver, SIS path), for every volume with SIS enabled, in a
+        single call.
+        """
+        X = netapp.api.X
+        api_call = X('sis-get-iter',
+                     X('desired-attributes',
+                       X('sis-status-info',
+                         X('path'),
+                         X('vserver'),
+                         X('is-compression-enabled'),
+                         X('is-inline-compression-enabled'))))
+
+        def unpack_sis(sis_status_info):
+            def get(attribute):
+                return netapp.api._child_get_string(sis_status_info,
+                                                    attribute)
+            return ((get('vserver'), get('path')),
+                    (netapp.api._read_bool(get('is-compression-enabled')),
+                     netapp.api._read_bool(
+                         get('is-inline-compression-enabled'))))
+
+        return dict(self.server._get_paginated(
+            api_call,
+            endpoint='ONTAP',
+            constructor=unpack_sis,
+            container_tag='attributes-list'))
+
+    def _volume_records(self, attributes, compression):
+        """
+        Join the results of _volume_attributes() and _compression() into
+        netapp.api.Volumes, like server.volumes would. Volumes without
+        SIS have compression disabled.
+        """
+        def volume(attributes_list):
+            def get(attribute):
+                return netapp.api._child_get_string(
+                    attributes_list, 'volume-id-attributes', attribute)
+            enabled, inline = compression.get(
+                (get('owning-vserver-name'), "/vol/{}".format(get('name'))),
+                (False, False))
+            return netapp.api.Volume(attributes_list, compression=enabled,
+                                     inline=inline)
+
+        return [volume(a) for a in attributes]
+
+    def _read_volumes(self):
+        """
+        Read all volumes from the filer, in one (paginated)
+        volume-get-iter call and one sis-get-iter call.
+        """
+        return self._volume_records(self._volume_attributes(),
+                                    self._compression())
+
+    def _load_volumes(self):
+        """
+        Read all volumes from the filer for the inventory, refreshing
+        the volume index as a side-effect since we have it all anyway.
+        """
+        volumes = [self.format_volume(v) for v in self._read_volumes()]
+        self.volume_index.replace_all((v['name'],
+                                       v['junction_path'],
+                                       v['filer_address'])
+                                      for v in volumes)
+        return [v for v in volumes if self.is_listed(v)]
+
+    def _update_inventory(self, volume_name):
+        """
+        Re-read a single volume into the inventory after a write, but
+        only if there is an inventory to keep up to date.
+        """
+        if not self.inventory.loaded:
+            return
+
+        try:
+            volume = self.format_volume(
+                self.server.volumes.single(volume_name=volume_name))
+        except IndexError:
+            self.inventory.discard(volume_name)
+            return
+
+        if self.is_listed(volume):
+            self.inventory.put(volume)
+        else:
+            self.inventory.discard(volume_name)
 
     @property
     def volumes(self):
         """
         Explicitly ignores volumes belonging to aggr0 and volumes that
         are restricted if not queried directly.
+
+        Served from the inventory cache if enabled.
         """
+        self._inventory_refresh.start()
+        return self.inventory.volumes()
 
-        return [self.format_volume(v) for v in self.server.volumes
-                if not v.state == 'restricted'
-                and v.containing_aggregate_name
-                and not re.match("^aggr0.*", v.containing_aggregate_name)]
+    def filter_volumes(self, **filters):
+        return list(self.iter_volumes(**filters))
+
+    def iter_volumes(self, **filters):
+        """
+        Filter in the inventory if it is enabled, otherwise have the
+        filer do as much as it can of the filtering, and produce the
+        volumes as they come in from the filer.
+        """
+        filters = {k: v for k, v in filters.items() if v is not None}
+        raise_on_unknown_filters(filters)
+
+        if self.inventory.enabled:
+            return (v for v in self.volumes if volume_matches(v, **filters))
+
+        for value in filters.values():
+            if ZAPI_QUERY_OPERATORS_RE.search(value):
+                raise ValueError("Filter values may not contain any of"
+                                 " the characters {}"
+                                 .format(ZAPI_QUERY_OPERATORS))
+
+        query = {}
+        if 'aggregate_name' in filters:
+            query['containing_aggregate_name'] = filters['aggregate_name']
+        if 'filer_address' in filters:
+            query['node'] = filters['filer_address']
+        if 'name_prefix' in filters:
+            query['name'] = "{}*".format(filters['name_prefix'])
+
+        return (v for v in map(self.format_volume,
+                               self.server.volumes.filter(**query))
+                if self.is_listed(v) and volume_matches(v, **filters))
 
     # Volume parameters validation does not need to take place since we
     # also want to return offline and restricted volumes if asked
@@ -781,28 +1793,107 @@ class NetappStorage(StorageBackend):
         return self.format_volume(volume)
 
     def get_policy(self, policy_name):
-        if policy_name not in [p.name for p in self.server.export_policies]:
-            raise KeyError("No such policy exists: '{}'".format(policy_name))
-        rules = [r[1] for r in self.server.export_rules_of(policy_name)]
-        return rules
+        return self._policy_rules(policy_name)
 
     def set_policy(self, volume_name, policy_name):
         volume_name = self.parse_volume_name(volume_name)
 
         self.server.set_volume_export_policy(volume_name=volume_name,
                                              policy_name=policy_name)
+        self._update_inventory(volume_name)
 
-    @normalised_with('snapshot', as_list=True)
     def get_snapshots(self, volume_name):
+        return list(self.iter_snapshots(volume_name))
+
+    def iter_snapshots(self, volume_name):
+        """
+        Served from the snapshot cache if the volume is in it, otherwise
+        the snapshots are produced as they come in from the filer, and
+        cached if all of them are read.
+        """
         volume_name = self.parse_volume_name(volume_name)
-        return [{'name': s.name,
-                 'size_kbytes': s.size_kbytes,
-                 'creation_time': s.creation_time}
-                for s in self.server.snapshots_of(volume_name)]
+        cached = self.snapshot_cache.snapshots(volume_name)
+        if cached is not None:
+            return iter(cached)
+
+        return self._caching_snapshots(
+            volume_name,
+            self.snapshot_cache.version(volume_name),
+            self._snapshots_of(volume_name))
+
+    def _caching_snapshots(self, volume_name, version, snapshots):
+        if not self.snapshot_cache.enabled:
+            yield from snapshots
+            return
+
+        seen = []
+        for snapshot in snapshots:
+            seen.append(snapshot)
+            yield snapshot
+        self.snapshot_cache.replace(volume_name, seen, version)
+
+    @normalised_with('snapshot', as_list=True, lazy=True)
+    def _snapshots_of(self, volume_name):
+        return (format_snapshot(s)
+                for s in self.server.snapshots_of(volume_name))
+
+    @normalised_with('snapshot')
+    def _snapshot_of(self, volume_name, snapshot_name):
+        """
+        Ask the filer for a single snapshot of a volume, rather than
+        going through all of them.
+        """
+        if ZAPI_QUERY_OPERATORS_RE.search(snapshot_name):
+            # It would be taken for a pattern by the filer
+            snapshots = (s for s in self.server.snapshots_of(volume_name)
+                         if s.name == snapshot_name)
+        else:
+            X = netapp.api.X
+            api_call = X('snapshot-get-iter',
+                         X('desired-attributes',
+                           X('snapshot-info',
+                             X('name'),
+                             X('access-time'),
+                             X('total'))),
+                         X('query',
+                           X('snapshot-info',
+                             X('volume', str(volume_name)),
+                             X('name', str(snapshot_name)))))
+            snapshots = self.server._get_paginated(
+                api_call,
+                endpoint='ONTAP',
+                constructor=unpack_snapshot,
+                container_tag='attributes-list')
+
+        for snapshot in snapshots:
+            return format_snapshot(snapshot)
+        raise KeyError("No such snapshot exists for volume '{}': '{}'"
+                       .format(volume_name, snapshot_name))
 
     @property
     def policies(self):
-        return [self.format_policy(p) for p in self.server.export_policies]
+        return list(self.iter_policies())
+
+    def iter_policies(self):
+        self._policy_index_refresh.start()
+        return ({'name': name, 'rules': rules}
+                for name, rules in self.policy_index.policies())
+
+    def policies_granting(self, network):
+        self._policy_index_refresh.start()
+        return ({'name': name, 'rules': rules}
+                for name, rules in self.policy_index.granting(network))
+
+    def volumes_accessible_from(self, network):
+        """
+        Joins the policy index with the inventory, both kept up to date
+        as volumes and policies change, rather than going through every
+        volume.
+        """
+        self._inventory_refresh.start()
+        policy_names = [p['name'] for p in self.policies_granting(network)]
+        return self.inventory.volumes_with('active_policy_name',
+                                           policy_names)
 
     def locks(self, volume_name):
         volume_name = self.parse_volume_name(volume_name)
@@ -819,33 +1910,42 @@ class NetappStorage(StorageBackend):
 
         self.server.clone_volume(from_volume_name, clone_volume_name,
                                  junction_path, from_snapshot_name)
+        self.volume_index.add(clone_volume_name, junction_path)
+        self._update_inventory(clone_volume_name)
 
     def create_snapshot(self, volume_name, snapshot_name):
-        _node, junction_path = self.node_junction_path(volume_name)
-        volume_name = self.name_from_path(junction_path)
+        node, junction_path = self.node_junction_path(volume_name)
+        volume_name = self.name_from_path(junction_path, node=node)
 
         self.server.create_snapshot(volume_name, snapshot_name)
+        if self.snapshot_cache.snapshots(volume_name) is not None:
+            self.snapshot_cache.put(
+                volume_name, self._snapshot_of(volume_name, snapshot_name))
+        else:
+            self.snapshot_cache.invalidate(volume_name)
 
     def get_snapshot(self, volume_name, snapshot_name):
         volume_name = self.parse_volume_name(volume_name)
-        snapshots = self.get_snapshots(volume_name)
-        for snapshot in snapshots:
-            if snapshot['name'] == snapshot_name:
-                return snapshot
-        raise ValueError("No such snapshot {}".format(snapshot_name))
+        snapshot = self.snapshot_cache.get(volume_name, snapshot_name)
+        if snapshot is None:
+            snapshot = self._snapshot_of(volume_name, snapshot_name)
+        return snapshot
 
     def remove_policy(self, policy_name):
         try:
             self.server.delete_export_policy(policy_name)
         except netapp.api.APIError as e:
             if e.errno == 15661:
+                self.policy_index.discard(policy_name)
                 raise KeyError("Policy doesn't exist: '{}'"
                                .format(policy_name))
             else:
                 raise e
+        self.policy_index.discard(policy_name)
 
     def create_policy(self, policy_name, rules):
         self.server.create_export_policy(policy_name, rules=rules)
+        self.policy_index.put(policy_name, rules)
 
     def delete_snapshot(self, volume_name, snapshot_name):
         volume_name = self.parse_volume_name(volume_name)
@@ -856,23 +1956,44 @@ class NetappStorage(StorageBackend):
                 raise KeyError("No such snapshot {}".format(snapshot_name))
             else:
                 raise e
+        finally:
+            self.snapshot_cache.discard(volume_name, snapshot_name)
 
     def rollback_volume(self, volume_name, restore_snapshot_name):
         volume_name = self.parse_volume_name(volume_name)
         self.get_snapshot(volume_name, restore_snapshot_name)
         self.server.rollback_volume_from_snapshot(volume_name,
                                                   restore_snapshot_name)
+        # Restoring a snapshot deletes all the snapshots taken after it
+        self.snapshot_cache.invalidate(volume_name)
+        self._update_inventory(volume_name)
 
     def ensure_policy_rule_present(self, policy_name, rule):
-        rules = [r for _i, r in self.server.export_rules_of(policy_name)]
-        if rule not in rules:
-            self.server.add_export_rule(policy_name, rule)
+        """
+        Answered from the policy index if it already has the rule, so
+        a rule removed outside of the API is only re-added once the
+        index has been refreshed.
+        """
+        if rule in self._policy_rules(policy_name):
+            return
+        self.server.add_export_rule(policy_name, rule)
+        self.policy_index.add_rule(policy_name, rule)
 
     def ensure_policy_rule_absent(self, policy_name, rule):
-        for index, stored_rule in self.server.export_rules_of(policy_name):
+        """
+        Always checked on the filer, as the policy index may not know
+        about the rule yet (e.g. if it was added through another
+        process), and failing to revoke access must not go unnoticed.
+        The index is updated with the rules read.
+        """
+        rules = sorted(self.server.export_rules_of(policy_name))
+        for index, stored_rule in rules:
             if rule == stored_rule:
                 self.server.remove_export_rule(policy_name, index)
                 break
+        if self.policy_index.rules(policy_name) is not None:
+            self.policy_index.put(policy_name, [r for _i, r in rules
+                                                if r != rule])
 
     @normalised_with('volume', allow_unknown=True)
     def create_volume(self, volume_name, **fields):
@@ -908,7 +2029,6 @@ class NetappStorage(StorageBackend):
         if not fields.get('size_total', None):
             raise ValueError("Must provide size_total for NetApp!")
 
-        aggregate_name = None
         snapshot_reserve = fields.get('percentage_snapshot_reserve', None)
         compression = fields.get('compression_enabled', None)
         inline_compression = fields.get('inline_compression', None)
@@ -932,57 +2052,50 @@ class NetappStorage(StorageBackend):
                      .format(volume_name))
             max_size_bytes = int(fields['size_total'])*1.20
 
-        if fields.get('aggregate_name', None):
-            aggregate_name = fields['aggregate_name']
+        aggregate_name = fields.get('aggregate_name', None) or None
+        if aggregate_name:
             log.debug("Using provided aggregate {}".format(aggregate_name))
-        else:
-            log.info("Aggregate not provided,"
-                     " using the one with the most free space...")
-            # sorted sorts ascending by default.
-
-            aggregates = sorted(self.server.aggregates,
-                                key=lambda a: a.bytes_available,
-                                reverse=True)
-
-            not_aggr0 = functools.partial(re.compile("(?!^aggr0.*)").match)
-
-            for aggregate in aggregates:
-                if not_aggr0(aggregate.name):
-                    aggregate_name = aggregate.name
-                    log.info("Picked aggregate {} for {}"
-                             .format(aggregate_name,
-                                     volume_name))
-                    break
-                else:
-                    log.info("Skipping aggregate {} because it is aggr0"
-                             .format(aggregate.name))
-
-        assert aggregate_name, "Could not find a suitable aggregate!"
 
         try:
-            self.server.create_volume(
-                name=volume_name,
-                size_bytes=fields['size_total'],
-                junction_path=junction_path,
-                percentage_snapshot_reserve=snapshot_reserve,
-                compression=compression,
-                inline_compression=inline_compression,
-                export_policy_name=export_policy_name,
-                aggregate_name=aggregate_name)
-
-            self.server.set_volume_autosize(
-                volume_name=volume_name,
-                autosize_enabled=autosize_enabled,
-                max_size_bytes=max_size_bytes)
-
-            return self.format_volume(
-                self.server.volumes.single(volume_name=volume_name))
+            with self.placement.reserve(
+                    fields['size_total'],
+                    aggregate_name=aggregate_name) as aggregate_name:
+                new_volume = self._create_and_read_volume(
+                    dict(name=volume_name,
+                         size_bytes=fields['size_total'],
+                         junction_path=junction_path,
+                         percentage_snapshot_reserve=snapshot_reserve,
+                         compression=compression,
+                         inline_compression=inline_compression,
+                         export_policy_name=export_policy_name,
+                         aggregate_name=aggregate_name),
+                    dict(volume_name=volume_name,
+                         autosize_enabled=autosize_enabled,
+                         max_size_bytes=max_size_bytes))
         except netapp.api.APIError as e:
             if e.errno == 17:
                 raise KeyError("Volume {} already exists!".format(volume_name))
             else:
                 raise e
 
+        self.volume_index.add(new_volume['name'],
+                              new_volume['junction_path'],
+                              node=new_volume['filer_address'])
+        if self.is_listed(new_volume):
+            self.inventory.put(new_volume)
+        return new_volume
+
+    def _create_and_read_volume(self, create_args, autosize_args):
+        """
+        Create a volume from the arguments to server.create_volume and
+        server.set_volume_autosize, and return it as read back from the
+        filer.
+        """
+        self.server.create_volume(**create_args)
+        self.server.set_volume_autosize(**autosize_args)
+        return self.format_volume(
+            self.server.volumes.single(volume_name=create_args['name']))
+
     def create_lock(self, volume_name, host_owner):
         # There doesn't seem to be any way of implementing this. :(
         return NotImplemented
@@ -992,59 +2105,198 @@ class NetappStorage(StorageBackend):
         self.server.break_lock(volume_name, host_owner)
 
     def patch_volume(self, volume_name, **data):
+        """
+        Apply the settings that changed. Independent settings are
+        applied concurrently (see _apply_settings()), and a failure to
+        apply one of them does not prevent the others from being
+        applied.
+        """
         previous = self.get_volume(volume_name)
+        unchanged = [k for k in data
+                     if k in previous and previous[k] == data[k]]
         changed_keys, updated_volume = patch_and_diff(previous, data)
 
-        # Autosize:
-        if 'max_autosize' in changed_keys:
-            log.info("Updating autosize...")
-            self.server.set_volume_autosize(
-                previous['name'],
-                max_size_bytes=updated_volume['max_autosize'],
-                autosize_enabled=updated_volume['autosize_enabled'])
+        settings = self._volume_settings(previous['name'], changed_keys,
+                                         updated_volume)
+        handled = set(k for steps in settings for fields, _call in steps
+                      for k in fields)
+        report = self._apply_settings(settings)
+        report['unchanged'] = sorted(unchanged)
+        for key in sorted(set(changed_keys) - handled):
+            report['failed'][key] = ("Cannot be updated on"
+                                     " NetApp back-ends")
+
+        if report['applied']:
+            self._update_inventory(previous['name'])
+        return report
+
+    def _volume_settings(self, volume_name, changed_keys, updated_volume):
+        """
+        Return the calls needed to apply the changed_keys of
+        updated_volume to volume_name, as a list of independent
+        settings. Each setting is a list of steps to take in order, as
+        (fields, call) tuples.
+        """
+        settings = []
+
+        # Resizing and autosize limits depend on each other
+        sizing = []
+        autosize_keys = [k for k in ['max_autosize', 'autosize_enabled']
+                         if k in changed_keys]
+        if autosize_keys:
+            sizing.append((
+                autosize_keys,
+                functools.partial(
+                    self.server.set_volume_autosize,
+                    volume_name,
+                    max_size_bytes=updated_volume['max_autosize'],
+                    autosize_enabled=updated_volume['autosize_enabled'])))
+        if 'size_total' in changed_keys:
+            sizing.append((
+                ['size_total'],
+                functools.partial(self.server.resize_volume,
+                                  volume_name=volume_name,
+                                  new_size=updated_volume['size_total'])))
+        if sizing:
+            settings.append(sizing)
 
-        # Snapshot reserve space
         if 'percentage_snapshot_reserve' in changed_keys:
-            log.info("Updating snapshot reserve space...")
-            self.server.set_volume_snapshot_reserve(
-                previous['name'],
-                reserve_percent=updated_volume['percentage_snapshot_reserve'])
-
-        # Compression
-        if any(re.match('compression', k) for k in changed_keys):
-            log.info("Updating compression...")
-            self.server.set_compression(
-                volume_name=previous['name'],
-                enabled=updated_volume['compression_enabled'],
-                inline=updated_volume['inline_compression'])
-
-        # Active export policy
-        if 'active_policy_name' in changed_keys:
-            log.info("Updating policy name...")
-            self.server.set_volume_export_policy(
-                previous['name'],
-                policy_name=updated_volume['active_policy_name'])
+            settings.append([(
+                ['percentage_snapshot_reserve'],
+                functools.partial(
+                    self.server.set_volume_snapshot_reserve,
+                    volume_name,
+                    reserve_percent=updated_volume[
+                        'percentage_snapshot_reserve']))])
+
+        compression_keys = [k for k in changed_keys
+                            if re.match('compression|inline_compression', k)]
+        if compression_keys:
+            settings.append([(
+                compression_keys,
+                functools.partial(
+                    self.server.set_compression,
+                    volume_name=volume_name,
+                    enabled=updated_volume['compression_enabled'],
+                    inline=updated_volume['inline_compression']))])
 
-        # Resize volume
-        if 'size_total' in changed_keys:
-            log.info("Resizing volume...")
-            self.server.resize_volume(volume_name=previous['name'],
-                                      new_size=updated_volume['size_total'])
+        if 'active_policy_name' in changed_keys:
+            settings.append([(
+                ['active_policy_name'],
+                functools.partial(
+                    self.server.set_volume_export_policy,
+                    volume_name,
+                    policy_name=updated_volume['active_policy_name']))])
 
-        # Caching policy
         if 'caching_policy' in changed_keys:
-            log.info("Setting caching policy...")
-            self.server.set_volume_caching_policy(
-                volume_name=previous['name'],
-                policy_name=updated_volume['caching_policy'])
+            settings.append([(
+                ['caching_policy'],
+                functools.partial(
+                    self.server.set_volume_caching_policy,
+                    volume_name=volume_name,
+                    policy_name=updated_volume['caching_policy']))])
+
+        return settings
+
+    def _apply_settings(self, settings):
+        """
+        Apply each of settings (see _volume_settings()) in its own
+        thread, and return a report of the applied and failed fields.
+        """
+        if len(settings) <= 1:
+            results = [apply_setting(setting) for setting in settings]
+        else:
+            with ThreadPoolExecutor(max_workers=len(settings)) as executor:
+                results = list(executor.map(traced(apply_setting),
+                                            settings))
+
+        return merge_setting_results(results)
 
     def restrict_volume(self, volume_name):
         name = self.parse_volume_name(volume_name)
         self.server.restrict_volume(name)
+        self.volume_index.discard(name)
+        self.inventory.discard(name)
+        self.snapshot_cache.invalidate(name)
 
         for volume in self.server.volumes.filter(name=name):
             return self.format_volume(volume)
 
+
+class AsyncNetappStorage(NetappStorage):
+    """
+    A NetApp back-end making its independent ZAPI calls concurrently on
+    an event loop, so that operations needing several calls take about
+    as long as their slowest call rather than the sum of them.
+
+    The StorageBackend methods are synchronous adapters around the
+    coroutines doing the actual work (named `*_async`), which run on a
+    background event loop with at most `concurrency` ZAPI calls in
+    flight at a time.
+
+    Takes the same arguments as NetappStorage, plus `concurrency`.
+    """
+
+    def __init__(self, *args, concurrency=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = EventLoopThread(
+            max_workers=int(concurrency),
+            name="zapi-{}".format(self.server.vfiler),
+            context=bind_current_trace)
+
+    def _call(self, func, *args, **kwargs):
+        return self.loop.call(func, *args, **kwargs)
+
+    async def _policy_names_async(self):
+        return await self._call(
+            lambda: [p.name for p in self.server.export_policies])
+
+    async def _policy_rules_async(self, policy_name):
+        rules = await self._call(self.server.export_rules_of, policy_name)
+        return [r for _i, r in rules]
+
+    async def get_policy_async(self, policy_name):
+        # Fetch the rules while checking that the policy exists
+        policy_names, rules = await asyncio.gather(
+            self._policy_names_async(),
+            self._policy_rules_async(policy_name))
+        if policy_name not in policy_names:
+            raise KeyError("No such policy exists: '{}'".format(policy_name))
+        return rules
+
+    def _read_policy(self, policy_name):
+        return self.loop.run(self.get_policy_async(policy_name))
+
+    async def _load_policies_async(self):
+        policy_names, export_rules = await asyncio.gather(
+            self._policy_names_async(),
+            self._call(self._export_rules))
+        return self._group_rules(policy_names, export_rules)
+
+    def _load_policies(self):
+        return self.loop.run(self._load_policies_async())
+
+    async def _read_volumes_async(self):
+        attributes, compression = await asyncio.gather(
+            self._call(self._volume_attributes),
+            self._call(self._compression))
+        return self._volume_records(attributes, compression)
+
+    def _read_volumes(self):
+        return self.loop.run(self._read_volumes_async())
+
+    # Creating a volume is left to NetappStorage: its calls all depend on
+    # the previous one, so there is nothing to overlap.
+
+    async def _apply_settings_async(self, settings):
+        results = await asyncio.gather(*[self._call(apply_setting, setting)
+                                         for setting in settings])
+        return merge_setting_results(results)
+
+    def _apply_settings(self, settings):
+        return self.loop.run(self._apply_settings_async(settings))
+
+
 # I don't know if this does anything, but it may be necessary for, uh,
 # some reason?
 # StorageBackend.register(DummyStorage)
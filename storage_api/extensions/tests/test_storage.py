@@ -1,12 +1,25 @@
+import storage_api.extensions.storage as storage_module
 from storage_api.extensions.storage import (DummyStorage,
-                                            NetappStorage) # noqa
-
+                                            NetappStorage,
+                                            AsyncNetappStorage) # noqa
+from storage_api.extensions.zapi import PooledServer
+from storage_api.extensions.cache import (SnapshotCache, PolicyRuleIndex,
+                                          NetworkTrie, VolumeInventory,
+                                          PeriodicRefresh, ReadWriteLock)
+from storage_api.extensions.placement import AggregatePlacement
+from storage_api.extensions.changefeed import ChangeFeed
+
+import ipaddress
 import uuid
 import functools
+import threading
+import time
 import os
 from unittest import mock
 from contextlib import contextmanager
+from datetime import datetime
 
+import lxml.etree
 import pytest
 import netapp.api
 
@@ -276,7 +289,8 @@ def test_clone_volume(storage, recorder):
                              from_volume_name=volume_name,
                              from_snapshot_name="mysnap")
 
-    assert vol == clone
+    assert clone['name'] == "vol2-clone"
+    assert dict(vol, name=None) == dict(clone, name=None)
 
 
 @on_all_backends
@@ -617,3 +631,1226 @@ def test_has_caching_policy(storage, recorder):
     with recorder.use_cassette('has_caching_policy'):
         with ephermeral_volume(storage) as vol:
             assert 'caching_policy' in vol
+
+
+def mocked_netapp(backend_class=NetappStorage, **kwargs):
+    """
+    A NetappStorage whose server is a mock, for testing the logic in
+    the back-end itself without a filer.
+    """
+    storage = backend_class(hostname="host-placeholder",
+                            username="user-placeholder",
+                            password="password-placeholder",
+                            vserver="vserver-placeholder",
+                            volume_index_refresh_s=0,
+                            inventory_refresh_s=0,
+                            **kwargs)
+    storage.server = mock.MagicMock()
+    return storage
+
+
+def test_netapp_name_from_path_uses_index():
+    storage = mocked_netapp()
+    volume = mock.MagicMock(junction_path="/jp", node_name="node1")
+    volume.name = "vol1"
+    storage.server.volumes.filter.side_effect = lambda **_kw: iter([volume])
+
+    assert storage.parse_volume_name("node1:/jp") == "vol1"
+    assert storage.parse_volume_name(":/jp") == "vol1"
+    assert storage.parse_volume_name("node1:/jp") == "vol1"
+    storage.server.volumes.filter.assert_called_once_with(junction_path="/jp")
+
+
+def test_netapp_name_from_path_miss_raises_key_error():
+    storage = mocked_netapp()
+    storage.server.volumes.filter.return_value = iter([])
+
+    with pytest.raises(KeyError):
+        storage.parse_volume_name("node1:/no/such/path")
+
+
+def test_netapp_restrict_volume_drops_index_entry():
+    storage = mocked_netapp()
+    storage.volume_index.add("vol1", "/jp", node="node1")
+    storage.server.volumes.filter.return_value = iter([])
+
+    storage.restrict_volume("node1:/jp")
+
+    storage.server.restrict_volume.assert_called_once_with("vol1")
+    assert storage.volume_index.path_of("vol1") is None
+
+
+def test_volume_name_index():
+    from storage_api.extensions.cache import VolumeNameIndex
+
+    index = VolumeNameIndex()
+    index.add("vol1", "/jp1", node="node1")
+    index.add("vol2", "/jp2", node="node2")
+    index.add("vol3", "/jp2", node="node3")
+
+    assert index.name_of("/jp1") == "vol1"
+    assert index.name_of("/jp1", node="some-other-node") == "vol1"
+    assert index.name_of("/jp2", node="node3") == "vol3"
+    assert index.name_of("/jp2") is None
+    assert index.path_of("vol1") == ("node1", "/jp1")
+
+    index.add("vol1", "/jp1-moved", node="node1")
+    assert index.name_of("/jp1") is None
+    assert index.name_of("/jp1-moved") == "vol1"
+
+    index.replace_all([("vol4", "/jp4", None), ("unmounted", None, "n")])
+    assert len(index) == 1
+    assert index.name_of("/jp4", node="node4") == "vol4"
+
+
+class FakeNetappVolume(object):
+    """
+    Something that looks enough like a netapp.api.Volume to be
+    formatted by NetappStorage.
+    """
+    def __init__(self, name, aggregate="aggr1", state="online",
+                 policy=None):
+        self.name = name
+        if policy is not None:
+            self.active_policy_name = policy
+        self.junction_path = "/{}".format(name)
+        self.node_name = "node1"
+        self.containing_aggregate_name = aggregate
+        self.state = state
+        self.size_total_bytes = DEFAULT_VOLUME_SIZE
+        self.size_used_bytes = 0
+
+
+def test_netapp_volumes_served_from_inventory():
+    storage = mocked_netapp()
+    storage._read_volumes = mock.Mock(side_effect=lambda: [
+        FakeNetappVolume("vol1"),
+        FakeNetappVolume("restricted", state="restricted"),
+        FakeNetappVolume("root", aggregate="aggr0_node1")])
+
+    assert [v['name'] for v in storage.volumes] == ["vol1"]
+    assert [v['name'] for v in storage.volumes] == ["vol1"]
+    assert storage._read_volumes.call_count == 1
+    assert storage.parse_volume_name("node1:/restricted") == "restricted"
+
+    storage.restrict_volume("vol1")
+    assert storage.volumes == []
+
+
+def test_netapp_inventory_write_through():
+    storage = mocked_netapp()
+    storage._read_volumes = mock.Mock(side_effect=lambda: [])
+    assert storage.volumes == []
+
+    storage.server.volumes.single.return_value = FakeNetappVolume("vol2")
+    storage.create_volume("vol2", junction_path="/vol2",
+                          size_total=DEFAULT_VOLUME_SIZE,
+                          aggregate_name="aggr1")
+    assert [v['name'] for v in storage.volumes] == ["vol2"]
+    assert storage._read_volumes.call_count == 1
+
+
+def test_netapp_inventory_disabled():
+    storage = mocked_netapp(inventory_ttl_s=0)
+    storage._read_volumes = mock.Mock(side_effect=lambda: [
+        FakeNetappVolume("vol1")])
+
+    storage.volumes
+    storage.volumes
+    assert storage._read_volumes.call_count == 2
+
+
+def test_netapp_filter_volumes_pushed_to_filer():
+    storage = mocked_netapp(inventory_ttl_s=0)
+    storage.server.volumes.filter.return_value = iter([
+        FakeNetappVolume("vol1"),
+        FakeNetappVolume("vol10", state="offline")])
+
+    volumes = storage.filter_volumes(name_prefix="vol", filer_address="node1",
+                                     state="online", aggregate_name=None)
+
+    assert [v['name'] for v in volumes] == ["vol1"]
+    storage.server.volumes.filter.assert_called_once_with(name="vol*",
+                                                          node="node1")
+
+    with pytest.raises(ValueError):
+        storage.filter_volumes(name_prefix="*")
+
+    with pytest.raises(ValueError):
+        storage.filter_volumes(colour="blue")
+
+
+@on_all_backends
+def test_filter_volumes(storage, recorder):
+    if isinstance(storage, NetappStorage):
+        return
+
+    storage.create_volume("filtered_1", filer_address="filer1")
+    storage.create_volume("filtered_2", filer_address="filer2")
+
+    assert [v['name'] for v in
+            storage.filter_volumes(filer_address="filer2")] == ["filtered_2"]
+    assert len(storage.filter_volumes(name_prefix="filtered_")) == 2
+
+
+def test_cached_validator_per_thread():
+    v = storage_module.cached_validator('volume')
+    assert storage_module.cached_validator('volume') is v
+    assert storage_module.cached_validator('volume',
+                                           allow_unknown=True) is not v
+
+    others = []
+    thread = threading.Thread(target=lambda: others.append(
+        storage_module.cached_validator('volume')))
+    thread.start()
+    thread.join()
+    assert others[0] is not v
+
+
+def test_normalised_with_batches():
+    class Backend(object):
+        trusted = False
+
+        def __init__(self, snapshots):
+            self.snapshots = snapshots
+
+        @storage_module.normalised_with('snapshot', as_list=True)
+        def eager(self):
+            return self.snapshots
+
+        @storage_module.normalised_with('snapshot', as_list=True, lazy=True)
+        def lazy(self):
+            return iter(self.snapshots)
+
+    count = storage_module.LAZY_BATCH_SIZE * 2 + 1
+    snapshots = [{'name': "snap{}".format(i), 'size_kbytes': i}
+                 for i in range(count)]
+    backend = Backend(snapshots)
+
+    assert backend.eager() == snapshots
+    assert backend.eager()[0] is not snapshots[0]
+    assert list(backend.lazy()) == snapshots
+
+    backend.snapshots = snapshots + [{'name': "bad", 'size_kbytes': -1}]
+    with pytest.raises(storage_module.ValidationError):
+        backend.eager()
+    with pytest.raises(storage_module.ValidationError):
+        list(backend.lazy())
+
+    backend.trusted = True
+    assert backend.eager()[-1] is backend.snapshots[-1]
+
+
+def test_trusted_backend_skips_normalisation():
+    storage = DummyStorage(trusted="true")
+    assert storage.trusted
+    storage.create_volume("trusted", size_total=10, filer_address="filer")
+    # Would not pass validation, as the schema does not allow it:
+    storage.patch_volume("trusted", some_field="kept")
+
+    assert storage.volumes[0]["some_field"] == "kept"
+    assert not DummyStorage(trusted="no").trusted
+    with pytest.raises(ValueError):
+        DummyStorage(trusted="maybe")
+
+
+def test_read_write_lock():
+    lock = ReadWriteLock()
+    events = []
+    writer_waiting = threading.Event()
+
+    def write():
+        writer_waiting.set()
+        with lock.writing():
+            events.append("write")
+
+    with lock.reading():
+        # Readers share the lock
+        with lock.reading():
+            pass
+        writer = threading.Thread(target=write)
+        writer.start()
+        writer_waiting.wait()
+        time.sleep(0.05)
+        assert events == []
+        events.append("read")
+    writer.join()
+
+    assert events == ["read", "write"]
+
+
+def test_dummy_storage_indexes():
+    storage = DummyStorage()
+    storage.create_policy("p1", ["10.0.0.0/24"])
+    storage.create_policy("p2", ["192.168.0.1"])
+    for i in range(4):
+        storage.create_volume("vol{}".format(i), filer_address="filer")
+        storage.patch_volume("vol{}".format(i),
+                             aggregate_name="aggr{}".format(i % 2))
+        storage.set_policy("vol{}".format(i), "p{}".format(i % 2 + 1))
+
+    def names(volumes):
+        return [v['name'] for v in volumes]
+
+    assert names(storage.filter_volumes(aggregate_name="aggr0")) == [
+        "vol0", "vol2"]
+    assert names(storage.filter_volumes(aggregate_name="aggr0",
+                                        filer_address="other")) == []
+    assert names(storage.volumes_accessible_from(
+        ipaddress.ip_network("10.0.0.1"))) == ["vol0", "vol2"]
+
+    storage.patch_volume("vol0", aggregate_name="aggr1")
+    storage.restrict_volume("vol3")
+    assert names(storage.filter_volumes(aggregate_name="aggr1")) == [
+        "vol0", "vol1"]
+    assert names(storage.filter_volumes(filer_address="filer")) == [
+        "vol0", "vol1", "vol2"]
+
+    storage.create_snapshot("vol1", "snap")
+    storage.clone_volume("clone", "vol1", "snap")
+    storage.patch_volume("clone", aggregate_name="aggr0")
+    assert storage.get_volume("vol1")['aggregate_name'] == "aggr1"
+    assert names(storage.filter_volumes(aggregate_name="aggr0")) == [
+        "vol2", "clone"]
+    assert storage.get_snapshots("clone") == []
+
+
+def test_dummy_storage_concurrent_writes():
+    storage = DummyStorage()
+    errors = []
+
+    def work(n):
+        try:
+            for i in range(50):
+                name = "vol{}_{}".format(n, i)
+                storage.create_volume(name, filer_address="filer")
+                storage.patch_volume(name, aggregate_name="aggr{}".format(i))
+                storage.create_snapshot(name, "snap")
+                storage.filter_volumes(aggregate_name="aggr{}".format(i))
+                storage.scan_state()
+                if i % 2:
+                    storage.restrict_volume(name)
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(storage.volumes) == 100
+    assert len(storage.scan_state()['snapshot']) == 100
+    assert len(storage.filter_volumes(filer_address="filer")) == 100
+    assert sum(len(storage.filter_volumes(aggregate_name="aggr{}".format(i)))
+               for i in range(50)) == 100
+
+
+def test_dummy_storage_filters_during_writes():
+    storage = DummyStorage()
+    for i in range(20):
+        storage.create_volume("stable{}".format(i), filer_address="filer")
+        storage.patch_volume("stable{}".format(i), aggregate_name="aggr0")
+    done = threading.Event()
+    errors = []
+
+    def write():
+        try:
+            for i in range(300):
+                name = "moving{}".format(i % 10)
+                if i < 10:
+                    storage.create_volume(name, filer_address="filer")
+                storage.patch_volume(name,
+                                     aggregate_name="aggr{}".format(i % 2))
+            for i in range(10):
+                storage.restrict_volume("moving{}".format(i))
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+        finally:
+            done.set()
+
+    def read():
+        try:
+            while not done.is_set():
+                volumes = storage.filter_volumes(aggregate_name="aggr0")
+                names = {v['name'] for v in volumes}
+                assert all(v['aggregate_name'] == "aggr0" for v in volumes)
+                assert {"stable{}".format(i) for i in range(20)} <= names
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    threads = ([threading.Thread(target=write)]
+               + [threading.Thread(target=read) for _ in range(3)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(storage.filter_volumes(aggregate_name="aggr0")) == 20
+
+
+def test_pooled_server_sessions_per_thread():
+    server = PooledServer(hostname="filer", username="user",
+                          password="password", pool_size=2,
+                          keep_alive=False)
+    sessions = [server.session]
+    thread = threading.Thread(target=lambda: sessions.append(server.session))
+    thread.start()
+    thread.join()
+
+    assert sessions[0] is server.session
+    assert sessions[0] is not sessions[1]
+    assert (sessions[0].get_adapter("https://filer")
+            is sessions[1].get_adapter("https://filer"))
+    assert sessions[0].headers['Connection'] == 'close'
+
+
+def test_pooled_server_limits_calls_in_flight():
+    server = PooledServer(hostname="filer", username="user",
+                          password="password", max_connections=2)
+    threads = [threading.Thread(target=server.perform_call,
+                                args=(None, "https://filer"))
+               for _ in range(6)]
+
+    def slow_call(self, api_call, api_url):
+        time.sleep(0.05)
+
+    with mock.patch.object(netapp.api.Server, 'perform_call', slow_call):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    stats = server.pool_stats()
+    assert stats['calls'] == 6
+    assert stats['in_flight'] == 0
+    assert stats['max_in_flight'] == 2
+
+
+def test_netapp_connection_stats():
+    storage = NetappStorage(hostname="filer", username="user",
+                            password="password", vserver="vs",
+                            pool_size="8", keep_alive="false")
+    stats = storage.connection_stats()
+    assert stats['pool_size'] == 8
+    assert not stats['keep_alive']
+    assert stats['connections_opened'] == 0
+    assert DummyStorage().connection_stats() is None
+
+
+def slow(delay_s, value):
+    def call(*_args, **_kwargs):
+        time.sleep(delay_s)
+        return value
+    return call
+
+
+def fake_policy(name):
+    policy = mock.MagicMock()
+    policy.name = name
+    return policy
+
+
+def test_async_netapp_get_policy_overlaps_calls():
+    storage = mocked_netapp(AsyncNetappStorage)
+    type(storage.server).export_policies = mock.PropertyMock(
+        side_effect=slow(0.2, [fake_policy("policy1")]))
+    storage.server.export_rules_of.side_effect = slow(
+        0.2, [(1, "10.0.0.1"), (2, "10.0.0.2")])
+
+    start = time.monotonic()
+    assert storage._read_policy("policy1") == ["10.0.0.1", "10.0.0.2"]
+    assert time.monotonic() - start < 0.35
+
+    with pytest.raises(KeyError):
+        storage._read_policy("no_such_policy")
+
+
+def test_async_netapp_policies():
+    storage = mocked_netapp(AsyncNetappStorage, concurrency=4)
+    policies = [fake_policy("policy{}".format(i)) for i in range(4)]
+    type(storage.server).export_policies = mock.PropertyMock(
+        side_effect=slow(0.2, policies))
+    storage.server._get_paginated.side_effect = slow(
+        0.2, [(p.name, 1, p.name + "_rule") for p in policies])
+
+    start = time.monotonic()
+    assert storage.policies == [{'name': p.name, 'rules': [p.name + "_rule"]}
+                                for p in policies]
+    assert time.monotonic() - start < 0.35
+    storage.server.export_rules_of.assert_not_called()
+
+
+def test_async_netapp_create_volume():
+    storage = mocked_netapp(AsyncNetappStorage)
+    volume = FakeNetappVolume("vol1")
+    volume.autosize_enabled = False
+
+    def set_volume_autosize(volume_name, autosize_enabled, max_size_bytes):
+        time.sleep(0.1)
+        volume.autosize_enabled = autosize_enabled
+        # Filers round sizes up to whole blocks
+        volume.max_autosize = -(-int(max_size_bytes) // 4096) * 4096
+
+    storage.server.set_volume_autosize.side_effect = set_volume_autosize
+    # The volume is only read back once its autosize has been set
+    storage.server.volumes.single.side_effect = lambda **_kwargs: volume
+
+    volume = storage.create_volume("vol1", junction_path="/vol1",
+                                   size_total=1000, aggregate_name="aggr1")
+
+    assert volume['name'] == "vol1"
+    assert volume['autosize_enabled'] is True
+    assert volume['max_autosize'] == 4096
+    storage.server.set_volume_autosize.assert_called_once_with(
+        volume_name="vol1", autosize_enabled=True, max_size_bytes=1200.0)
+
+    storage.server.create_volume.side_effect = netapp.api.APIError(errno=17)
+    with pytest.raises(KeyError):
+        storage.create_volume("vol1", junction_path="/vol1", size_total=1000,
+                              aggregate_name="aggr1")
+
+
+@pytest.mark.parametrize('backend_class', [NetappStorage, AsyncNetappStorage])
+def test_netapp_patch_volume_concurrent_report(backend_class):
+    storage = mocked_netapp(backend_class)
+    storage.get_volume = lambda _name: {
+        'name': "vol1", 'size_total': 100, 'max_autosize': 120,
+        'autosize_enabled': True, 'percentage_snapshot_reserve': 0,
+        'compression_enabled': True, 'inline_compression': True,
+        'active_policy_name': "default", 'caching_policy': None}
+    for setter in ['set_volume_snapshot_reserve', 'set_compression',
+                   'set_volume_export_policy', 'set_volume_autosize']:
+        getattr(storage.server, setter).side_effect = slow(0.2, None)
+    storage.server.set_volume_caching_policy.side_effect = (
+        netapp.api.APIError(message="No such caching policy"))
+
+    start = time.monotonic()
+    report = storage.patch_volume("vol1",
+                                  size_total=100,
+                                  max_autosize=240,
+                                  percentage_snapshot_reserve=5,
+                                  inline_compression=False,
+                                  active_policy_name="other",
+                                  caching_policy="auto")
+    assert time.monotonic() - start < 0.35
+
+    assert report == {
+        'applied': ['active_policy_name', 'inline_compression',
+                    'max_autosize', 'percentage_snapshot_reserve'],
+        'unchanged': ['size_total'],
+        'failed': {'caching_policy': "No such caching policy"}}
+    storage.server.set_compression.assert_called_once_with(
+        volume_name="vol1", enabled=True, inline=False)
+    storage.server.resize_volume.assert_not_called()
+
+
+def test_netapp_patch_volume_sizing_in_order():
+    storage = mocked_netapp()
+    storage.get_volume = lambda _name: {
+        'name': "vol1", 'size_total': 100, 'max_autosize': 120,
+        'autosize_enabled': True}
+    storage.server.set_volume_autosize.side_effect = (
+        netapp.api.APIError(message="Too small"))
+
+    report = storage.patch_volume("vol1", size_total=200, max_autosize=110)
+
+    assert report['applied'] == []
+    assert report['failed']['max_autosize'] == "Too small"
+    assert "size_total" in report['failed']
+    storage.server.resize_volume.assert_not_called()
+
+
+def fake_snapshot(name):
+    return netapp.api.Snapshot(name=name, size_kbytes=42,
+                               creation_time=datetime(2017, 1, 1))
+
+
+def test_snapshot_cache():
+    cache = SnapshotCache(ttl_s=60, max_volumes=2)
+    version = cache.version("vol1")
+    cache.put("vol1", {'name': "snap0"})
+    cache.replace("vol1", [{'name': "snap1"}], version)
+    assert cache.snapshots("vol1") is None
+
+    cache.replace("vol1", [{'name': "snap1"}], cache.version("vol1"))
+    cache.put("vol1", {'name': "snap2"})
+    assert cache.get("vol1", "snap2") == {'name': "snap2"}
+    cache.discard("vol1", "snap1")
+    assert cache.snapshots("vol1") == [{'name': "snap2"}]
+
+    cache.replace("vol2", [], cache.version("vol2"))
+    cache.replace("vol3", [], cache.version("vol3"))
+    assert cache.snapshots("vol1") is None
+    assert len(cache) == 2
+
+    cache.invalidate("vol2")
+    assert cache.get("vol2", "snap") is None
+
+
+def test_netapp_get_snapshot_single_query():
+    storage = mocked_netapp()
+    storage.server._get_paginated.return_value = iter([fake_snapshot("s1")])
+
+    snapshot = storage.get_snapshot("vol1", "s1")
+
+    assert snapshot['name'] == "s1"
+    storage.server.snapshots_of.assert_not_called()
+    query = lxml.etree.tostring(
+        storage.server._get_paginated.call_args[0][0]).decode()
+    assert "<volume>vol1</volume><name>s1</name>" in query
+
+    storage.server._get_paginated.return_value = iter([])
+    with pytest.raises(KeyError):
+        storage.get_snapshot("vol1", "no_such_snapshot")
+
+
+def test_netapp_snapshot_cache_write_through():
+    storage = mocked_netapp()
+    storage.server.snapshots_of.return_value = iter(
+        [fake_snapshot("s{}".format(i)) for i in range(3)])
+
+    assert len(storage.get_snapshots("vol1")) == 3
+    assert len(storage.get_snapshots("vol1")) == 3
+    assert storage.get_snapshot("vol1", "s1")['name'] == "s1"
+    assert storage.server.snapshots_of.call_count == 1
+    storage.server._get_paginated.assert_not_called()
+
+    storage.server._get_paginated.return_value = iter([fake_snapshot("new")])
+    storage.name_from_path = lambda junction_path, node=None: junction_path
+    storage.create_snapshot("vol1", "new")
+    storage.delete_snapshot("vol1", "s0")
+
+    assert ([s['name'] for s in storage.get_snapshots("vol1")]
+            == ["s1", "s2", "new"])
+    assert storage.server.snapshots_of.call_count == 1
+
+    storage.rollback_volume("vol1", "s1")
+    storage.get_snapshots("vol1")
+    assert storage.server.snapshots_of.call_count == 2
+
+
+def fake_aggregate(name, bytes_available, node="node1"):
+    return netapp.api.Aggregate(name=name, node_names=[node],
+                                bytes_used=0,
+                                bytes_available=bytes_available)
+
+
+def test_placement_strategies():
+    aggregates = [fake_aggregate("aggr0_root", 1000),
+                  fake_aggregate("aggr1", 500),
+                  fake_aggregate("aggr2", 200),
+                  fake_aggregate("aggr3", 300, node="node2")]
+    placement = AggregatePlacement(load=lambda: aggregates,
+                                   exclude=storage_module.AGGR0_RE)
+
+    with placement.reserve(100) as aggregate_name:
+        assert aggregate_name == "aggr1"
+    with placement.reserve(150, strategy='best_fit') as aggregate_name:
+        assert aggregate_name == "aggr2"
+    with placement.reserve(100, strategy='spread') as aggregate_name:
+        assert aggregate_name == "aggr3"
+    # Nothing fits: fall back to the most free space
+    with placement.reserve(10000) as aggregate_name:
+        assert aggregate_name == "aggr1"
+
+    with pytest.raises(ValueError):
+        AggregatePlacement(load=lambda: aggregates, strategy='random')
+
+    with pytest.raises(ValueError):
+        with AggregatePlacement(load=lambda: []).reserve(100):
+            pass
+
+
+def test_placement_reservations():
+    load = mock.MagicMock(return_value=[fake_aggregate("aggr1", 500),
+                                        fake_aggregate("aggr2", 400)])
+    placement = AggregatePlacement(load=load)
+
+    with placement.reserve(200) as first:
+        with placement.reserve(200) as second:
+            pass
+    with placement.reserve(200) as third:
+        pass
+    assert (first, second, third) == ("aggr1", "aggr2", "aggr1")
+    load.assert_called_once_with()
+
+    with pytest.raises(RuntimeError):
+        with placement.reserve(200):
+            raise RuntimeError("creation failed")
+    free = {a.name: a.free_bytes for a in placement.aggregates()}
+    assert free == {"aggr1": 100, "aggr2": 200}
+
+    # Created volumes are accounted for by the filer after a re-read
+    placement.refresh()
+    free = {a.name: a.free_bytes for a in placement.aggregates()}
+    assert free == {"aggr1": 500, "aggr2": 400}
+
+
+def test_placement_committed_reservations_expire():
+    load = mock.MagicMock(return_value=[fake_aggregate("aggr1", 500)])
+    placement = AggregatePlacement(load=load, ttl_s=0.05)
+
+    for _ in range(10):
+        with placement.reserve(10, aggregate_name="aggr1"):
+            pass
+    time.sleep(0.1)
+    with placement.reserve(10, aggregate_name="aggr1"):
+        pass
+
+    # The aggregates were never read, and only the last one is kept
+    load.assert_not_called()
+    assert len(placement._committed) == 1
+
+
+def test_placement_concurrent_creations_spread():
+    placement = AggregatePlacement(
+        load=lambda: [fake_aggregate("aggr{}".format(i), 1000)
+                      for i in range(4)])
+    chosen = []
+    barrier = threading.Barrier(4)
+
+    def create():
+        with placement.reserve(600) as aggregate_name:
+            chosen.append(aggregate_name)
+            barrier.wait(timeout=5)
+
+    threads = [threading.Thread(target=create) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(chosen) == ["aggr0", "aggr1", "aggr2", "aggr3"]
+
+
+def test_netapp_create_volume_placement():
+    storage = mocked_netapp(placement_strategy='best_fit', trusted=True)
+    storage.server.aggregates = [fake_aggregate("aggr0", 10000),
+                                 fake_aggregate("aggr1", 5000),
+                                 fake_aggregate("aggr2", 2000)]
+    storage._create_and_read_volume = mock.MagicMock(
+        side_effect=lambda create_args, autosize_args: dict(
+            create_args, filer_address="node1", state='online'))
+
+    storage.create_volume("vol1", junction_path="/vol1", size_total=1500)
+    storage.create_volume("vol2", junction_path="/vol2", size_total=1500)
+    storage.create_volume("vol3", junction_path="/vol3", size_total=1500,
+                          aggregate_name="aggr0")
+
+    placed = [c[0][0]['aggregate_name']
+              for c in storage._create_and_read_volume.call_args_list]
+    assert placed == ["aggr2", "aggr1", "aggr0"]
+
+
+def test_network_trie():
+    trie = NetworkTrie()
+    trie.add(ipaddress.ip_network("10.0.0.0/8"), "wide")
+    trie.add(ipaddress.ip_network("10.1.0.0/16"), "narrow")
+    trie.add(ipaddress.ip_network("10.1.2.3/32"), "host")
+    trie.add(ipaddress.ip_network("0.0.0.0/0"), "everyone")
+    trie.add(ipaddress.ip_network("2001:db8::/32"), "v6")
+
+    def containing(network):
+        return trie.containing(ipaddress.ip_network(network))
+
+    assert containing("10.1.2.3") == {"wide", "narrow", "host", "everyone"}
+    assert containing("10.1.0.0/24") == {"wide", "narrow", "everyone"}
+    assert containing("10.0.0.0/7") == {"everyone"}
+    assert containing("192.168.0.1") == {"everyone"}
+    assert containing("2001:db8::1") == {"v6"}
+
+    trie.add(ipaddress.ip_network("10.1.0.0/16"), "narrow")
+    trie.discard(ipaddress.ip_network("10.1.0.0/16"), "narrow")
+    assert "narrow" in containing("10.1.0.1")
+    trie.discard(ipaddress.ip_network("10.1.0.0/16"), "narrow")
+    assert "narrow" not in containing("10.1.0.1")
+
+
+def test_policy_rule_index():
+    load = mock.MagicMock(return_value=[
+        ("p1", ["10.0.0.0/8", "host.cern.ch"]),
+        ("p2", ["10.1.2.3"]),
+        ("empty", [])])
+    index = PolicyRuleIndex(load=load)
+
+    assert index.rules("p1") == ["10.0.0.0/8", "host.cern.ch"]
+    assert index.rules("no_such_policy") is None
+    assert index.has_rule("p2", "10.1.2.3") is True
+    assert index.has_rule("empty", "10.1.2.3") is False
+    assert index.has_rule("no_such_policy", "10.1.2.3") is None
+    load.assert_called_once_with()
+
+    def granting(network):
+        return [name for name, _rules
+                in index.granting(ipaddress.ip_network(network))]
+
+    assert granting("10.1.2.3") == ["p1", "p2"]
+    assert granting("10.1.2.0/24") == ["p1"]
+
+    index.add_rule("p2", "10.1.2.0/24")
+    assert index.rules("p2") == ["10.1.2.0/24", "10.1.2.3"]
+    assert granting("10.1.2.0/24") == ["p1", "p2"]
+    index.remove_rule("p1", "10.0.0.0/8")
+    index.discard("p2")
+    index.put("p3", ["0.0.0.0/0"])
+    assert granting("10.1.2.0/24") == ["p3"]
+    assert ([name for name, _rules in index.policies()]
+            == ["p1", "empty", "p3"])
+
+
+def test_policy_rule_index_keeps_writes_during_load():
+    index = PolicyRuleIndex(load=lambda: [("p1", ["10.0.0.1"])])
+    index.policies()
+
+    def load():
+        index.add_rule("p1", "10.0.0.2")
+        index.put("p2", ["10.0.0.3"])
+        return [("p1", ["10.0.0.1"]), ("p3", [])]
+
+    index._load = load
+    index.refresh()
+
+    assert index.policies() == [("p1", ["10.0.0.2", "10.0.0.1"]),
+                                ("p3", []),
+                                ("p2", ["10.0.0.3"])]
+
+
+def test_netapp_policy_index():
+    storage = mocked_netapp()
+    type(storage.server).export_policies = mock.PropertyMock(
+        return_value=[fake_policy("p1"), fake_policy("empty")])
+    storage.server._get_paginated.return_value = [("p1", 2, "10.0.0.2"),
+                                                  ("p1", 1, "10.0.0.1")]
+
+    assert storage.get_policy("p1") == ["10.0.0.1", "10.0.0.2"]
+    assert storage.get_policy("empty") == []
+    assert storage.policies == [{'name': "p1",
+                                 'rules': ["10.0.0.1", "10.0.0.2"]},
+                                {'name': "empty", 'rules': []}]
+
+    storage.ensure_policy_rule_present("p1", "10.0.0.1")
+    storage.server.export_rules_of.assert_not_called()
+    storage.server.add_export_rule.assert_not_called()
+
+    # Removals are checked on the filer, which may have rules the index
+    # does not know about yet
+    storage.server.export_rules_of.return_value = [(1, "10.0.0.1"),
+                                                   (2, "10.0.0.2"),
+                                                   (3, "10.0.0.3")]
+    storage.ensure_policy_rule_absent("p1", "10.0.0.3")
+    storage.server.remove_export_rule.assert_called_once_with("p1", 3)
+    assert storage.get_policy("p1") == ["10.0.0.1", "10.0.0.2"]
+    storage.server.remove_export_rule.reset_mock()
+
+    storage.ensure_policy_rule_present("p1", "10.0.0.0/24")
+    storage.server.add_export_rule.assert_called_once_with("p1",
+                                                           "10.0.0.0/24")
+    assert [p['name'] for p in storage.policies_granting(
+        ipaddress.ip_network("10.0.0.5"))] == ["p1"]
+
+    storage.server.export_rules_of.return_value = [(1, "10.0.0.0/24"),
+                                                   (2, "10.0.0.1"),
+                                                   (3, "10.0.0.2")]
+    storage.ensure_policy_rule_absent("p1", "10.0.0.1")
+    storage.server.remove_export_rule.assert_called_once_with("p1", 2)
+    assert storage.get_policy("p1") == ["10.0.0.0/24", "10.0.0.2"]
+
+    storage.create_policy("p2", ["10.0.0.0/8"])
+    storage.remove_policy("empty")
+    assert [p['name'] for p in storage.policies_granting(
+        ipaddress.ip_network("10.0.0.0/16"))] == ["p2"]
+
+    # Policies created outside of the API are looked up on the filer
+    storage.server.export_rules_of.return_value = [(1, "10.0.0.4")]
+    type(storage.server).export_policies = mock.PropertyMock(
+        return_value=[fake_policy("p1"), fake_policy("p2"),
+                      fake_policy("new")])
+    assert storage.get_policy("new") == ["10.0.0.4"]
+    with pytest.raises(KeyError):
+        storage.get_policy("no_such_policy")
+    assert storage.server._get_paginated.call_count == 1
+
+
+def test_volume_inventory_volumes_with():
+    volumes = [{'name': "vol1", 'active_policy_name': "p1"},
+               {'name': "vol2", 'active_policy_name': "p2"},
+               {'name': "vol3"}]
+    inventory = VolumeInventory(ttl_s=60, load=lambda: volumes,
+                                indexed=['active_policy_name'])
+
+    def names(values):
+        return [v['name'] for v
+                in inventory.volumes_with('active_policy_name', values)]
+
+    assert names(["p1", "p2"]) == ["vol1", "vol2"]
+    assert names([None]) == ["vol3"]
+
+    inventory.put({'name': "vol1", 'active_policy_name': "p2"})
+    inventory.put({'name': "vol4", 'active_policy_name': "p1"})
+    inventory.discard("vol2")
+    assert names(["p1"]) == ["vol4"]
+    assert names(["p2"]) == ["vol1"]
+
+    # By name, not in the order they were added
+    inventory.put({'name': "vol0", 'active_policy_name': "p1"})
+    assert names(["p1", "p2"]) == ["vol0", "vol1", "vol4"]
+
+    with pytest.raises(ValueError):
+        inventory.volumes_with('state', ["online"])
+
+
+def test_netapp_volumes_accessible_from():
+    storage = mocked_netapp()
+    type(storage.server).export_policies = mock.PropertyMock(
+        return_value=[fake_policy("wide"), fake_policy("narrow")])
+    storage.server._get_paginated.return_value = [
+        ("wide", 1, "10.0.0.0/8"),
+        ("narrow", 1, "10.1.1.1")]
+    storage._read_volumes = mock.Mock(side_effect=lambda: [
+        FakeNetappVolume("vol1", policy="wide"),
+        FakeNetappVolume("vol2", policy="narrow"),
+        FakeNetappVolume("vol3", policy="default")])
+
+    def accessible_from(address):
+        return [v['name'] for v in storage.volumes_accessible_from(
+            ipaddress.ip_network(address))]
+
+    assert accessible_from("10.1.1.1") == ["vol1", "vol2"]
+    assert accessible_from("10.2.0.0/16") == ["vol1"]
+    assert accessible_from("192.168.0.1") == []
+
+    storage.server.volumes.single.return_value = FakeNetappVolume(
+        "vol3", policy="narrow")
+    storage.set_policy("vol3", "narrow")
+    storage.ensure_policy_rule_absent("narrow", "10.1.1.1")
+    storage.ensure_policy_rule_present("narrow", "10.1.1.0/24")
+    assert accessible_from("10.1.1.1") == ["vol1", "vol2", "vol3"]
+    assert storage._read_volumes.call_count == 1
+    assert storage.server._get_paginated.call_count == 1
+
+
+def test_change_feed():
+    state = {'volume': {"vol1": {'size': 1}, "vol2": {'size': 2}},
+             'policy': {}}
+    feed = ChangeFeed(scan=lambda: {kind: dict(items)
+                                    for kind, items in state.items()},
+                      interval_s=0)
+    feed.start()
+    first = feed.token
+
+    token, changes, complete = feed.since(None)
+    assert complete
+    assert sorted(c.key for c in changes) == ["vol1", "vol2"]
+    assert feed.since(first) == (first, [], False)
+
+    state['volume']["vol1"] = {'size': 10}
+    del state['volume']["vol2"]
+    state['policy']["p1"] = {'rules': []}
+    feed.poll()
+    second = feed.token
+    state['volume']["vol1"] = {'size': 20}
+    feed.poll()
+
+    token, changes, complete = feed.since(first)
+    assert token == feed.token
+    assert not complete
+    assert ([(c.kind, c.key, c.change, c.data) for c in changes]
+            == [('policy', "p1", 'created', {'rules': []}),
+                ('volume', "vol2", 'deleted', None),
+                ('volume', "vol1", 'updated', {'size': 20})])
+
+    _token, changes, _complete = feed.since(second, kinds=['policy'])
+    assert changes == []
+    # A token from a later scan elsewhere is not moved back
+    assert feed.since(feed.token + 60)[0] == feed.token + 60
+
+
+def test_change_feed_resyncs_when_changes_are_dropped():
+    state = {'volume': {}}
+    feed = ChangeFeed(scan=lambda: {'volume': dict(state['volume'])},
+                      interval_s=0, max_events=2)
+    feed.start()
+    first = feed.token
+    for i in range(3):
+        state['volume']["vol{}".format(i)] = {}
+        feed.poll()
+
+    token, changes, complete = feed.since(first)
+    assert complete
+    assert len(changes) == 3
+    assert not feed.since(token)[2]
+
+
+def test_change_feed_token_from_another_feed():
+    state = {'volume': {}}
+
+    def scan_a():
+        seen = {'volume': dict(state['volume'])}
+        if scanning:
+            # Changed during the scan of a, after it read the state,
+            # then found by a scan of b ending before the one of a
+            time.sleep(0.01)
+            state['volume']["vol1"] = {}
+            feed_b.poll()
+            time.sleep(0.01)
+        return seen
+
+    scanning = False
+    feed_a = ChangeFeed(scan=scan_a, interval_s=0)
+    feed_b = ChangeFeed(scan=lambda: {'volume': dict(state['volume'])},
+                        interval_s=0)
+    feed_a.start()
+    feed_b.start()
+
+    scanning = True
+    feed_a.poll()
+    scanning = False
+    token, changes, complete = feed_b.since(feed_a.token)
+    assert not complete
+    assert [c.key for c in changes] == ["vol1"]
+    assert feed_a.since(token)[1] == []
+
+
+def test_change_feed_wait():
+    feed = ChangeFeed(scan=lambda: {}, interval_s=0)
+    feed.start()
+    token = feed.token
+    assert not feed.wait(token, timeout_s=0.05)
+
+    threading.Timer(0.05, feed.poll).start()
+    assert feed.wait(token, timeout_s=5)
+
+
+def test_dummy_scan_state():
+    storage = DummyStorage()
+    storage.create_volume("vol1")
+    storage.create_snapshot("vol1", "snap1")
+    storage.create_lock("vol1", "host1")
+    storage.create_policy("p1", ["10.0.0.1"])
+
+    state = storage.scan_state()
+
+    assert list(state['volume']) == ["vol1"]
+    assert state['snapshot']["vol1/snap1"]['volume_name'] == "vol1"
+    assert state['lock'] == {"vol1": {'volume_name': "vol1",
+                                      'hosts': ["host1"]}}
+    assert state['policy'] == {"p1": {'name': "p1", 'rules': ["10.0.0.1"]}}
+
+    storage.ensure_policy_rule_present("p1", "10.0.0.2")
+    assert state['policy']["p1"]['rules'] == ["10.0.0.1"]
+
+
+def test_netapp_scan_state():
+    storage = mocked_netapp(policy_index_refresh_s=0)
+    storage._read_volumes = mock.Mock(side_effect=lambda: [
+        FakeNetappVolume("vol1")])
+    type(storage.server).export_policies = mock.PropertyMock(
+        return_value=[fake_policy("p1")])
+    snapshot = storage_module.format_snapshot(netapp.api.Snapshot(
+        name="snap1", size_kbytes=1, creation_time=datetime(2017, 1, 1)))
+
+    def paginated(api_call, **_kwargs):
+        return {'export-rule-get-iter': [("p1", 1, "10.0.0.1")],
+                'snapshot-get-iter': [("vol1", snapshot),
+                                      ("aggr0_root", {'name': "x"})],
+                'lock-get-iter': [("vol1", "host2"), ("vol1", "host1")],
+                }[api_call.tag]
+    storage.server._get_paginated.side_effect = paginated
+
+    state = storage.scan_state()
+
+    assert list(state['volume']) == ["vol1"]
+    assert list(state['snapshot']) == ["vol1/snap1"]
+    assert state['lock']["vol1"]['hosts'] == ["host1", "host2"]
+    assert state['policy'] == {"p1": {'name': "p1", 'rules': ["10.0.0.1"]}}
+    storage.server.snapshots_of.assert_not_called()
+    storage.server.locks_on.assert_not_called()
+
+
+def test_pooled_server_port_and_scheme():
+    server = PooledServer(hostname="filer", username="user",
+                          password="password", port=8080, scheme="http")
+    assert server.ontap_api_url.startswith("http://filer:8080/")
+    assert server.ocum_api_url.startswith("http://filer:8080/")
+    with pytest.raises(ValueError):
+        PooledServer(hostname="filer", username="user",
+                     password="password", scheme="ftp")
+
+
+@contextmanager
+def fake_filer_storage(profiles=None, backend_class=NetappStorage,
+                       **kwargs):
+    from benchmarks.endpoints import make_fleet
+    from benchmarks.fakefiler import FakeFiler, serve
+
+    filer = FakeFiler.from_fleet(make_fleet(30, 90, 5, seed=3),
+                                 profiles=profiles)
+    server = serve(filer)
+    try:
+        yield filer, backend_class(hostname="127.0.0.1", port=server.port,
+                                   scheme="http", username="user",
+                                   password="password", vserver="vs0",
+                                   **kwargs)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_netapp_against_fake_filer():
+    with fake_filer_storage(inventory_refresh_s=0,
+                            volume_index_refresh_s=0,
+                            policy_index_refresh_s=0) as (filer, storage):
+        listed = {v['name'] for v in storage.volumes}
+        assert listed == {name for name, v in filer.volumes.items()
+                          if v['state'] != 'restricted'}
+
+        name = next(iter(filer.volumes))
+        volume = storage.get_volume(name)
+        assert volume['size_total'] == filer.volumes[name]['size_total']
+        assert ([s['name'] for s in storage.get_snapshots(name)]
+                == list(filer.snapshots[name]))
+
+        storage.create_volume("new", junction_path="/new",
+                              size_total=2 ** 30)
+        storage.create_snapshot(":/new", "snap")
+        assert storage.get_snapshot("new", "snap")['name'] == "snap"
+        report = storage.patch_volume("new", size_total=2 ** 31)
+        assert report['applied'] == ['size_total']
+        assert filer.volumes["new"]['size_total'] == 2 ** 31
+
+        storage.create_policy("policy", ["10.0.0.0/8"])
+        storage.ensure_policy_rule_present("policy", "10.1.0.0/16")
+        storage.ensure_policy_rule_absent("policy", "10.0.0.0/8")
+        assert list(filer.policies["policy"].values()) == ["10.1.0.0/16"]
+
+        locked, host = next(iter(filer.locks.items()), (name, "host"))
+        filer.locks[locked] = [host]
+        assert storage.locks(locked) == [host]
+        storage.remove_lock(locked, host)
+        assert storage.locks(locked) is None
+
+
+@pytest.mark.parametrize('backend_class', [NetappStorage, AsyncNetappStorage])
+def test_netapp_inventory_loaded_in_bulk(backend_class):
+    from benchmarks.fakefiler import CallProfile
+
+    # One page of everything
+    profiles = {call: CallProfile(max_records=1000)
+                for call in ['volume-get-iter', 'sis-get-iter']}
+    with fake_filer_storage(profiles=profiles, backend_class=backend_class,
+                            inventory_refresh_s=0,
+                            volume_index_refresh_s=0,
+                            policy_index_refresh_s=0) as (filer, storage):
+        filer.sis_enabled.discard(next(iter(filer.volumes)))
+        expected = {v['name']: v for v in map(storage.format_volume,
+                                              storage.server.volumes)
+                    if storage.is_listed(v)}
+        filer.calls.clear()
+
+        assert {v['name']: v for v in storage.volumes} == expected
+        assert filer.calls == {'volume-get-iter': 1, 'sis-get-iter': 1}
+
+
+def test_periodic_refresh_pauses_when_unused():
+    calls = []
+    refresh = PeriodicRefresh(0.01, lambda: calls.append(1), idle_s=0.05)
+    refresh.start()
+    assert refresh.running
+    time.sleep(0.2)
+    assert not refresh.running
+    made = len(calls)
+    assert made
+    time.sleep(0.05)
+    assert len(calls) == made
+
+    refresh.start()
+    assert refresh.running
+    refresh.stop()
+
+
+def test_fake_filer_pages_and_injected_errors():
+    from benchmarks.fakefiler import CallProfile, EBUSY
+
+    profiles = {'volume-get-iter': CallProfile(max_records=7),
+                'snapshot-create': CallProfile(error_rate=1.0)}
+    with fake_filer_storage(profiles=profiles) as (filer, storage):
+        assert len(list(storage.server.volumes)) == 30
+        assert filer.calls['volume-get-iter'] == 5
+
+        with pytest.raises(netapp.api.APIError) as excinfo:
+            storage.server.create_snapshot(next(iter(filer.volumes)), "s")
+        assert excinfo.value.errno == EBUSY
+        assert filer.errors_injected == 1
+
+
+@pytest.mark.parametrize('backend_class', [NetappStorage, AsyncNetappStorage])
+def test_zapi_call_trace(backend_class, caplog):
+    from benchmarks.fakefiler import CallProfile
+    from storage_api.extensions import zapi
+
+    profiles = {'volume-size': CallProfile(latency_s=0.05)}
+    with fake_filer_storage(profiles=profiles, backend_class=backend_class,
+                            slow_call_s=0.04, inventory_refresh_s=0,
+                            volume_index_refresh_s=0,
+                            policy_index_refresh_s=0) as (filer, storage):
+        name = next(iter(filer.volumes))
+        before = sum(filer.calls.values())
+        trace = zapi.start_trace()
+        try:
+            # Settings are applied in parallel, in other threads
+            report = storage.patch_volume(name, size_total=2 ** 31,
+                                          percentage_snapshot_reserve=10)
+        finally:
+            zapi.end_trace()
+
+        assert sorted(report['applied']) == ['percentage_snapshot_reserve',
+                                             'size_total']
+        assert trace.calls == sum(filer.calls.values()) - before
+        calls = {call: count for call, count, _ in trace.summary()}
+        assert calls['volume-size'] == 1
+        assert sum(calls.values()) == trace.calls
+        assert trace.summary()[0][0] == 'volume-size'
+        assert zapi.current_trace() is None
+
+        storage.get_volume(name)
+        assert trace.calls == sum(calls.values())
+
+    slow = [r.getMessage() for r in caplog.records
+            if "Slow ZAPI call" in r.getMessage()]
+    assert slow and "volume-size" in slow[0] and name in slow[0]
+
+
+def test_timed_backend():
+    from storage_api.extensions.metrics import (BACKEND_SECONDS,
+                                                timed_backend)
+    import inspect
+
+    backend = DummyStorage()
+    timed = timed_backend("timed", backend)
+    assert timed_backend("timed", backend) is timed
+    assert timed_backend("timed", DummyStorage()) is not timed
+    timed = timed_backend("timed", backend)
+
+    assert (inspect.signature(timed.create_volume)
+            == inspect.signature(backend.create_volume))
+    count = functools.partial(BACKEND_SECONDS.count, "timed")
+
+    timed.create_volume("timed", size_total=10, filer_address="filer")
+    timed.create_volume("timed_too", size_total=10, filer_address="filer")
+    assert count("create_volume") == 2
+    assert [v['name'] for v in timed.volumes] == ["timed", "timed_too"]
+    assert count("volumes") == 1
+
+    volumes = timed.iter_volumes()
+    next(volumes)
+    assert count("iter_volumes") == 0
+    assert len(list(volumes)) == 1
+    assert count("iter_volumes") == 1
+
+    with pytest.raises(KeyError):
+        timed.get_volume("no_such_volume")
+    assert count("get_volume") == 1
+    assert timed.trusted is backend.trusted
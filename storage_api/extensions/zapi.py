@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "LICENSE".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""
+The transport used to talk ZAPI to NetApp filers.
+
+netapp.api.Server uses a single requests.Session with the default
+connection pool for everything, which is not safe to share between
+the threads of a uwsgi worker.
+
+The calls made on behalf of an HTTP request are counted and timed in
+its CallTrace, which is kept per thread (see tracing()). Work handed
+over to other threads has to take the trace along (see traced()).
+"""
+from storage_api.utils import init_logger
+from storage_api.extensions import metrics
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict  # noqa
+
+import lxml.etree
+import netapp.api
+import requests
+from requests.adapters import HTTPAdapter
+
+log = init_logger()
+
+# How much of the arguments of slow calls to log
+MAX_LOGGED_CALL_LENGTH = 2000
+
+ZAPI_SECONDS = metrics.histogram(
+    'sapi_zapi_call_duration_seconds',
+    "Time spent in ZAPI calls to the filers, including waiting for a"
+    " connection",
+    ['call'])
+
+
+class CallTrace(object):
+    """
+    The number of ZAPI calls made on behalf of something (e.g. an HTTP
+    request), and the time spent in them, in total and by call name.
+
+    Calls made at the same time from several threads are all counted,
+    so the total time may be longer than the request itself.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.duration_s = 0.0
+        self.by_name = OrderedDict()  # type: Dict[str, list]
+        self._lock = threading.Lock()
+
+    def record(self, name, duration_s):
+        with self._lock:
+            self.calls += 1
+            self.duration_s += duration_s
+            entry = self.by_name.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += duration_s
+
+    def summary(self):
+        """
+        Return a list of (name, calls, duration in seconds) tuples, by
+        descending duration.
+        """
+        with self._lock:
+            entries = [(name, calls, duration_s) for name, (calls, duration_s)
+                       in self.by_name.items()]
+        return sorted(entries, key=lambda e: e[2], reverse=True)
+
+
+_current = threading.local()
+
+
+def current_trace():
+    """
+    Return the CallTrace of the current thread, or None.
+    """
+    return getattr(_current, 'trace', None)
+
+
+@contextmanager
+def tracing(trace):
+    """
+    Record the ZAPI calls made by the current thread in trace (if not
+    None) in the with block.
+    """
+    previous = current_trace()
+    _current.trace = trace
+    try:
+        yield trace
+    finally:
+        _current.trace = previous
+
+
+def start_trace():
+    """
+    Record the ZAPI calls made by the current thread from now on in a
+    new CallTrace, and return it.
+    """
+    _current.trace = CallTrace()
+    return _current.trace
+
+
+def end_trace():
+    _current.trace = None
+
+
+def traced(func, trace=None):
+    """
+    Return a function calling func with its ZAPI calls recorded in trace,
+    by default the CallTrace of the current thread, for func to be run
+    in another thread.
+    """
+    trace = trace or current_trace()
+    if trace is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with tracing(trace):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def bind_current_trace():
+    """
+    Return a function binding functions to the CallTrace of the current
+    thread (see traced()), for them to be run later in other threads.
+    """
+    return functools.partial(traced, trace=current_trace())
+
+
+def call_name(api_call):
+    return lxml.etree.QName(api_call).localname
+
+
+class PooledServer(netapp.api.Server):
+    """
+    A netapp.api.Server giving each thread its own session, while all
+    threads share one pool of kept-alive connections to the filer, so
+    that a connection (and its TLS handshake) outlives the request that
+    opened it.
+
+    - pool_size: the number of idle connections kept open
+    - max_connections: the maximum number of calls in flight at the same
+      time, further calls wait for one to finish. 0 means no limit.
+    - keep_alive: if False, close every connection after its call.
+    - scheme: https, or http for filers (or stand-ins for them, see
+      benchmarks/fakefiler.py) answering over plain HTTP.
+    - slow_call_s: calls taking longer than this are logged with their
+      arguments. 0 disables the logging.
+
+    Every call is recorded in the CallTrace of the calling thread, if it
+    has one (see tracing()), and in ZAPI_SECONDS.
+    """
+
+    def __init__(self, *args, pool_size=4, max_connections=0,
+                 keep_alive=True, scheme="https", slow_call_s=0, **kwargs):
+        if scheme not in ("http", "https"):
+            raise ValueError("Invalid ZAPI scheme: {}".format(scheme))
+        self.pool_size = pool_size
+        self.max_connections = max_connections
+        self.keep_alive = keep_alive
+        self.slow_call_s = slow_call_s
+        self._adapter = HTTPAdapter(pool_connections=1,
+                                    pool_maxsize=pool_size)
+        self._local = threading.local()
+        self._slots = (threading.BoundedSemaphore(max_connections)
+                       if max_connections > 0 else None)
+        self._stats_lock = threading.Lock()
+        self._calls = 0
+        self._in_flight = 0
+        self._max_in_flight = 0
+        super().__init__(*args, **kwargs)
+        # netapp.api.Server always talks HTTPS
+        self.ocum_api_url = self._with_scheme(self.ocum_api_url, scheme)
+        self.ontap_api_url = self._with_scheme(self.ontap_api_url, scheme)
+
+    @staticmethod
+    def _with_scheme(url, scheme):
+        return "{}://{}".format(scheme, url.split("://", 1)[1])
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", self._adapter)
+            session.mount("http://", self._adapter)
+            if not self.keep_alive:
+                session.headers['Connection'] = 'close'
+            self._local.session = session
+        return session
+
+    @session.setter
+    def session(self, session):
+        # netapp.api.Server.__init__ sets up a session of its own, which
+        # we have no use for.
+        session.close()
+
+    def close(self):
+        self._adapter.close()
+
+    def perform_call(self, api_call, api_url):
+        start = time.perf_counter()
+        if self._slots is not None:
+            self._slots.acquire()
+
+        with self._stats_lock:
+            self._calls += 1
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+        try:
+            return super().perform_call(api_call, api_url)
+        finally:
+            with self._stats_lock:
+                self._in_flight -= 1
+            if self._slots is not None:
+                self._slots.release()
+            self._record_call(api_call, time.perf_counter() - start)
+
+    def _record_call(self, api_call, duration_s):
+        name = call_name(api_call)
+        ZAPI_SECONDS.observe(duration_s, name)
+        trace = current_trace()
+        if trace is not None:
+            trace.record(name, duration_s)
+
+        if 0 < self.slow_call_s < duration_s:
+            arguments = lxml.etree.tostring(api_call, encoding='unicode')
+            if len(arguments) > MAX_LOGGED_CALL_LENGTH:
+                arguments = arguments[:MAX_LOGGED_CALL_LENGTH] + "..."
+            log.warning("Slow ZAPI call {} to {} took {:.3f}s: {}"
+                        .format(name, self.hostname, duration_s, arguments))
+
+    def pool_stats(self):
+        """
+        Return a dictionary of statistics about the use of the
+        connection pool since it was created.
+        """
+        opened = 0
+        requests_sent = 0
+        idle = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            requests_sent += pool.num_requests
+            idle += sum(1 for conn in list(pool.pool.queue)
+                        if conn is not None and conn.sock is not None)
+
+        with self._stats_lock:
+            return {'pool_size': self.pool_size,
+                    'max_connections': self.max_connections,
+                    'keep_alive': self.keep_alive,
+                    'calls': self._calls,
+                    'in_flight': self._in_flight,
+                    'max_in_flight': self._max_in_flight,
+                    'requests': requests_sent,
+                    'connections_opened': opened,
+                    'idle_connections': idle}
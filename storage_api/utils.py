@@ -48,6 +48,24 @@ def filter_none(d):
     return dict_without(d, *filter(lambda k: d[k] is None, d.keys()))
 
 
+def to_bool(value):
+    """
+    Interpret value as a boolean, accepting the strings true/false,
+    yes/no, on/off and 1/0 in any case as they come from configuration.
+
+    Raises ValueError on any other string.
+    """
+    if not isinstance(value, str):
+        return bool(value)
+
+    lowered = value.strip().lower()
+    if lowered in ('true', 'yes', 'on', '1'):
+        return True
+    if lowered in ('false', 'no', 'off', '0', ''):
+        return False
+    raise ValueError("Not a boolean value: '{}'".format(value))
+
+
 def compose_decorators(*decs):
     """
     Compose a set of decorators into one.
@@ -1,13 +1,18 @@
 from storage_api.apis import common
+import storage_api.apis.storage
 from storage_api.apis import SAPI_MOUNTPOINT
 from storage_api.utils import compose_decorators
 
+import gzip
 import json
+import os
 from urllib.parse import urlencode
 from contextlib import contextmanager
 import uuid
 from storage_api.utils import init_logger
 from functools import partial
+import threading
+from unittest import mock
 
 import pytest
 import hypothesis
@@ -331,7 +336,11 @@ def test_clone_from_snapshot(client, namespace):
                                              'from_volume': master_name})
 
     assert post_code == 201
-    assert _get(client, clone_volume) == _get(client, volume)
+    clone_code, clone = _get(client, clone_volume)
+    volume_code, original = _get(client, volume)
+    assert clone_code == volume_code == 200
+    assert clone['name'] == "clone"
+    assert dict(clone, name=None) == dict(original, name=None)
 
 
 @params_namespaces
@@ -762,3 +771,797 @@ def test_put_to_export_rule_with_slash(client, namespace):
         for rule in rules:
             put_code, _ = _put(client, ("{}/rule/{}".format(policy, rule)))
             assert put_code == 201
+
+
+@params_namespaces
+def test_list_volumes_filtered(client, namespace):
+    with user_set(client):
+        for volume_name in ["alpha_1", "alpha_2", "beta_1"]:
+            post_code, _ = _post(client, '{}/volumes/{}'
+                                 .format(namespace, volume_name))
+            assert post_code == 201
+
+    code, response = _get(client, "{}/volumes".format(namespace),
+                          name_prefix="alpha")
+    assert code == 200
+    assert sorted(v['name'] for v in response) == ["alpha_1", "alpha_2"]
+
+    code, response = _get(client, "{}/volumes".format(namespace),
+                          filer_address="no-such-filer")
+    assert code == 200
+    assert response == []
+
+
+@params_namespaces
+def test_list_volumes_projection(client, namespace):
+    with user_set(client):
+        _post(client, '{}/volumes/{}'.format(namespace, "projected"),
+              data={'size_total': 42})
+
+    code, response = _get(client, "{}/volumes".format(namespace),
+                          fields="name,size_total")
+    assert code == 200
+    assert response == [{'name': "projected", 'size_total': 42}]
+
+    code, response = _get(client, "{}/volumes".format(namespace),
+                          fields="name,no_such_field")
+    assert code == 400
+    assert 'no_such_field' in response['message']
+
+
+@params_namespaces
+def test_list_volumes_paginated(client, namespace):
+    volume_names = ["paged_{}".format(i) for i in range(7)]
+    with user_set(client):
+        for volume_name in reversed(volume_names):
+            _post(client, '{}/volumes/{}'.format(namespace, volume_name))
+
+    seen = []
+    params = {'limit': 3}
+    while True:
+        result = client.get("{}/volumes?{}".format(namespace,
+                                                   urlencode(params)))
+        assert result.status_code == 200
+        seen.extend(v['name'] for v in json.loads(
+            result.get_data(as_text=True)))
+        if 'X-Next-Cursor' not in result.headers:
+            break
+        assert 'rel="next"' in result.headers['Link']
+        params['cursor'] = result.headers['X-Next-Cursor']
+
+    assert seen == volume_names
+
+    code, _ = _get(client, "{}/volumes".format(namespace), cursor="abc")
+    assert code == 400
+
+
+@params_namespaces
+def test_list_volumes_streamed(client, namespace):
+    code, response = _get(client, "{}/volumes".format(namespace),
+                          stream="true")
+    assert code == 200
+    assert response == []
+
+    with user_set(client):
+        for i in range(100):
+            _post(client, '{}/volumes/streamed_{}'.format(namespace, i))
+
+    code, response = _get(client, "{}/volumes".format(namespace),
+                          stream="true", fields="name")
+    assert code == 200
+    assert len(response) == 100
+    assert {'name': "streamed_42"} in response
+
+
+@params_namespaces
+def test_list_snapshots_streamed_no_volume(client, namespace):
+    code, response = _get(client,
+                          "{}/volumes/no_such_volume/snapshots"
+                          .format(namespace),
+                          stream="true")
+    assert code == 404
+
+
+@params_namespaces
+def test_get_volume_conditional(client, namespace):
+    with user_set(client):
+        _post(client, '{}/volumes/etagged'.format(namespace),
+              data={'size_total': 100})
+
+        url = "{}/volumes/etagged".format(namespace)
+        result = client.get(url)
+        assert result.status_code == 200
+        etag = result.headers['ETag']
+
+        with mock.patch.object(storage_api.apis.storage, 'marshal_fast',
+                               wraps=storage_api.apis.storage.marshal_fast
+                               ) as marshal_fast:
+            not_modified = client.get(url, headers={'If-None-Match': etag})
+            assert not marshal_fast.called
+        assert not_modified.status_code == 304
+        assert not_modified.headers['ETag'] == etag
+        assert not not_modified.get_data()
+
+        masked = client.get(url, headers={'If-None-Match': etag,
+                                          'X-Fields': 'name'})
+        assert masked.status_code == 200
+        assert masked.headers['ETag'] != etag
+
+        client.patch(url, data=json.dumps({'size_total': 200}),
+                     headers=_DEFAULT_HEADERS)
+        modified = client.get(url, headers={'If-None-Match': etag})
+        assert modified.status_code == 200
+        assert modified.headers['ETag'] != etag
+
+
+@params_namespaces
+def test_list_snapshots_conditional(client, namespace):
+    with user_set(client):
+        _post(client, '{}/volumes/snapped'.format(namespace))
+        _post(client, '{}/volumes/snapped/snapshots/snap1'.format(namespace))
+
+    url = "{}/volumes/snapped/snapshots".format(namespace)
+    result = client.get(url)
+    assert result.status_code == 200
+    assert 'Last-Modified' not in result.headers
+
+    not_modified = client.get(
+        url, headers={'If-None-Match': result.headers['ETag']})
+    assert not_modified.status_code == 304
+
+    assert 'ETag' not in client.get(url, query_string={'stream': 'true'}
+                                    ).headers
+
+
+@params_namespaces
+def test_list_snapshots_conditional_after_delete(client, namespace):
+    volume = '{}/volumes/snapped_twice'.format(namespace)
+    with user_set(client):
+        _post(client, volume)
+        _post(client, '{}/snapshots/snap1'.format(volume))
+        _post(client, '{}/snapshots/snap2'.format(volume))
+
+        url = "{}/snapshots".format(volume)
+        etag = client.get(url).headers['ETag']
+        client.delete('{}/snapshots/snap2'.format(volume))
+
+        result = client.get(url, headers={'If-None-Match': etag})
+        assert result.status_code == 200
+        assert result.headers['ETag'] != etag
+        assert [s['name'] for s in json.loads(result.get_data(
+            as_text=True))] == ["snap1"]
+
+
+@params_namespaces
+def test_get_policy_conditional(client, namespace):
+    with user_set(client):
+        url = "{}/export/etagged_policy".format(namespace)
+        _post(client, url, data={'rules': ["10.0.0.1"]})
+
+        etag = client.get(url).headers['ETag']
+        assert client.get(url, headers={'If-None-Match': etag}
+                          ).status_code == 304
+
+        client.put("{}/rule/10.0.0.2".format(url))
+        assert client.get(url, headers={'If-None-Match': etag}
+                          ).status_code == 200
+
+
+@params_namespaces
+def test_list_policies_granting(client, namespace):
+    with user_set(client):
+        _post(client, "{}/export/granting_wide".format(namespace),
+              data={'rules': ["10.128.0.0/9", "host.cern.ch"]})
+        _post(client, "{}/export/granting_narrow".format(namespace),
+              data={'rules': ["10.200.1.5"]})
+
+        def granting(address):
+            code, policies = _get(client, "{}/export".format(namespace),
+                                  granting=address)
+            assert code == 200
+            return sorted(p['name'] for p in policies
+                          if p['name'].startswith("granting_"))
+
+        assert granting("10.200.1.5") == ["granting_narrow",
+                                          "granting_wide"]
+        assert granting("10.200.1.0/24") == ["granting_wide"]
+        assert granting("10.0.0.1") == []
+
+        code, _ = _get(client, "{}/export".format(namespace),
+                       granting="host.cern.ch")
+        assert code == 400
+
+
+@params_namespaces
+def test_get_volumes_accessible_from(client, namespace):
+    with user_set(client):
+        _post(client, "{}/export/access_wide".format(namespace),
+              data={'rules': ["10.64.0.0/10"]})
+        _post(client, "{}/export/access_narrow".format(namespace),
+              data={'rules': ["10.64.3.0/24"]})
+        for volume_name, policy_name in [("access_1", "access_wide"),
+                                         ("access_2", "access_narrow")]:
+            volume = "{}/volumes/{}".format(namespace, volume_name)
+            _post(client, volume)
+            _patch(client, volume, data={'active_policy_name': policy_name})
+
+        code, volumes = _get(client, "{}/access/10.64.3.7".format(namespace))
+        assert code == 200
+        assert (sorted(v['name'] for v in volumes
+                       if v['name'].startswith("access_"))
+                == ["access_1", "access_2"])
+
+        code, volumes = _get(client,
+                             "{}/access/10.64.0.0/16".format(namespace))
+        assert code == 200
+        assert ([v['name'] for v in volumes
+                 if v['name'].startswith("access_")] == ["access_1"])
+
+        code, _ = _get(client, "{}/access/not-an-address".format(namespace))
+        assert code == 400
+
+
+def _poll_changes(app, namespace):
+    """
+    Make the change feed of namespace scan now rather than in a while.
+    """
+    with app.app_context():
+        storage_api.apis.storage.change_feed(namespace.split("/")[-1]).poll()
+
+
+@params_namespaces
+def test_list_volumes_since(client, namespace, temp_app):
+    url = "{}/volumes".format(namespace)
+    with user_set(client):
+        _post(client, "{}/changed_1".format(url))
+        _post(client, "{}/changed_2".format(url))
+
+        code, changes = _get(client, url, since="0")
+        assert code == 200
+        assert changes['complete']
+        assert changes['deleted'] == []
+        assert (sorted(v['name'] for v in changes['changed'])
+                == ["changed_1", "changed_2"])
+
+        code, changes = _get(client, url, since=changes['token'])
+        assert code == 200
+        assert (changes['complete'], changes['changed'],
+                changes['deleted']) == (False, [], [])
+
+        token = changes['token']
+        _patch(client, "{}/changed_1".format(url),
+               data={'active_policy_name': "changed"})
+        _delete(client, "{}/changed_2".format(url))
+        _post(client, "{}/changed_3".format(url))
+        _poll_changes(temp_app, namespace)
+
+        code, changes = _get(client, url, since=token)
+        assert code == 200
+        assert not changes['complete']
+        assert (sorted(v['name'] for v in changes['changed'])
+                == ["changed_1", "changed_3"])
+        assert changes['deleted'] == ["changed_2"]
+        assert changes['token'] > token
+
+        code, _ = _get(client, url, since="yesterday")
+        assert code == 400
+
+
+@params_namespaces
+def test_events(client, namespace, temp_app):
+    url = "{}/events".format(namespace)
+    with mock.patch.dict(temp_app.config, {'EVENTS_MAX_DURATION_S': 0}), \
+            user_set(client):
+        _post(client, "{}/volumes/evented".format(namespace))
+        _put(client, "{}/volumes/evented/locks/db1.cern.ch".format(namespace))
+
+        response = client.get(url, query_string={'since': "0"})
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        events = response.get_data(as_text=True).strip().split("\n\n")
+        assert events[0] == "retry: {}".format(
+            int(temp_app.config['EVENTS_RETRY_S'] * 1000))
+        assert events[1] == "event: resync\ndata: {}"
+        assert "event: lock\n" in response.get_data(as_text=True)
+        assert events[-1].startswith("id: ")
+        token = events[-1].split("\n")[0][len("id: "):]
+
+        _delete(client, "{}/volumes/evented/locks/db1.cern.ch"
+                .format(namespace))
+        _poll_changes(temp_app, namespace)
+
+        response = client.get(url, headers={'Last-Event-ID': token},
+                              query_string={'kinds': "lock,volume"})
+        lines = response.get_data(as_text=True).strip().split("\n")
+        assert lines[0].startswith("retry: ")
+        assert lines[2].startswith("id: ")
+        assert lines[3] == "event: lock"
+        assert json.loads(lines[4][len("data: "):]) == {
+            'change': "deleted", 'key': "evented", 'data': None}
+
+        response = client.get(url, query_string={'kinds': "quotas"})
+        assert response.status_code == 400
+
+
+def _batch(client, namespace, operations, ordered=False):
+    return _post(client, "{}/batch".format(namespace),
+                 data={'operations': operations, 'ordered': ordered})
+
+
+@params_namespaces
+@pytest.mark.parametrize('ordered', [True, False])
+def test_batch(client, namespace, ordered):
+    with user_set(client):
+        code, results = _batch(client, namespace, [
+            {'operation': "create_volume",
+             'arguments': {'volume_name': "batched",
+                           'size_total': 100}},
+            {'operation': "create_policy",
+             'arguments': {'policy_name': "batched_policy",
+                           'rules': ["10.0.0.1"]}}],
+            ordered=ordered)
+        assert code == 200
+        assert [r['status'] for r in results] == [201, 201]
+        assert results[0]['result']['name'] == "batched"
+
+        code, results = _batch(client, namespace, [
+            {'operation': "create_snapshot",
+             'arguments': {'volume_name': "batched",
+                           'snapshot_name': "snap{}".format(i)}}
+            for i in range(20)] + [
+            {'operation': "get_snapshots",
+             'arguments': {'volume_name': "no_such_volume"}},
+            {'operation': "ensure_policy_rule_present",
+             'arguments': {'policy_name': "batched_policy",
+                           'rule': "10.0.0.2"}},
+            {'operation': "patch_volume",
+             'arguments': {'volume_name': "batched", 'colour': "blue"}},
+            {'operation': "format_volume", 'arguments': {}},
+            {'operation': "get_policy",
+             'arguments': {'policy_name': "batched_policy"}}],
+            ordered=ordered)
+        assert code == 200
+
+    statuses = [r['status'] for r in results]
+    assert statuses[:20] == [201] * 20
+    assert statuses[20] == 404
+    if ordered:
+        assert statuses[21:] == [424] * 4
+    else:
+        assert statuses[21:] == [201, 400, 400, 200]
+        assert results[-1]['result'] == ["10.0.0.1", "10.0.0.2"]
+
+    _, snapshots = _get(client, "{}/volumes/batched/snapshots"
+                        .format(namespace))
+    assert len(snapshots) == 20
+
+
+@params_namespaces
+def test_batch_checks_roles(client, namespace):
+    with user_set(client, user={'roles': [common.USER_ROLE]}):
+        code, results = _batch(client, namespace, [
+            {'operation': "create_volume",
+             'arguments': {'volume_name': "batched"}},
+            {'operation': "get_volume",
+             'arguments': {'volume_name': "batched"}}])
+
+    assert code == 200
+    assert [r['status'] for r in results] == [403, 404]
+
+
+@params_namespaces
+def test_batch_too_large(client, namespace, temp_app):
+    with mock.patch.dict(temp_app.config, {'BATCH_MAX_OPERATIONS': 2}), \
+            user_set(client):
+        code, _ = _batch(client, namespace, [
+            {'operation': "get_volume", 'arguments': {'volume_name': "x"}}
+            for _ in range(3)])
+    assert code == 400
+
+
+def test_list_all_subsystems_volumes(client):
+    with user_set(client):
+        _post(client, '{}/netapp/volumes/fanned'.format(ROOT_URL))
+        _post(client, '{}/ceph/volumes/fanned'.format(ROOT_URL))
+        _post(client, '{}/ceph/volumes/other'.format(ROOT_URL))
+
+    code, response = _get(client, "{}/_all/volumes".format(ROOT_URL),
+                          name_prefix="fan", fields="name,subsystem")
+    assert code == 200
+    assert response['errors'] == []
+    assert sorted(response['volumes'], key=lambda v: v['subsystem']) == [
+        {'name': "fanned", 'subsystem': "ceph"},
+        {'name': "fanned", 'subsystem': "netapp"}]
+
+    code, response = _get(client, "{}/_all/volumes/other".format(ROOT_URL))
+    assert code == 200
+    assert [(v['name'], v['subsystem']) for v in response['volumes']] == [
+        ("other", "ceph")]
+
+    code, _ = _get(client, "{}/_all/volumes/nowhere".format(ROOT_URL))
+    assert code == 404
+
+
+def test_all_subsystems_partial_failure(client, temp_app):
+    storage = temp_app.extensions[temp_app.config['SUBSYSTEM']['netapp']]
+    release = threading.Event()
+
+    def slow_get_volume(volume_name):
+        release.wait(5)
+        raise KeyError(volume_name)
+
+    with user_set(client):
+        _post(client, '{}/ceph/volumes/partial'.format(ROOT_URL))
+
+    with mock.patch.dict(temp_app.config, {'FANOUT_TIMEOUT_S': 0.2}), \
+            mock.patch.object(storage, 'get_volume', slow_get_volume), \
+            mock.patch.object(temp_app.extensions[
+                temp_app.config['SUBSYSTEM']['dummy']],
+                'get_volume', side_effect=ValueError("Broken")):
+        code, response = _get(client, "{}/_all/volumes/partial"
+                              .format(ROOT_URL))
+        release.set()
+
+    assert code == 200
+    assert [v['subsystem'] for v in response['volumes']] == ["ceph"]
+    assert sorted((e['subsystem'], e['status'])
+                  for e in response['errors']) == [("dummy", 400),
+                                                   ("netapp", 504)]
+
+
+def test_subsystem_connections(client):
+    code, _ = _get(client, "/conf/subsystems/dummy/connections")
+    assert code == 404
+    code, _ = _get(client, "/conf/subsystems/no_such_thing/connections")
+    assert code == 404
+
+
+@params_namespaces
+def test_patch_volume_report(client, namespace, temp_app):
+    storage = temp_app.extensions[
+        temp_app.config['SUBSYSTEM'][namespace.split("/")[-1]]]
+    url = "{}/volumes/patched".format(namespace)
+
+    with user_set(client):
+        _post(client, url, data={'size_total': 100})
+        code, report = _patch(client, url, data={'size_total': 200})
+        assert code == 200
+        assert report == {'applied': ['size_total'], 'unchanged': [],
+                          'failed': {}}
+
+        with mock.patch.object(storage, 'patch_volume', return_value={
+                'applied': [], 'unchanged': [],
+                'failed': {'size_total': "No space left"}}):
+            code, report = _patch(client, url, data={'size_total': 300})
+        assert code == 500
+        assert report['failed'] == {'size_total': "No space left"}
+
+
+def test_swagger_spec_is_rendered_once(client):
+    plain = client.get("/swagger.json")
+    assert plain.status_code == 200
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.headers['Vary'] == 'Accept-Encoding'
+    assert 'max-age' in plain.headers['Cache-Control']
+    spec = json.loads(plain.get_data(as_text=True))
+    assert "{}/{{subsystem}}/volumes".format(ROOT_URL) in spec['paths']
+
+    compressed = client.get("/swagger.json",
+                            headers={'Accept-Encoding': 'gzip'})
+    assert compressed.status_code == 200
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.get_data()) == plain.get_data()
+    assert compressed.headers['ETag'] != plain.headers['ETag']
+
+    refused = client.get("/swagger.json",
+                         headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in refused.headers
+
+    not_modified = client.get(
+        "/swagger.json",
+        headers={'Accept-Encoding': 'gzip',
+                 'If-None-Match': compressed.headers['ETag']})
+    assert not_modified.status_code == 304
+    assert not_modified.get_data() == b''
+
+
+def test_swagger_spec_without_server(tmpdir):
+    from storage_api.apis.__main__ import main
+
+    output = tmpdir.join("swagger.json")
+    main(["--output", str(output)])
+    spec = json.loads(output.read())
+    assert "{}/{{subsystem}}/volumes".format(ROOT_URL) in spec['paths']
+
+
+@params_namespaces
+def test_list_volumes_compressed(client, namespace, temp_app):
+    url = "{}/volumes".format(namespace)
+    gzipped = {'Accept-Encoding': 'gzip'}
+
+    small = client.get(url, headers=gzipped)
+    assert 'Content-Encoding' not in small.headers
+    assert 'Accept-Encoding' in small.vary
+
+    with user_set(client):
+        for i in range(50):
+            _post(client, '{}/volumes/compressed_{}'.format(namespace, i))
+
+    plain = client.get(url)
+    result = client.get(url, headers=gzipped)
+    assert result.status_code == 200
+    assert result.headers['Content-Encoding'] == 'gzip'
+    assert int(result.headers['Content-Length']) < len(plain.get_data())
+    assert gzip.decompress(result.get_data()) == plain.get_data()
+    assert result.headers['ETag'] == "W/" + plain.headers['ETag']
+
+    not_modified = client.get(url, headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': result.headers['ETag']})
+    assert not_modified.status_code == 304
+
+    streamed = client.get(url, query_string={'stream': 'true'},
+                          headers=gzipped)
+    assert streamed.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in streamed.headers
+    assert (json.loads(gzip.decompress(streamed.get_data()).decode('utf-8'))
+            == json.loads(plain.get_data(as_text=True)))
+
+    unsupported = client.get(url, headers={'Accept-Encoding': 'compress'})
+    assert 'Content-Encoding' not in unsupported.headers
+
+    with mock.patch.dict(temp_app.config, {'COMPRESSION_ENCODINGS': []}):
+        disabled = client.get(url, headers=gzipped)
+    assert 'Content-Encoding' not in disabled.headers
+
+
+@params_namespaces
+def test_list_volumes_ndjson(client, namespace):
+    url = "{}/volumes".format(namespace)
+    ndjson = {'Accept': 'application/x-ndjson'}
+
+    empty = client.get(url, headers=ndjson)
+    assert empty.status_code == 200
+    assert empty.mimetype == 'application/x-ndjson'
+    assert empty.get_data() == b''
+
+    with user_set(client):
+        for i in range(40):
+            _post(client, '{}/volumes/ndjson_{}'.format(namespace, i))
+
+    _, volumes = _get(client, url)
+    result = client.get(url, headers=ndjson)
+    assert 'Accept' in result.vary
+    lines = result.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == volumes
+
+    result = client.get(url, query_string={'fields': 'name', 'limit': 5},
+                        headers=ndjson)
+    assert 'X-Next-Cursor' in result.headers
+    assert ([json.loads(line) for line
+             in result.get_data(as_text=True).splitlines()]
+            == [{'name': name} for name
+                in sorted(v['name'] for v in volumes)[:5]])
+
+    assert client.get("{}/volumes/no_such_volume/snapshots"
+                      .format(namespace), headers=ndjson).status_code == 404
+
+
+@params_namespaces
+def test_list_volumes_msgpack(client, namespace):
+    msgpack = pytest.importorskip("msgpack")
+
+    url = "{}/volumes".format(namespace)
+    with user_set(client):
+        for i in range(3):
+            _post(client, '{}/volumes/msgpack_{}'.format(namespace, i))
+
+    _, volumes = _get(client, url)
+    result = client.get(url, headers={'Accept': 'application/msgpack'})
+    assert result.mimetype == 'application/msgpack'
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(result.get_data())
+    assert list(unpacker) == volumes
+
+
+@composite
+def marshallable_values(draw):
+    from datetime import datetime
+    return draw(sampled_from([None, 0, 17, "17", "text", True, False, 1.5,
+                              datetime(2017, 1, 2, 3, 4, 5),
+                              ["10.0.0.1/32", "10.0.0.2/32"], [],
+                              [{'name': "nested", 'size_total': 1}]]))
+
+
+@pytest.mark.parametrize('model_name', ['volume_read_model', 'snapshot_model',
+                                        'export_policy_model', 'lock_model',
+                                        'volume_changes_model'])
+@given(data=hypothesis.strategies.data())
+def test_marshal_fast_matches_marshal(model_name, data):
+    from flask_restplus import marshal
+    from storage_api.apis.common.serializers import marshal_fast
+
+    model = getattr(storage_api.apis.storage, model_name)
+    names = list(model.resolved)
+    item = {name: data.draw(marshallable_values())
+            for name in data.draw(lists(sampled_from(names + ["unknown"]),
+                                        unique=True))}
+    mask = data.draw(sampled_from([None] + names))
+
+    def dumped(marshal, item):
+        try:
+            return json.dumps(marshal(item, model, mask=mask))
+        except Exception as e:
+            return type(e)
+
+    assert dumped(marshal_fast, item) == dumped(marshal, item)
+    assert (dumped(marshal_fast, [item, item])
+            == dumped(marshal, [item, item]))
+
+
+def test_marshal_fast_caches_serializers():
+    from flask_restplus.mask import Mask
+    from storage_api.apis.common.serializers import record_serializer
+
+    model = storage_api.apis.storage.volume_read_model
+    assert record_serializer(model) is record_serializer(model)
+    assert (record_serializer(model, Mask("name", skip=True))
+            is record_serializer(model, "name"))
+    assert record_serializer(model, "name") is not record_serializer(model)
+
+
+def _metric_value(text, sample):
+    """
+    Return the value of sample (a metric name with its labels) in the
+    Prometheus exposition text, 0 if it is not there.
+    """
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.split(" ")[-1])
+    return 0
+
+
+@params_namespaces
+def test_metrics(client, namespace):
+    subsystem = namespace.split("/")[-1]
+    route = '{route="' + ROOT_URL + '/<string:subsystem>/volumes'
+    requests_sample = ('sapi_http_request_duration_seconds_count' + route
+                       + '",method="GET"}')
+    not_found_sample = ('sapi_http_responses_total' + route
+                        + '/<path:volume_name>",method="GET",status="404"}')
+    backend_sample = ('sapi_backend_call_duration_seconds_count'
+                      '{{subsystem="{}",method="iter_volumes"}}'
+                      .format(subsystem))
+    marshal_sample = ('sapi_marshal_duration_seconds_count'
+                      '{model="VolumeRead"}')
+
+    before = client.get("/metrics").get_data(as_text=True)
+
+    with user_set(client):
+        _post(client, '{}/volumes/measured'.format(namespace))
+    _get(client, '{}/volumes'.format(namespace))
+    streamed = client.get('{}/volumes'.format(namespace),
+                          query_string={'stream': 'true'})
+    streamed.get_data()
+    streamed.close()
+    _get(client, '{}/volumes/no_such_volume'.format(namespace))
+
+    result = client.get("/metrics")
+    assert result.status_code == 200
+    assert result.mimetype == 'text/plain'
+    after = result.get_data(as_text=True)
+    assert "# TYPE sapi_http_request_duration_seconds histogram" in after
+
+    for sample, increase in [(requests_sample, 2),
+                             (not_found_sample, 1),
+                             (backend_sample, 2),
+                             (marshal_sample, 2)]:
+        assert (_metric_value(after, sample)
+                - _metric_value(before, sample)) == increase
+
+    bucket = requests_sample.replace("_count", "_bucket").replace(
+        "}", ',le="+Inf"}')
+    assert _metric_value(after, bucket) == _metric_value(after,
+                                                         requests_sample)
+
+
+def test_metrics_of_all_processes(client, temp_app, tmpdir):
+    from storage_api.extensions import metrics
+
+    sample = ('sapi_http_responses_total'
+              '{route="/metrics",method="GET",status="200"}')
+    other_process = metrics.Registry()
+    other_process.register(metrics.Counter(
+        'sapi_http_responses_total', "Responses sent, by status code",
+        ['route', 'method', 'status'])).inc("/metrics", "GET", "200",
+                                            amount=1000)
+    tmpdir.join("1.json").write(json.dumps(other_process.snapshot()))
+
+    local = _metric_value(client.get("/metrics").get_data(as_text=True),
+                          sample)
+    with mock.patch.dict(temp_app.config, {'METRICS_DIR': str(tmpdir)}):
+        merged = _metric_value(
+            client.get("/metrics").get_data(as_text=True), sample)
+
+    assert merged == local + 1 + 1000
+    assert tmpdir.join("{}.json".format(os.getpid())).check()
+
+
+def test_metrics_of_exited_processes(client, temp_app, tmpdir):
+    import subprocess
+    import sys
+    from storage_api.extensions import metrics
+
+    sample = 'sapi_test_total{kind="exited"}'
+    exited = []
+    for _ in range(2):
+        process = subprocess.Popen([sys.executable, "-c", ""])
+        process.wait()
+        exited.append(process.pid)
+        registry = metrics.Registry()
+        counter = registry.register(metrics.Counter(
+            'sapi_test_total', "For tests", ['kind']))
+        counter.inc("exited", amount=10)
+        tmpdir.join("{}.json".format(process.pid)).write(
+            json.dumps(registry.snapshot()))
+
+    with mock.patch.dict(temp_app.config, {'METRICS_DIR': str(tmpdir)}):
+        first = client.get("/metrics").get_data(as_text=True)
+        second = client.get("/metrics").get_data(as_text=True)
+
+    assert _metric_value(first, sample) == _metric_value(second, sample) == 20
+    assert tmpdir.join(metrics.EXITED_SNAPSHOT).check()
+    for pid in exited:
+        assert not tmpdir.join("{}.json".format(pid)).check()
+
+
+def test_metrics_dir_is_cleared_on_setup(tmpdir):
+    from flask import Flask
+    from storage_api import conf
+    from storage_api.apis.common import monitoring
+    from storage_api.extensions import metrics
+
+    app = Flask(__name__)
+    conf.load_metrics_conf(app)
+    assert app.config['METRICS_DIR']
+
+    app.config['METRICS_DIR'] = str(tmpdir)
+    tmpdir.join("1.json").write("{}")
+    tmpdir.join(metrics.EXITED_SNAPSHOT).write("{}")
+
+    monitoring.setup_metrics(app)
+    assert not [f for f in tmpdir.listdir() if f.ext == ".json"]
+
+
+def test_metrics_token(client, temp_app):
+    with mock.patch.dict(temp_app.config, {'METRICS_TOKEN': "s3cret"}):
+        assert client.get("/metrics").status_code == 401
+        assert client.get("/metrics", headers={
+            'Authorization': "Bearer wrong"}).status_code == 401
+        assert client.get("/metrics", headers={
+            'Authorization': "Bearer s3cret"}).status_code == 200
+
+
+def test_backend_call_headers(client, temp_app):
+    from storage_api.extensions import zapi
+
+    result = client.get("{}/dummy/volumes".format(ROOT_URL))
+    assert result.headers['X-SAPI-Backend-Calls'] == "0"
+    assert result.headers['Server-Timing'] == 'zapi;dur=0.0;desc="0 calls"'
+
+    storage = temp_app.extensions[temp_app.config['SUBSYSTEM']['dummy']]
+
+    def get_volume(volume_name):
+        trace = zapi.current_trace()
+        trace.record("volume-get-iter", 0.002)
+        trace.record("volume-get-iter", 0.003)
+        trace.record("snapshot-get-iter", 0.010)
+        return {'name': volume_name}
+
+    with mock.patch.object(storage, 'get_volume', side_effect=get_volume):
+        result = client.get("{}/dummy/volumes/traced".format(ROOT_URL))
+    assert result.status_code == 200
+    assert result.headers['X-SAPI-Backend-Calls'] == "3"
+    assert result.headers['Server-Timing'] == (
+        'zapi;dur=15.0;desc="3 calls", '
+        'zapi.snapshot-get-iter;dur=10.0;desc="1 call", '
+        'zapi.volume-get-iter;dur=5.0;desc="2 calls"')